@@ -1,2 +1,5 @@
-from .base_trainer import BaseTrainer
-from .base_dataloader import BaseDataLoader
\ No newline at end of file
+# BaseDataLoader first, base_trainer imports data_loaders which imports it from base
+from .base_dataloader import BaseDataLoader
+from .base_trainer import BaseTrainer, forward_discriminator
+from .checkpoint import CheckpointManager
+from .ema import ModelEMA
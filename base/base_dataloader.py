@@ -1,7 +1,42 @@
 import numpy as np
+import torch
 from torch.utils.data import DataLoader
 from torch.utils.data.dataloader import default_collate
-from torch.utils.data.sampler import SubsetRandomSampler
+from torch.utils.data.sampler import Sampler, SubsetRandomSampler
+
+
+class ResumableRandomSampler(Sampler):
+    """
+    Random permutation of indices every epoch, whose permutation and position can be saved and restored so a
+    resumed epoch continues with the next batch
+    """
+    def __init__(self, indices):
+        self.indices = np.asarray(indices)
+        self.perm = None
+        self.start = 0
+        self._resume = None
+
+    def __iter__(self):
+        if self._resume is not None:
+            self.perm, self.start = self._resume
+            self._resume = None
+        else:
+            # torch's generator as SubsetRandomSampler, np.random is reseeded whenever a loader splits its data
+            self.perm, self.start = self.indices[torch.randperm(len(self.indices)).numpy()], 0
+        return iter(self.perm[self.start:].tolist())
+
+    def __len__(self):
+        return len(self.indices)
+
+    def state_dict(self, position):
+        """
+        :param position: number of indices of the current epoch already used, counted from its first batch
+        """
+        return {'perm': self.perm, 'cursor': position}
+
+    def load_state_dict(self, state):
+        """ the next epoch continues the saved one """
+        self._resume = (np.asarray(state['perm']), state['cursor'])
 
 
 class BaseDataLoader(DataLoader):
@@ -29,7 +64,10 @@ class BaseDataLoader(DataLoader):
 
     def _split_sampler(self, split):
         if split == 0.0:
-            return None, None
+            if not self.shuffle:
+                return None, None
+            self.shuffle = False
+            return ResumableRandomSampler(np.arange(self.n_samples)), None
 
         idx_full = np.arange(self.n_samples)
 
@@ -46,7 +84,7 @@ class BaseDataLoader(DataLoader):
         valid_idx = idx_full[0:len_valid]
         train_idx = np.delete(idx_full, np.arange(0, len_valid))
 
-        train_sampler = SubsetRandomSampler(train_idx)
+        train_sampler = ResumableRandomSampler(train_idx)
         valid_sampler = SubsetRandomSampler(valid_idx)
 
         # turn off shuffle option which is mutually exclusive with sampler
@@ -55,8 +93,33 @@ class BaseDataLoader(DataLoader):
 
         return train_sampler, valid_sampler
 
-    def split_validation(self):
+    def split_validation(self, dataset=None):
+        """
+        :param dataset: dataset for the validation indices instead of the training one, e.g. with test transforms
+        """
         if self.valid_sampler is None:
             return None
-        else:
-            return DataLoader(sampler=self.valid_sampler, **self.init_kwargs)
\ No newline at end of file
+        kwargs = dict(self.init_kwargs)
+        if dataset is not None:
+            kwargs['dataset'] = dataset
+        return DataLoader(sampler=self.valid_sampler, **kwargs)
+
+    def state_dict(self, num_batches=None):
+        """
+        Position of the loader and order of the dataset lists
+
+        :param num_batches: batches of the current epoch already trained on, including those before a resume,
+                            None at the end of an epoch
+        """
+        state = {'sampler': None}
+        if num_batches is not None and isinstance(self.sampler, ResumableRandomSampler) and self.sampler.perm is not None:
+            state['sampler'] = self.sampler.state_dict(num_batches * self.batch_size)
+        if hasattr(self.dataset, 'state_dict'):
+            state['dataset'] = self.dataset.state_dict()
+        return state
+
+    def load_state_dict(self, state):
+        if state.get('sampler') is not None:
+            self.sampler.load_state_dict(state['sampler'])
+        if 'dataset' in state and hasattr(self.dataset, 'load_state_dict'):
+            self.dataset.load_state_dict(state['dataset'])
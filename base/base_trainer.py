@@ -1,9 +1,37 @@
+import time
 import torch
 import numpy as np
 import logging
 from abc import abstractmethod
 from numpy import inf
-from utils import TensorboardWriter
+from utils import TensorboardWriter, ThroughputMeter, StepProfiler
+from data_loaders.diff_aug import DiffAugment, AdaptiveDiffAugment
+from data_loaders.synthetic import SyntheticDataLoader
+from .checkpoint import CheckpointManager, get_rng_state, set_rng_state
+from .ema import ModelEMA
+from losses import gan_loss
+
+
+def forward_discriminator(disc, imgs, augment=None, labels=None):
+    """
+    Run a discriminator once on several batches concatenated along the batch dimension,
+    InstanceNorm keeps statistics per sample so the logits match separate calls
+
+    :param disc: discriminator
+    :param imgs: list of image batches, e.g. [real, fake, edge]
+    :param augment: optional callable applied once to the concatenated batch
+    :param labels: optional list of domain labels of every batch, for StarDiscriminator
+    :return: list of logits of every batch
+    """
+    sizes = [x.size(0) for x in imgs]
+    x = torch.cat(imgs, dim=0)
+    if augment is not None:
+        x = augment(x)
+    if labels is None:
+        logits = disc(x)
+    else:
+        logits = disc(x, torch.cat(labels, dim=0))
+    return list(torch.split(logits, sizes, dim=0))
 
 
 class BaseTrainer:
@@ -16,6 +44,9 @@ class BaseTrainer:
         self.epochs = config.epochs
         self.save_period = config.save_period
         self.start_epoch = 1
+        # batches of start_epoch already trained on when resuming from a mid-epoch checkpoint
+        self.start_step = 0
+        self.epoch = self.start_epoch
         self.config.train = True
 
         # setup GPU device if available, move model into configured device
@@ -23,7 +54,44 @@ class BaseTrainer:
 
         # setup visualization writer instance
         self.logger.info("Creating tensorboard writer...")
-        self.writer = TensorboardWriter(config.summary_dir, self.logger, config.tensorboard)
+        self.writer = TensorboardWriter(config.summary_dir, self.logger, config.tensorboard,
+                                        scalar_every=config.tb_scalar_every)
+        self.checkpointer = CheckpointManager(config.checkpoint_dir, self.logger,
+                                              keep=config.keep_checkpoints)
+        self.ckpt_every_steps = config.ckpt_every_steps
+        self.ckpt_every_secs = 60 * config.ckpt_every_mins
+        self._last_ckpt_time = time.time()
+        self.throughput = ThroughputMeter()
+        self.epoch_throughput = {}
+
+        # opt-in timing of the named regions of the training step
+        profile_steps = config.profile_steps
+        profile_steps = tuple(int(step) for step in profile_steps.split(',')) if profile_steps else None
+        self.profiler = StepProfiler(config.profile or profile_steps is not None, self.device,
+                                     self.logger, self.writer, profile_steps, config.log_dir)
+
+        # adaptive augmentation probability, plain DiffAugment when disabled
+        self.ada = None
+        if config.ada_target > 0:
+            threshold = getattr(gan_loss, '{}Loss'.format(config.adv_criterion)).real_threshold
+            self.ada = AdaptiveDiffAugment(config.data_aug_policy, target=config.ada_target,
+                                           interval=config.ada_interval, speed_kimg=config.ada_kimg,
+                                           threshold=threshold, device=self.device)
+
+        # moving average of the generator weights, built by the trainers with _build_ema
+        self.ema = None
+
+    def _build_ema(self, models):
+        """
+        Keep an exponential moving average of the given models with --ema-decay, updated every --ema-every steps
+        and checkpointed under 'ema'. Call once the models are on their device and before resuming
+        :param models: dict of name to model, named as the modules of the inference generator, e.g. {'gen': gen}
+        """
+        decay = self.config.ema_decay
+        if decay <= 0:
+            return
+        self.ema = ModelEMA({name: self._module(model) for name, model in models.items()},
+                            decay=decay, every=self.config.ema_every)
 
     def _build_model(self):
         """ build model """
@@ -37,6 +105,22 @@ class BaseTrainer:
         """ build train and validation data loader """
         raise NotImplementedError
 
+    def _build_synthetic_dataloader(self, kind, deterministic=False):
+        """
+        Train and validation loaders of --data-source synthetic
+        :param kind: structure of the batches, see SyntheticDataset
+        :param deterministic: as split_validation of the disk loaders
+        """
+        train_dataloader = SyntheticDataLoader(
+            kind=kind,
+            image_size=self.config.image_size,
+            batch_size=self.config.batch_size,
+            num_workers=self.config.num_workers,
+            num_images=self.config.synthetic_size,
+            mode=self.config.synthetic_mode)
+        valid_dataloader = train_dataloader.split_validation(deterministic=deterministic)
+        return train_dataloader, valid_dataloader
+
     @abstractmethod
     def _build_criterion(self):
         """ build loss functions """
@@ -59,20 +143,40 @@ class BaseTrainer:
         """
         Full training logic
         """
-        for epoch in range(self.start_epoch, self.epochs + 1):
-            result = self._train_epoch(epoch)
+        self._last_ckpt_time = time.time()
+        completed = False
+        try:
+            for epoch in range(self.start_epoch, self.epochs + 1):
+                self.epoch = epoch
+                result = self._train_epoch(epoch)
 
-            # save logged informations into log dict
-            log = {'epoch': epoch}
-            log.update(result)
+                # save logged informations into log dict
+                log = {'epoch': epoch}
+                log.update(result)
+                log.update(self.epoch_throughput)
+                if self.ada is not None:
+                    log['ada_p'] = self.ada.p.item()
 
-            # print logged informations to the screen
-            for key, value in log.items():
-                self.logger.info('    {:15s}: {}'.format(str(key), value))
+                # print logged informations to the screen
+                for key, value in log.items():
+                    self.logger.info('    {:15s}: {}'.format(str(key), value))
 
-            # save checkpoint
-            if epoch % self.save_period == 0:
-                self._save_checkpoint(epoch)
+                # save checkpoint
+                if epoch % self.save_period == 0:
+                    self._save_checkpoint(epoch)
+            completed = True
+        finally:
+            # queued checkpoints and tensorboard events are written also when training fails, e.g. the mid-epoch
+            # checkpoint to recover from
+            try:
+                self.checkpointer.close()
+            except Exception as e:
+                if completed:
+                    raise
+                # keep the exception of the training
+                self.logger.error("Writing the last checkpoint failed: {}".format(e))
+            finally:
+                self.writer.close()
 
     def _prepare_device(self, n_gpu_use):
         """
@@ -92,53 +196,95 @@ class BaseTrainer:
         list_ids = list(range(n_gpu_use))
         return device, list_ids
 
-    def _save_checkpoint(self, epoch):
+    def _checkpoint_state(self, epoch):
+        """ state dicts of the models and optimizers to checkpoint """
+        raise NotImplementedError
+
+    def _load_checkpoint_state(self, checkpoint):
+        """ load the state dicts of _checkpoint_state into the models and optimizers """
+        raise NotImplementedError
+
+    def _load_optimizer_state(self, optim, state, name):
         """
-        Saving checkpoints
+        Load an optimizer state, skipped with a warning when its parameter groups do not match the current models,
+        e.g. checkpoints of older architectures whose weights were converted on load
+        """
+        sizes = [len(group['params']) for group in optim.param_groups]
+        saved_sizes = [len(group['params']) for group in state['param_groups']]
+        if sizes != saved_sizes:
+            self.logger.warning("Optimizer {} of the checkpoint has parameter groups of sizes {} instead of {}, "
+                                "its state is not loaded".format(name, saved_sizes, sizes))
+            return
+        optim.load_state_dict(state)
+
+    @staticmethod
+    def _module(model):
+        """ model without its DataParallel wrapper """
+        return model.module if isinstance(model, torch.nn.DataParallel) else model
+
+    def _save_checkpoint(self, epoch, step=0):
+        """
+        Saving checkpoints, written in the background by the checkpoint manager. Besides the models and optimizers
+        they hold the random generator states and the order and position of the train loader, so training resumes
+        with the next batch
 
         :param epoch: current epoch number
-        :param log: logging information of the epoch
-        :param save_best: if True, rename the saved checkpoint to 'model_best.pth'
-        """
-        model = type(self.model).__name__
-        model = model[:-9]
-        state = {
-            "model": model,
-            'epoch': epoch,
-            'state_dict': self.model.state_dict() if len(self.device_ids) <= 1 else self.model.module.state_dict(),
-            'optimizer': self.optimizer.state_dict(),
-        }
-        filename = str(self.config.checkpoint_dir + 'current.pth')
-        torch.save(state, filename)
-        self.logger.info("Saving checkpoint: {} ...".format(filename))
-
-        if epoch % self.save_period == 0:
-            filename = str(self.config.checkpoint_dir + 'epoch{}.pth'.format(epoch))
-            torch.save(state, filename)
-            self.logger.info("Saving checkpoint: {} ...".format(filename))
+        :param step: batches of the epoch trained on for a mid-epoch checkpoint, 0 once the epoch is done
+        """
+        state = self._checkpoint_state(epoch)
+        state['step'] = step
+        state['rng'] = get_rng_state()
+        state['loader'] = self.train_dataloader.state_dict(step if step > 0 else None)
+        if self.ada is not None:
+            state['ada'] = self.ada.state_dict()
+        if self.ema is not None:
+            state['ema'] = self.ema.state_dict()
+        links = ['epoch{}.pth'.format(epoch)] if step == 0 and epoch % self.save_period == 0 else []
+        self.checkpointer.save(state, 'current.pth', links)
+        self._last_ckpt_time = time.time()
 
+    def _step_checkpoint_due(self, step):
+        """
+        :param step: batches of the current epoch trained on
+        """
+        if step >= len(self.train_dataloader):
+            # the epoch checkpoint follows
+            return False
+        if self.ckpt_every_steps > 0 and step % self.ckpt_every_steps == 0:
+            return True
+        return self.ckpt_every_secs > 0 and time.time() - self._last_ckpt_time >= self.ckpt_every_secs
 
     def _resume_checkpoint(self, resume_path):
         """
-        Resume from saved checkpoints
+        Resume from saved checkpoints, mid-epoch checkpoints continue with the next batch of their epoch. Call
+        once the models and optimizers are built
 
         :param resume_path: Checkpoint path to be resumed
         """
         resume_path = str(resume_path)
         self.logger.info("Loading checkpoint: {} ...".format(resume_path))
-        checkpoint = torch.load(resume_path)
-        self.start_epoch = checkpoint['epoch'] + 1
+        checkpoint = torch.load(resume_path, map_location='cpu')
+        self._load_checkpoint_state(checkpoint)
 
-        # load architecture params from checkpoint.
-        if checkpoint['model'] != self.config.model:
-            self.logger.warning("Warning: Architecture configuration given in config file is different from that of "
-                                "checkpoint. This may yield an exception while state_dict is being loaded.")
-        self.model.load_state_dict(checkpoint['state_dict'])
+        step = checkpoint.get('step', 0)
+        self.start_epoch = checkpoint['epoch'] if step > 0 else checkpoint['epoch'] + 1
+        self.start_step = step
+        # --profile-steps counts global steps
+        self.profiler.num_steps = (self.start_epoch - 1) * len(self.train_dataloader) + step
+        if 'loader' in checkpoint:
+            self.train_dataloader.load_state_dict(checkpoint['loader'])
+        if 'rng' in checkpoint:
+            set_rng_state(checkpoint['rng'])
+        if self.ada is not None and 'ada' in checkpoint:
+            self.ada.load_state_dict(checkpoint['ada'])
+        if self.ema is not None:
+            if 'ema' in checkpoint:
+                self.ema.load_state_dict(checkpoint['ema'])
+            else:
+                self.logger.warning("Checkpoint has no EMA weights, averaging starts from the loaded models")
+                self.ema.reset()
 
-        # load optimizer state from checkpoint only when optimizer type is not changed.
-        self.optimizer.load_state_dict(checkpoint['optimizer'])
-
-        self.logger.info("Checkpoint loaded. Resume training from epoch {}".format(self.start_epoch))
+        self.logger.info("Checkpoint loaded. Resume training from epoch {} step {}".format(self.start_epoch, self.start_step))
 
     def _progress(self, batch_idx):
         base = '[{}/{} ({:.0f}%)]'
@@ -146,6 +292,84 @@ class BaseTrainer:
         total = self.train_dataloader.n_samples
         return base.format(current, total, 100.0 * current / total)
 
+    def _timed_loader(self, loader):
+        """
+        Iterate the train loader as (batch_idx, batch) while measuring the time spent waiting for batches,
+        throughput is written to tensorboard every log_step steps and kept for the epoch log. Steps of the
+        profiler end here and its region summary is logged at the end of the epoch, the EMA weights are updated and
+        mid-epoch checkpoints are written between steps. After a mid-epoch resume batch_idx starts at the resumed step
+        """
+        self.throughput.reset()
+        log_step = getattr(self, 'log_step', 1)
+        if self.start_step > 0:
+            # the iterator draws its base seed from torch's generator, which the checkpoint restored at a point
+            # within the epoch, so keep the stream of an uninterrupted run
+            rng_state = torch.get_rng_state()
+            batches = iter(loader)
+            torch.set_rng_state(rng_state)
+        else:
+            batches = iter(loader)
+        batch_idx, self.start_step = self.start_step, 0
+        while True:
+            start = time.perf_counter()
+            try:
+                with self.profiler.region('data', host=True):
+                    batch = next(batches)
+            except StopIteration:
+                break
+            self.throughput.update(time.perf_counter() - start, batch[0].size(0))
+            yield batch_idx, batch
+            if self.ema is not None:
+                with self.profiler.region('ema'):
+                    self.ema.update()
+            self.profiler.step()
+            if batch_idx % log_step == 0:
+                for key, value in self.throughput.window().items():
+                    self.writer.add_scalar(key, value)
+            batch_idx += 1
+            if self._step_checkpoint_due(batch_idx):
+                self._save_checkpoint(self.epoch, step=batch_idx)
+        self.epoch_throughput = self.throughput.result()
+        self.profiler.summary('of {} steps'.format(batch_idx))
+
+    def augment(self, x):
+        """ differentiable augmentation of discriminator inputs with the configured policy """
+        if self.ada is not None:
+            return self.ada(x)
+        return DiffAugment(x, policy=self.config.data_aug_policy)
+
+    def ada_step(self, real_logits, batch_size):
+        """
+        Feed the discriminator outputs on real images of a D step to the adaptive augmentation, no-op when disabled
+        :param real_logits: list of logits on real images, one per discriminator
+        :param batch_size: number of real images of the step
+        """
+        if self.ada is None:
+            return
+        for logits in real_logits:
+            self.ada.accumulate(logits)
+        self.ada.step(batch_size)
+
+    def forward_disc(self, disc, imgs, labels=None, augment=True):
+        """
+        Discriminator logits of several batches in one forward, see forward_discriminator
+        :param augment: apply self.augment to the inputs
+        """
+        return forward_discriminator(disc, imgs, self.augment if augment else None, labels)
+
+    def _set_grad_checkpointing(self, gens, discs):
+        """
+        Enable the activation checkpointing configured by --grad-ckpt and --disc-grad-ckpt
+        :param gens: generators, checkpointed at the given stages of down, res and up
+        :param discs: discriminators, checkpointed at their down stage
+        """
+        stages = [stage for stage in self.config.grad_ckpt.split(',') if stage]
+        for gen in gens:
+            gen.set_grad_checkpointing(stages)
+        if self.config.disc_grad_ckpt:
+            for disc in discs:
+                disc.set_grad_checkpointing(['down'])
+
     def set_requires_grad(self, models, requires_grad=False):
         """Set requies_grad=Fasle for all the networks to avoid unnecessary computations
         Parameters:
@@ -0,0 +1,170 @@
+import os
+import re
+import queue
+import random
+import shutil
+import threading
+import numpy as np
+import torch
+
+
+def snapshot(obj):
+    """
+    Copy of a (nested) state with every tensor cloned to cpu, so training can go on while it is written
+    """
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((key, snapshot(value)) for key, value in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot(value) for value in obj)
+    return obj
+
+
+def get_rng_state():
+    """ states of the python, numpy, torch and cuda random generators """
+    return {
+        'python': random.getstate(),
+        'numpy': np.random.get_state(),
+        'torch': torch.get_rng_state(),
+        'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else [],
+    }
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if state['cuda'] and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'][:torch.cuda.device_count()])
+
+
+class CheckpointManager:
+    """
+    Writes checkpoints from a background thread. The state is copied to cpu on the calling thread, written to a
+    temporary file and renamed over the target, so an interrupted write never leaves a corrupt checkpoint. Extra
+    names of the same checkpoint (e.g. epoch10.pth next to current.pth) are hard links, or copies where links are
+    not supported, and only the newest keep of them are kept
+    """
+    def __init__(self, checkpoint_dir, logger, keep=0, async_write=True):
+        """
+        :param checkpoint_dir: directory of the checkpoints
+        :param keep: number of periodic checkpoints to keep, 0 keeps all
+        :param async_write: write in a background thread, otherwise save blocks until written
+        """
+        self.checkpoint_dir = str(checkpoint_dir)
+        self.logger = logger
+        self.keep = keep
+        self.async_write = async_write
+        self._error = None
+        self._queue = None
+        self._remove_stale_tmp()
+        if async_write:
+            # at most one snapshot waits while another one is written
+            self._queue = queue.Queue(maxsize=1)
+            self._thread = threading.Thread(target=self._worker, name='checkpoint-writer', daemon=True)
+            self._thread.start()
+
+    def save(self, state, filename, links=()):
+        """
+        :param state: checkpoint dict, tensors may live on any device
+        :param filename: name of the checkpoint in checkpoint_dir, e.g. 'current.pth'
+        :param links: further names of the same checkpoint, e.g. ['epoch10.pth']
+        """
+        self._raise_error()
+        job = (snapshot(state), filename, list(links))
+        if self.async_write:
+            self._queue.put(job)
+        else:
+            self._write(*job)
+
+    def wait(self):
+        """ block until every queued checkpoint is written """
+        if self.async_write:
+            self._queue.join()
+        self._raise_error()
+
+    def close(self):
+        if self.async_write and self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+        self._raise_error()
+
+    def _remove_stale_tmp(self):
+        """ remove temporary files left by writes that were interrupted, e.g. by preemption """
+        if not os.path.isdir(self.checkpoint_dir):
+            return
+        for name in os.listdir(self.checkpoint_dir):
+            if name.endswith('.pth.tmp'):
+                os.remove(os.path.join(self.checkpoint_dir, name))
+                self.logger.info("Removing incomplete checkpoint: {} ...".format(name))
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise RuntimeError('Writing a checkpoint failed') from error
+
+    def _worker(self):
+        while True:
+            job = self._queue.get()
+            try:
+                if job is None:
+                    return
+                self._write(*job)
+            except Exception as e:
+                self.logger.error("Writing checkpoint {} failed: {}".format(job[1], e))
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def _fsync_dir(self):
+        # make the renames durable, not supported on every platform
+        try:
+            fd = os.open(self.checkpoint_dir, os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            os.fsync(fd)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+
+    def _write(self, state, filename, links):
+        path = os.path.join(self.checkpoint_dir, filename)
+        tmp_path = path + '.tmp'
+        # a stale temporary file of an earlier failed write is overwritten
+        with open(tmp_path, 'wb') as f:
+            torch.save(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        self._fsync_dir()
+        self.logger.info("Saving checkpoint: {} ...".format(path))
+        for link in links:
+            link_path = os.path.join(self.checkpoint_dir, link)
+            tmp_path = link_path + '.tmp'
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            try:
+                os.link(path, tmp_path)
+            except OSError:
+                shutil.copyfile(path, tmp_path)
+                with open(tmp_path, 'rb+') as f:
+                    os.fsync(f.fileno())
+            os.replace(tmp_path, link_path)
+            self.logger.info("Saving checkpoint: {} ...".format(link_path))
+        if links:
+            self._fsync_dir()
+        self._rotate()
+
+    def _rotate(self):
+        if self.keep <= 0:
+            return
+        pattern = re.compile(r'^epoch(\d+)\.pth$')
+        periodic = [(int(m.group(1)), name) for name in os.listdir(self.checkpoint_dir)
+                    for m in [pattern.match(name)] if m is not None]
+        for _, name in sorted(periodic)[:-self.keep]:
+            os.remove(os.path.join(self.checkpoint_dir, name))
+            self.logger.info("Removing checkpoint: {} ...".format(name))
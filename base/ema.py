@@ -0,0 +1,72 @@
+import copy
+import torch
+
+
+class ModelEMA:
+    """
+    Exponential moving average of the weights of one or more models, e.g. a generator and its mapping network.
+    The shadow copies are updated every `every` steps with one multi-tensor lerp over all parameters, the decay is
+    raised to the power of `every` so the averaging horizon in steps does not depend on it. Buffers are copied
+    """
+    def __init__(self, models, decay=0.999, every=1):
+        """
+        :param models: dict of name to model (without DataParallel), names are those of the inference modules,
+            e.g. {'gen': gen, 'map_net': map_net}
+        :param decay: per step decay of the average
+        :param every: steps between updates
+        """
+        self.models = models
+        self.decay = decay
+        self.every = max(1, every)
+        self.num_steps = 0
+        self.shadow = {}
+        for name, model in models.items():
+            shadow = copy.deepcopy(model).eval()
+            for param in shadow.parameters():
+                param.requires_grad_(False)
+            self.shadow[name] = shadow
+        self._refresh()
+
+    def _refresh(self):
+        # flat lists of matching tensors, parameters are updated in place so these stay valid
+        self._params, self._shadow_params, self._buffers, self._shadow_buffers = [], [], [], []
+        for name, model in self.models.items():
+            self._params += list(model.parameters())
+            self._shadow_params += list(self.shadow[name].parameters())
+            self._buffers += list(model.buffers())
+            self._shadow_buffers += list(self.shadow[name].buffers())
+
+    @torch.no_grad()
+    def reset(self):
+        """ restart the averages from the current weights of the models, e.g. after loading them """
+        for shadow, param in zip(self._shadow_params + self._shadow_buffers, self._params + self._buffers):
+            shadow.copy_(param)
+
+    @torch.no_grad()
+    def update(self):
+        """ count a training step, update the averages every `every` steps """
+        self.num_steps += 1
+        if self.num_steps % self.every != 0:
+            return
+        weight = 1 - self.decay ** self.every
+        params = [param.detach() for param in self._params]
+        if hasattr(torch, '_foreach_lerp_'):
+            torch._foreach_lerp_(self._shadow_params, params, weight)
+        elif hasattr(torch, '_foreach_mul_'):
+            torch._foreach_mul_(self._shadow_params, 1 - weight)
+            torch._foreach_add_(self._shadow_params, params, alpha=weight)
+        else:
+            for shadow, param in zip(self._shadow_params, params):
+                shadow.lerp_(param, weight)
+        for shadow, buffer in zip(self._shadow_buffers, self._buffers):
+            shadow.copy_(buffer)
+
+    def state_dict(self):
+        state = {name: shadow.state_dict() for name, shadow in self.shadow.items()}
+        state['num_steps'] = self.num_steps
+        return state
+
+    def load_state_dict(self, state):
+        self.num_steps = state.get('num_steps', 0)
+        for name, shadow in self.shadow.items():
+            shadow.load_state_dict(state[name])
@@ -0,0 +1,72 @@
+"""
+Memory/throughput tradeoff of activation checkpointing on Generator and Discriminator
+
+Runs a generator step (generator forward, discriminator forward, backward) for every checkpointing config and
+reports peak cuda memory and images per second, e.g.
+python -m benchmarks.checkpointing --image-size 256 --num-res 8 --batch-size 8
+"""
+import argparse
+import json
+import torch
+from models import Generator, Discriminator
+from benchmarks.timing import time_fn
+
+CONFIGS = [
+    ('none', [], False),
+    ('res', ['res'], False),
+    ('res,up', ['res', 'up'], False),
+    ('down,res,up', ['down', 'res', 'up'], False),
+    ('down,res,up+disc', ['down', 'res', 'up'], True),
+]
+
+
+def get_config(manual=None):
+    parser = argparse.ArgumentParser('Activation checkpointing benchmark')
+    parser.add_argument('--image-size', default=256, type=int, help='image size')
+    parser.add_argument('--down-size', default=64, type=int, help='downsample size')
+    parser.add_argument('--num-res', default=8, type=int, help='number of residual blocks')
+    parser.add_argument('--batch-size', default=8, type=int, help='batch size')
+    parser.add_argument('--iters', default=10, type=int, help='timed iterations')
+    parser.add_argument('--output', default=None, help='write results as json')
+    return parser.parse_args(manual)
+
+
+def main():
+    args = get_config()
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    gen = Generator(args.image_size, args.down_size, args.num_res).to(device)
+    disc = Discriminator(args.image_size, args.down_size).to(device)
+    x = torch.rand((args.batch_size, 3, args.image_size, args.image_size), device=device) * 2 - 1
+
+    def step():
+        gen.zero_grad()
+        disc.zero_grad()
+        loss = disc(gen(x)).mean()
+        loss.backward()
+
+    results = []
+    for name, stages, disc_ckpt in CONFIGS:
+        gen.set_grad_checkpointing(stages)
+        disc.set_grad_checkpointing(['down'] if disc_ckpt else [])
+        if device.type == 'cuda':
+            torch.cuda.empty_cache()
+            torch.cuda.reset_peak_memory_stats(device)
+        timing = time_fn(step, device, args.iters, warmup=2)
+        result = {
+            'config': name,
+            'step_ms': timing['latency_ms'],
+            'images_per_sec': args.batch_size * 1000 / timing['latency_ms'],
+            'peak_memory_mb': torch.cuda.max_memory_allocated(device) / 2 ** 20 if device.type == 'cuda' else None,
+        }
+        results.append(result)
+        print('{:18s} | {:9.2f} ms/step | {:8.2f} img/s | peak memory {}'.format(
+            name, result['step_ms'], result['images_per_sec'],
+            '{:.0f} MB'.format(result['peak_memory_mb']) if result['peak_memory_mb'] is not None else 'n/a (cpu)'))
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump({'device': str(device), 'config': vars(args), 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+"""
+DiffAugment translation and cutout against the meshgrid reference implementations
+
+Checks that both produce the same outputs under a fixed seed and times forward and backward, e.g.
+python -m benchmarks.diff_aug --batch-size 16 --image-size 256
+"""
+import argparse
+import json
+import torch
+import torch.nn.functional as F
+from data_loaders.diff_aug import DiffAugment, rand_translation, rand_cutout
+from benchmarks.timing import time_fn
+
+
+def get_config(manual=None):
+    parser = argparse.ArgumentParser('DiffAugment benchmark')
+    parser.add_argument('--batch-size', default=16, type=int, help='batch size')
+    parser.add_argument('--image-size', default=256, type=int, help='image size')
+    parser.add_argument('--iters', default=50, type=int, help='timed iterations')
+    parser.add_argument('--output', default=None, help='write results as json')
+    return parser.parse_args(manual)
+
+
+def reference_translation(x, ratio=0.125):
+    shift_x, shift_y = int(x.size(2) * ratio + 0.5), int(x.size(3) * ratio + 0.5)
+    translation_x = torch.randint(-shift_x, shift_x + 1, size=[x.size(0), 1, 1], device=x.device)
+    translation_y = torch.randint(-shift_y, shift_y + 1, size=[x.size(0), 1, 1], device=x.device)
+    grid_batch, grid_x, grid_y = torch.meshgrid(
+        torch.arange(x.size(0), dtype=torch.long, device=x.device),
+        torch.arange(x.size(2), dtype=torch.long, device=x.device),
+        torch.arange(x.size(3), dtype=torch.long, device=x.device),
+    )
+    grid_x = torch.clamp(grid_x + translation_x + 1, 0, x.size(2) + 1)
+    grid_y = torch.clamp(grid_y + translation_y + 1, 0, x.size(3) + 1)
+    x_pad = F.pad(x, [1, 1, 1, 1, 0, 0, 0, 0])
+    x = x_pad.permute(0, 2, 3, 1).contiguous()[grid_batch, grid_x, grid_y].permute(0, 3, 1, 2)
+    return x
+
+
+def reference_cutout(x, ratio=0.5):
+    cutout_size = int(x.size(2) * ratio + 0.5), int(x.size(3) * ratio + 0.5)
+    offset_x = torch.randint(0, x.size(2) + (1 - cutout_size[0] % 2), size=[x.size(0), 1, 1], device=x.device)
+    offset_y = torch.randint(0, x.size(3) + (1 - cutout_size[1] % 2), size=[x.size(0), 1, 1], device=x.device)
+    grid_batch, grid_x, grid_y = torch.meshgrid(
+        torch.arange(x.size(0), dtype=torch.long, device=x.device),
+        torch.arange(cutout_size[0], dtype=torch.long, device=x.device),
+        torch.arange(cutout_size[1], dtype=torch.long, device=x.device),
+    )
+    grid_x = torch.clamp(grid_x + offset_x - cutout_size[0] // 2, min=0, max=x.size(2) - 1)
+    grid_y = torch.clamp(grid_y + offset_y - cutout_size[1] // 2, min=0, max=x.size(3) - 1)
+    mask = torch.ones(x.size(0), x.size(2), x.size(3), dtype=x.dtype, device=x.device)
+    mask[grid_batch, grid_x, grid_y] = 0
+    x = x * mask.unsqueeze(1)
+    return x
+
+
+def check_same(fn, reference, x, seed=0):
+    torch.manual_seed(seed)
+    out = fn(x)
+    torch.manual_seed(seed)
+    out_ref = reference(x)
+    return bool(torch.equal(out, out_ref))
+
+
+def run(fn, x):
+    def step():
+        x.grad = None
+        fn(x).sum().backward()
+    return step
+
+
+def main():
+    args = get_config()
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    x = (torch.rand((args.batch_size, 3, args.image_size, args.image_size), device=device) * 2 - 1).requires_grad_()
+
+    results = []
+    for name, fn, reference in [('translation', rand_translation, reference_translation),
+                                ('cutout', rand_cutout, reference_cutout)]:
+        same = check_same(fn, reference, x.detach())
+        ref_timing = time_fn(run(reference, x), device, args.iters)
+        new_timing = time_fn(run(fn, x), device, args.iters)
+        result = {
+            'op': name,
+            'same_output': same,
+            'reference_ms': ref_timing['latency_ms'],
+            'vectorized_ms': new_timing['latency_ms'],
+        }
+        results.append(result)
+        print('{op:12s} | same output {same_output} | {reference_ms:8.3f} -> {vectorized_ms:8.3f} ms (fwd+bwd)'.format(**result))
+
+    policy = 'color,translation,cutout'
+    full = time_fn(run(lambda t: DiffAugment(t, policy=policy), x), device, args.iters)
+    print('DiffAugment {} | {:8.3f} ms (fwd+bwd)'.format(policy, full['latency_ms']))
+    results.append({'op': policy, 'vectorized_ms': full['latency_ms']})
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump({'device': str(device), 'config': vars(args), 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+"""
+Scaling of the per-domain heads of MappingNetwork, StyleEncoder and StarDiscriminator with the number of domains
+
+Compares the per-sample gathered heads against evaluating every domain head and indexing the result,
+e.g. python -m benchmarks.domain_heads --num-domains 2 4 8 16 32 64
+"""
+import argparse
+import json
+import torch
+import torch.nn.functional as F
+from models.utils import DomainLinear
+from benchmarks.timing import time_fn
+
+
+def get_config(manual=None):
+    parser = argparse.ArgumentParser('Domain head benchmark')
+    parser.add_argument('--num-domains', default=[2, 4, 8, 16, 32, 64], type=int, nargs='+', help='domain counts')
+    parser.add_argument('--batch-size', default=16, type=int, help='batch size')
+    parser.add_argument('--feat-size', default=16, type=int, help='spatial size of the discriminator features')
+    parser.add_argument('--iters', default=50, type=int, help='timed iterations')
+    parser.add_argument('--backward', action='store_true', help='time forward and backward')
+    parser.add_argument('--output', default=None, help='write results as json')
+    return parser.parse_args(manual)
+
+
+def all_heads_mlp(layers, h, y):
+    """
+    reference: evaluate every domain head on the whole batch and index one row per sample
+    """
+    out = []
+    for d in range(layers[0].num_domains):
+        s = h
+        for i, layer in enumerate(layers):
+            s = F.linear(s, layer.weight[d], layer.bias[d])
+            if i < len(layers) - 1:
+                s = F.relu(s)
+        out += [s]
+    out = torch.stack(out, dim=1)
+    idx = torch.arange(y.size(0), device=y.device)
+    return out[idx, y]
+
+
+def gathered_mlp(layers, h, y):
+    s = h
+    for i, layer in enumerate(layers):
+        s = layer(s, y)
+        if i < len(layers) - 1:
+            s = F.relu(s)
+    return s
+
+
+def all_heads_conv(conv, feat, y):
+    out = conv(feat)
+    idx = torch.arange(y.size(0), device=y.device)
+    return out[idx, y].unsqueeze(1)
+
+
+def gathered_conv(conv, feat, y):
+    batch_size, _, h, w = feat.shape
+    weight = conv.weight[y].view(batch_size, 1, -1)
+    bias = conv.bias[y].view(batch_size, 1, 1)
+    return torch.baddbmm(bias, weight, feat.flatten(2)).view(batch_size, 1, h, w)
+
+
+def run(fn, backward):
+    def step():
+        out = fn()
+        if backward:
+            out.sum().backward()
+    return step
+
+
+def main():
+    args = get_config()
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+    results = []
+    for num_domains in args.num_domains:
+        y = torch.randint(num_domains, (args.batch_size,), device=device)
+
+        # MappingNetwork heads, 256 -> 256 -> 128 -> 64
+        layers = [DomainLinear(256, 256, num_domains), DomainLinear(256, 128, num_domains),
+                  DomainLinear(128, 64, num_domains)]
+        layers = [layer.to(device) for layer in layers]
+        h = torch.randn((args.batch_size, 256), device=device)
+        assert torch.allclose(gathered_mlp(layers, h, y), all_heads_mlp(layers, h, y), atol=1e-4)
+        mlp_ref = time_fn(run(lambda: all_heads_mlp(layers, h, y), args.backward), device, args.iters)
+        mlp_new = time_fn(run(lambda: gathered_mlp(layers, h, y), args.backward), device, args.iters)
+
+        # StarDiscriminator 1x1 output conv on 512 channel features
+        conv = torch.nn.Conv2d(512, num_domains, kernel_size=1).to(device)
+        feat = torch.randn((args.batch_size, 512, args.feat_size, args.feat_size), device=device)
+        assert torch.allclose(gathered_conv(conv, feat, y), all_heads_conv(conv, feat, y), atol=1e-4)
+        conv_ref = time_fn(run(lambda: all_heads_conv(conv, feat, y), args.backward), device, args.iters)
+        conv_new = time_fn(run(lambda: gathered_conv(conv, feat, y), args.backward), device, args.iters)
+
+        result = {
+            'num_domains': num_domains,
+            'mapping_all_heads_ms': mlp_ref['latency_ms'],
+            'mapping_gathered_ms': mlp_new['latency_ms'],
+            'disc_all_heads_ms': conv_ref['latency_ms'],
+            'disc_gathered_ms': conv_new['latency_ms'],
+        }
+        results.append(result)
+        print('domains {num_domains:4d} | mapping {mapping_all_heads_ms:8.3f} -> {mapping_gathered_ms:8.3f} ms'
+              ' | disc head {disc_all_heads_ms:8.3f} -> {disc_gathered_ms:8.3f} ms'.format(**result))
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump({'device': str(device), 'batch_size': args.batch_size, 'backward': args.backward,
+                       'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+"""
+Overhead of the moving average of the generator weights
+
+Times a generator training step (generator forward, discriminator forward, backward, Adam step), one ModelEMA
+update and the same update as a per-tensor lerp loop, and reports the update cost per training step relative to
+the step for every --ema-every, e.g.
+python -m benchmarks.ema --image-size 256 --batch-size 8 --every 1 4 16
+"""
+import argparse
+import json
+import torch
+from models import Generator, Discriminator
+from base.ema import ModelEMA
+from benchmarks.timing import time_fn
+
+
+def get_config(manual=None):
+    parser = argparse.ArgumentParser('EMA benchmark')
+    parser.add_argument('--image-size', default=256, type=int, help='image size')
+    parser.add_argument('--down-size', default=64, type=int, help='downsample size')
+    parser.add_argument('--num-res', default=8, type=int, help='number of residual blocks')
+    parser.add_argument('--batch-size', default=8, type=int, help='batch size')
+    parser.add_argument('--every', nargs='+', default=[1, 4, 16], type=int, help='steps between updates')
+    parser.add_argument('--iters', default=10, type=int, help='timed iterations')
+    parser.add_argument('--cpu', default=False, action='store_true', help='run on cpu even if cuda is available')
+    parser.add_argument('--output', default=None, help='write results as json')
+    return parser.parse_args(manual)
+
+
+def main():
+    args = get_config()
+    device = torch.device('cuda' if torch.cuda.is_available() and not args.cpu else 'cpu')
+    gen = Generator(args.image_size, args.down_size, args.num_res).to(device)
+    disc = Discriminator(args.image_size, args.down_size).to(device)
+    optim = torch.optim.Adam(gen.parameters(), lr=1e-4)
+    x = torch.rand((args.batch_size, 3, args.image_size, args.image_size), device=device) * 2 - 1
+
+    def step():
+        optim.zero_grad()
+        disc(gen(x)).mean().backward()
+        optim.step()
+
+    ema = ModelEMA({'gen': gen}, decay=0.999, every=1)
+
+    def loop_update():
+        with torch.no_grad():
+            for shadow, param in zip(ema._shadow_params, ema._params):
+                shadow.lerp_(param, 1e-3)
+
+    step_ms = time_fn(step, device, args.iters, warmup=2)['latency_ms']
+    update_ms = time_fn(ema.update, device, args.iters, warmup=2)['latency_ms']
+    loop_ms = time_fn(loop_update, device, args.iters, warmup=2)['latency_ms']
+    print('{} | step {:.2f} ms | ema update {:.3f} ms | per-tensor loop {:.3f} ms | {} tensors'.format(
+        device, step_ms, update_ms, loop_ms, len(ema._params)))
+
+    results = []
+    for every in args.every:
+        result = {
+            'every': every,
+            'overhead_pct': 100 * update_ms / every / step_ms,
+            'loop_overhead_pct': 100 * loop_ms / every / step_ms,
+        }
+        results.append(result)
+        print('every {:3d} | overhead {:6.2f}% | per-tensor loop {:6.2f}%'.format(
+            every, result['overhead_pct'], result['loop_overhead_pct']))
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump({'device': str(device), 'torch': torch.__version__, 'config': vars(args), 'step_ms': step_ms,
+                       'update_ms': update_ms, 'loop_update_ms': loop_ms, 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+"""
+Micro-benchmarks of the hot building blocks of the trainers
+
+Times forward (and backward where the op is trained through) of InstanceNorm, guided_filter, superpixel,
+DiffAugment, PatchNCELoss and VGGPerceptualLoss at the given image sizes, e.g.
+python -m benchmarks.micro --image-size 128 256 --batch-size 4 --output micro.json
+"""
+import argparse
+import json
+import torch
+from models.utils import InstanceNorm
+from losses import PatchNCELoss, VGGPerceptualLoss
+from data_loaders import DiffAugment
+from utils import guided_filter, superpixel
+from benchmarks.timing import time_fn
+
+OPS = ['instance_norm', 'guided_filter', 'superpixel', 'diff_augment', 'patch_nce', 'vgg_perceptual']
+
+
+def get_config(manual=None):
+    parser = argparse.ArgumentParser('Micro-benchmarks')
+    parser.add_argument('--ops', nargs='+', default=OPS, choices=OPS, help='ops to benchmark')
+    parser.add_argument('--image-size', nargs='+', default=[128, 256], type=int, help='image sizes')
+    parser.add_argument('--batch-size', default=4, type=int, help='batch size')
+    parser.add_argument('--num-patches', default=256, type=int, help='patches per image of PatchNCELoss')
+    parser.add_argument('--iters', default=10, type=int, help='timed iterations')
+    parser.add_argument('--cpu', default=False, action='store_true', help='run on cpu even if cuda is available')
+    parser.add_argument('--output', default=None, help='write results as json')
+    return parser.parse_args(manual)
+
+
+def build_op(name, batch_size, image_size, args, device):
+    """
+    :return: callable running one forward (and backward) of the op
+    """
+    x = (torch.rand((batch_size, 3, image_size, image_size), device=device) * 2 - 1).requires_grad_()
+    y = torch.rand((batch_size, 3, image_size, image_size), device=device) * 2 - 1
+
+    if name == 'instance_norm':
+        # feature map of the first generator block
+        norm = InstanceNorm(32).to(device)
+        feats = torch.randn((batch_size, 32, image_size, image_size), device=device, requires_grad=True)
+        return lambda: norm(feats).sum().backward()
+    if name == 'guided_filter':
+        return lambda: guided_filter(y, x, r=5, eps=2e-1).sum().backward()
+    if name == 'superpixel':
+        images = y.cpu().numpy().transpose(0, 2, 3, 1)
+        return lambda: superpixel(images)
+    if name == 'diff_augment':
+        return lambda: DiffAugment(x, policy='color,translation,cutout').sum().backward()
+    if name == 'patch_nce':
+        loss = PatchNCELoss(0.07)
+        num = batch_size * args.num_patches
+        feat_q = torch.nn.functional.normalize(torch.randn((num, 256), device=device), dim=1).requires_grad_()
+        feat_k = torch.nn.functional.normalize(torch.randn((num, 256), device=device), dim=1)
+        return lambda: loss(feat_q, feat_k, batch_size).mean().backward()
+    if name == 'vgg_perceptual':
+        # weights do not change the cost, skip the download
+        loss = VGGPerceptualLoss(pretrained=False).to(device)
+        return lambda: loss(x, y).backward()
+    raise NotImplementedError(name)
+
+
+def run(args):
+    device = torch.device('cuda' if torch.cuda.is_available() and not args.cpu else 'cpu')
+    results = []
+    for image_size in args.image_size:
+        for name in args.ops:
+            fn = build_op(name, args.batch_size, image_size, args, device)
+            if device.type == 'cuda':
+                torch.cuda.reset_peak_memory_stats(device)
+            timing = time_fn(fn, device, args.iters, warmup=2)
+            result = {
+                'op': name,
+                'image_size': image_size,
+                'batch_size': args.batch_size,
+                'latency_ms': timing['latency_ms'],
+                'latency_p50_ms': timing['latency_p50_ms'],
+                'peak_memory_mb': torch.cuda.max_memory_allocated(device) / 2 ** 20 if device.type == 'cuda' else None,
+            }
+            results.append(result)
+            print('{:16s} {:4d}px | {:9.2f} ms | p50 {:9.2f} ms'.format(
+                name, image_size, result['latency_ms'], result['latency_p50_ms']))
+    return {'device': str(device), 'torch': torch.__version__, 'config': vars(args), 'results': results}
+
+
+def main():
+    args = get_config()
+    report = run(args)
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+"""
+Full benchmark suite: micro-benchmarks and every trainer at 128 and 256, written as one json report for regression
+tracking. The defaults are small enough for cpu, e.g.
+python -m benchmarks.suite --cpu --output bench.json
+"""
+import argparse
+import json
+import platform
+import time
+import torch
+from benchmarks import micro, trainers
+
+
+def get_config(manual=None):
+    parser = argparse.ArgumentParser('Benchmark suite')
+    parser.add_argument('--image-size', nargs='+', default=[128, 256], type=int, help='image sizes')
+    parser.add_argument('--batch-size', default=2, type=int, help='batch size')
+    parser.add_argument('--steps', default=3, type=int, help='measured training steps per trainer')
+    parser.add_argument('--iters', default=5, type=int, help='timed iterations of the micro-benchmarks')
+    parser.add_argument('--skip-trainers', default=False, action='store_true', help='only run the micro-benchmarks')
+    parser.add_argument('--cpu', default=False, action='store_true', help='run on cpu even if cuda is available')
+    parser.add_argument('--output', default='benchmarks.json', help='json report')
+    return parser.parse_args(manual)
+
+
+def main():
+    args = get_config()
+    common = ['--image-size'] + [str(size) for size in args.image_size] + ['--batch-size', str(args.batch_size)]
+    if args.cpu:
+        common.append('--cpu')
+
+    report = {
+        'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'host': platform.node(),
+        'torch': torch.__version__,
+        'cuda': torch.cuda.get_device_name(0) if torch.cuda.is_available() and not args.cpu else None,
+    }
+    print('=== micro-benchmarks ===')
+    report['micro'] = micro.run(micro.get_config(common + ['--iters', str(args.iters)]))['results']
+    if not args.skip_trainers:
+        print('=== trainers ===')
+        report['trainers'] = trainers.run(trainers.get_config(common + ['--steps', str(args.steps)]))['results']
+
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print('Saving benchmark report: {} ...'.format(args.output))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,29 @@
+import time
+import torch
+import numpy as np
+
+__all__ = ['time_fn']
+
+
+def time_fn(fn, device, iters=20, warmup=3):
+    """
+    Time a callable, synchronizing cuda before reading the clock
+
+    :return: dict with mean/p50 latency in ms
+    """
+    for _ in range(warmup):
+        fn()
+    latencies = []
+    for _ in range(iters):
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        start = time.perf_counter()
+        fn()
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        latencies.append((time.perf_counter() - start) * 1000)
+    latencies = np.asarray(latencies)
+    return {
+        'latency_ms': float(latencies.mean()),
+        'latency_p50_ms': float(np.percentile(latencies, 50)),
+    }
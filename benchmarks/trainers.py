@@ -0,0 +1,157 @@
+"""
+Step time, throughput and peak memory of every trainer on a generated dataset
+
+Writes random images in the layout of the real data dir (`<style>_train.txt` / `<style>_test.txt` lists) and runs
+each trainer/image size in its own process for a warmup epoch and a measured epoch of --steps steps, validation
+excluded, e.g.
+python -m benchmarks.trainers --trainers cartoongan whitebox --image-size 128 256 --batch-size 4 --output trainers.json
+"""
+import argparse
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import numpy as np
+import torch
+from PIL import Image
+
+TRAINERS = ['cyclegan', 'cartoongan', 'whitebox', 'stargan', 'classifier']
+STYLES = ['real', 'gongqijun', 'tangqian', 'xinhaicheng', 'disney']
+
+
+def get_config(manual=None):
+    parser = argparse.ArgumentParser('Trainer benchmark')
+    parser.add_argument('--trainers', nargs='+', default=TRAINERS, choices=TRAINERS, help='trainers to benchmark')
+    parser.add_argument('--image-size', nargs='+', default=[128, 256], type=int, help='image sizes')
+    parser.add_argument('--batch-size', default=4, type=int, help='batch size')
+    parser.add_argument('--steps', default=5, type=int, help='training steps per epoch')
+    parser.add_argument('--num-workers', default=0, type=int, help='data loader workers')
+    parser.add_argument('--data-source', default='disk', choices=['disk', 'synthetic'],
+                        help='generated jpegs on disk, or pre-generated images in memory to exclude decoding')
+    parser.add_argument('--data-dir', default=None, help='generated dataset dir, a temporary dir by default')
+    parser.add_argument('--cpu', default=False, action='store_true', help='run on cpu even if cuda is available')
+    parser.add_argument('--extra', default='', help='extra main.py options of every run, e.g. "--grad-ckpt res"')
+    parser.add_argument('--output', default=None, help='write results as json')
+    parser.add_argument('--single', nargs=2, default=None, metavar=('TRAINER', 'IMAGE_SIZE'), help=argparse.SUPPRESS)
+    return parser.parse_args(manual)
+
+
+def make_dataset(data_dir, num_images, size=512, seed=0):
+    """
+    Smooth random images of every style; targets are cropped to 512 by the training transforms
+    """
+    rng = np.random.RandomState(seed)
+    for style in STYLES:
+        os.makedirs(os.path.join(data_dir, style), exist_ok=True)
+        paths = []
+        for i in range(num_images):
+            path = os.path.join(style, '{:05d}.jpg'.format(i))
+            low = rng.randint(0, 256, (size // 32, size // 32, 3), dtype=np.uint8)
+            Image.fromarray(low).resize((size, size), Image.BICUBIC).save(os.path.join(data_dir, path), quality=90)
+            paths.append(path)
+        for split in ['train', 'test']:
+            with open(os.path.join(data_dir, '{}_{}.txt'.format(style, split)), 'w') as f:
+                f.write('\n'.join(paths) + '\n')
+
+
+def run_single(args, exp_name, image_size):
+    from main import init_config, override_config
+    from trainers import build_trainer
+
+    use_cuda = torch.cuda.is_available() and not args.cpu
+    config = init_config(['--exp-name', exp_name, '--data-dir', args.data_dir, '--image-size', str(image_size),
+                          '--batch-size', str(args.batch_size), '--num-workers', str(args.num_workers),
+                          '--n-gpu', '1' if use_cuda else '0', '--vgg-cache-size', '0',
+                          '--data-source', args.data_source,
+                          # the synthetic loaders hold out two batches for validation
+                          '--synthetic-size', str(args.batch_size * (args.steps + 2))] + args.extra.split())
+    config = override_config(config)
+    out_dir = tempfile.mkdtemp()
+    config.summary_dir = os.path.join(out_dir, 'tb')
+    config.checkpoint_dir = os.path.join(out_dir, 'checkpoints/')
+    config.log_dir = os.path.join(out_dir, 'logs/')
+    config.result_dir = os.path.join(out_dir, 'results/')
+
+    trainer = build_trainer(config)
+    # validation is not part of the training step
+    trainer._valid_epoch = lambda epoch: {}
+    trainer._train_epoch(1)
+    if use_cuda:
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+    trainer._train_epoch(2)
+    throughput = trainer.epoch_throughput
+    trainer.checkpointer.close()
+    trainer.writer.close()
+    shutil.rmtree(out_dir, ignore_errors=True)
+
+    if use_cuda:
+        peak_memory = torch.cuda.max_memory_allocated() / 2 ** 20
+    else:
+        # linux reports kilobytes, the process only ran this trainer
+        peak_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10
+    return {
+        'trainer': exp_name,
+        'image_size': image_size,
+        'batch_size': args.batch_size,
+        'device': 'cuda' if use_cuda else 'cpu',
+        'data_source': args.data_source,
+        'step_ms': 1000 * args.batch_size / throughput['samples_per_sec'],
+        'samples_per_sec': throughput['samples_per_sec'],
+        'data_ms': 1000 * throughput['data_time'],
+        'compute_ms': 1000 * throughput['compute_time'],
+        'peak_memory_mb': peak_memory,
+        'peak_memory_kind': 'cuda_allocated' if use_cuda else 'process_rss',
+    }
+
+
+def run(args):
+    tmp_dir = None
+    if args.data_dir is None:
+        tmp_dir = args.data_dir = tempfile.mkdtemp()
+    if args.data_source == 'disk':
+        # --steps batches per epoch, the 1% validation split is empty below 100 images
+        make_dataset(args.data_dir, args.batch_size * args.steps)
+
+    results = []
+    for exp_name in args.trainers:
+        for image_size in args.image_size:
+            cmd = [sys.executable, '-m', 'benchmarks.trainers', '--single', exp_name, str(image_size),
+                   '--batch-size', str(args.batch_size), '--steps', str(args.steps),
+                   '--num-workers', str(args.num_workers), '--data-source', args.data_source,
+                   '--data-dir', args.data_dir, '--extra=' + args.extra]
+            if args.cpu:
+                cmd.append('--cpu')
+            proc = subprocess.run(cmd, stdout=subprocess.PIPE, universal_newlines=True)
+            if proc.returncode != 0:
+                result = {'trainer': exp_name, 'image_size': image_size, 'error': proc.returncode}
+                print('{:10s} {:4d}px | failed with exit code {}'.format(exp_name, image_size, proc.returncode))
+            else:
+                result = json.loads(proc.stdout.strip().split('\n')[-1])
+                print('{:10s} {:4d}px | {:9.1f} ms/step | {:7.2f} img/s | data {:7.1f} ms | peak memory {:.0f} MB'.format(
+                    exp_name, image_size, result['step_ms'], result['samples_per_sec'], result['data_ms'],
+                    result['peak_memory_mb']))
+            results.append(result)
+
+    if tmp_dir is not None:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return {'torch': torch.__version__, 'config': vars(args), 'results': results}
+
+
+def main():
+    args = get_config()
+    if args.single is not None:
+        result = run_single(args, args.single[0], int(args.single[1]))
+        print(json.dumps(result))
+        return
+    report = run(args)
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,3 @@
-from .diff_aug import DiffAugment
+from .diff_aug import DiffAugment, AdaptiveDiffAugment
 from .data_loader import CartoonDataLoader, CartoonGANDataLoader, CartoonDefaultDataLoader, StarCartoonDataLoader, ClassifierDataLoader
-
+from .synthetic import SyntheticDataLoader, make_image_bank
@@ -1,3 +1,4 @@
+import copy
 from torchvision import transforms
 from base import BaseDataLoader
 from torch.utils.data import DataLoader
@@ -51,14 +52,17 @@ class CartoonDefaultDataLoader(DataLoader):
 
 
 class CartoonDataLoader(BaseDataLoader):
+    dataset_class = CartoonDataset
+
     def __init__(self, data_dir, src_style='real', tar_style='gongqijun', image_size=256, batch_size=16, num_workers=4, validation_split=0.01):
+        self.image_size = image_size
 
         # data augmentation
         src_transform = build_train_transform(src_style, image_size)
         tar_transform = build_train_transform(tar_style, image_size)
 
         # create dataset
-        self.dataset = CartoonDataset(data_dir, src_style, tar_style, src_transform, tar_transform)
+        self.dataset = self.dataset_class(data_dir, src_style, tar_style, src_transform, tar_transform)
 
         super(CartoonDataLoader, self).__init__(
             dataset=self.dataset,
@@ -71,27 +75,27 @@ class CartoonDataLoader(BaseDataLoader):
     def shuffle_dataset(self):
         self.dataset._shuffle_data()
 
-
-class CartoonGANDataLoader(BaseDataLoader):
-    def __init__(self, data_dir, src_style='real', tar_style='gongqijun', image_size=256, batch_size=16, num_workers=4, validation_split=0.01):
-
-        # data augmentation
-        src_transform = build_train_transform(src_style, image_size)
-        tar_transform = build_train_transform(tar_style, image_size)
-
-        # create dataset
-        self.dataset = CartoonGANDataset(data_dir, src_style, tar_style, src_transform, tar_transform)
-
-        super(CartoonGANDataLoader, self).__init__(
-            dataset=self.dataset,
-            batch_size=batch_size,
-            shuffle=True,
-            validation_split=validation_split,
-            num_workers=num_workers,
-            drop_last=True)
-
-    def shuffle_dataset(self):
-        self.dataset._shuffle_data()
+    def split_validation(self, deterministic=False):
+        """
+        :param deterministic: validate on a fixed copy of the data with center crops, returning source paths as keys
+        """
+        if not deterministic:
+            return super(CartoonDataLoader, self).split_validation()
+        dataset = copy.copy(self.dataset)
+        # own lists, so shuffling the training data does not change the validation images
+        dataset.src_data = list(self.dataset.src_data)
+        dataset.tar_data = list(self.dataset.tar_data)
+        dataset.src_transform = build_test_transform('real', self.image_size)
+        dataset.tar_transform = build_test_transform('cartoon', self.image_size)
+        dataset.return_keys = True
+        return super(CartoonDataLoader, self).split_validation(dataset)
+
+
+class CartoonGANDataLoader(CartoonDataLoader):
+    """
+    CartoonDataLoader whose batches also hold the edge smoothed targets
+    """
+    dataset_class = CartoonGANDataset
 
 
 class StarCartoonDataLoader(BaseDataLoader):
@@ -14,6 +14,8 @@ class CartoonDataset(Dataset):
         print("total {} {} images for training".format(len(self.tar_data), tar_style))
         self.src_transform = src_transform
         self.tar_transform = tar_transform
+        # also return the source path, e.g. as key of cached source features
+        self.return_keys = False
 
     def _load_data(self, data_dir, src_style, tar_style):
         src_data = []
@@ -36,6 +38,14 @@ class CartoonDataset(Dataset):
         np.random.shuffle(self.src_data)
         np.random.shuffle(self.tar_data)
 
+    def state_dict(self):
+        """ order of the shuffled lists, see BaseDataLoader.state_dict """
+        return {'src_data': list(self.src_data), 'tar_data': list(self.tar_data)}
+
+    def load_state_dict(self, state):
+        self.src_data = list(state['src_data'])
+        self.tar_data = list(state['tar_data'])
+
     def __len__(self):
         return len(self.src_data)
 
@@ -53,6 +63,8 @@ class CartoonDataset(Dataset):
         # transform tar img
         if self.tar_transform is not None:
             tar_img = self.tar_transform(tar_img)
+        if self.return_keys:
+            return src_img, tar_img, src_path
         return src_img, tar_img
 
 
@@ -109,6 +121,8 @@ class CartoonGANDataset(CartoonDataset):
         if self.tar_transform is not None:
             tar_img = self.tar_transform(tar_img)
             smooth_tar_img = self.tar_transform(smooth_tar_img)
+        if self.return_keys:
+            return src_img, tar_img, smooth_tar_img, src_path
         return src_img, tar_img, smooth_tar_img
 
 
@@ -143,6 +157,14 @@ class StarCartoonDataset(Dataset):
             np.random.shuffle(item)
             self.tar_data[key] = item
 
+    def state_dict(self):
+        """ order of the shuffled lists, see BaseDataLoader.state_dict """
+        return {'src_data': list(self.src_data), 'tar_data': {key: list(item) for key, item in self.tar_data.items()}}
+
+    def load_state_dict(self, state):
+        self.src_data = list(state['src_data'])
+        self.tar_data = {key: list(item) for key, item in state['tar_data'].items()}
+
     def __len__(self):
         return len(self.src_data)
 
@@ -42,15 +42,14 @@ def rand_translation(x, ratio=0.125):
     shift_x, shift_y = int(x.size(2) * ratio + 0.5), int(x.size(3) * ratio + 0.5)
     translation_x = torch.randint(-shift_x, shift_x + 1, size=[x.size(0), 1, 1], device=x.device)
     translation_y = torch.randint(-shift_y, shift_y + 1, size=[x.size(0), 1, 1], device=x.device)
-    grid_batch, grid_x, grid_y = torch.meshgrid(
-        torch.arange(x.size(0), dtype=torch.long, device=x.device),
-        torch.arange(x.size(2), dtype=torch.long, device=x.device),
-        torch.arange(x.size(3), dtype=torch.long, device=x.device),
-    )
-    grid_x = torch.clamp(grid_x + translation_x + 1, 0, x.size(2) + 1)
-    grid_y = torch.clamp(grid_y + translation_y + 1, 0, x.size(3) + 1)
+    # the shift is separable: gather the rows, then the columns of the zero padded image
+    grid_x = torch.arange(x.size(2), dtype=torch.long, device=x.device).view(1, -1) + translation_x.view(-1, 1)
+    grid_y = torch.arange(x.size(3), dtype=torch.long, device=x.device).view(1, -1) + translation_y.view(-1, 1)
+    grid_x = torch.clamp(grid_x + 1, 0, x.size(2) + 1)
+    grid_y = torch.clamp(grid_y + 1, 0, x.size(3) + 1)
     x_pad = F.pad(x, [1, 1, 1, 1, 0, 0, 0, 0])
-    x = x_pad.permute(0, 2, 3, 1).contiguous()[grid_batch, grid_x, grid_y].permute(0, 3, 1, 2)
+    x = torch.gather(x_pad, 2, grid_x.view(x.size(0), 1, -1, 1).expand(-1, x.size(1), -1, x_pad.size(3)))
+    x = torch.gather(x, 3, grid_y.view(x.size(0), 1, 1, -1).expand(-1, x.size(1), x.size(2), -1))
     return x
 
 
@@ -58,16 +57,15 @@ def rand_cutout(x, ratio=0.5):
     cutout_size = int(x.size(2) * ratio + 0.5), int(x.size(3) * ratio + 0.5)
     offset_x = torch.randint(0, x.size(2) + (1 - cutout_size[0] % 2), size=[x.size(0), 1, 1], device=x.device)
     offset_y = torch.randint(0, x.size(3) + (1 - cutout_size[1] % 2), size=[x.size(0), 1, 1], device=x.device)
-    grid_batch, grid_x, grid_y = torch.meshgrid(
-        torch.arange(x.size(0), dtype=torch.long, device=x.device),
-        torch.arange(cutout_size[0], dtype=torch.long, device=x.device),
-        torch.arange(cutout_size[1], dtype=torch.long, device=x.device),
-    )
-    grid_x = torch.clamp(grid_x + offset_x - cutout_size[0] // 2, min=0, max=x.size(2) - 1)
-    grid_y = torch.clamp(grid_y + offset_y - cutout_size[1] // 2, min=0, max=x.size(3) - 1)
-    mask = torch.ones(x.size(0), x.size(2), x.size(3), dtype=x.dtype, device=x.device)
-    mask[grid_batch, grid_x, grid_y] = 0
-    x = x * mask.unsqueeze(1)
+    # the cut out box is the product of a row and a column range
+    start_x = offset_x.view(-1, 1) - cutout_size[0] // 2
+    start_y = offset_y.view(-1, 1) - cutout_size[1] // 2
+    rows = torch.arange(x.size(2), dtype=torch.long, device=x.device).view(1, -1) - start_x
+    cols = torch.arange(x.size(3), dtype=torch.long, device=x.device).view(1, -1) - start_y
+    rows = (rows >= 0) & (rows < cutout_size[0])
+    cols = (cols >= 0) & (cols < cutout_size[1])
+    mask = ~(rows.unsqueeze(2) & cols.unsqueeze(1))
+    x = x * mask.unsqueeze(1).to(x.dtype)
     return x
 
 
@@ -75,4 +73,74 @@ AUGMENT_FNS = {
     'color': [rand_brightness, rand_saturation, rand_contrast],
     'translation': [rand_translation],
     'cutout': [rand_cutout],
-}
\ No newline at end of file
+}
+
+class AdaptiveDiffAugment:
+    """
+    DiffAugment whose ops are applied to every sample with probability p. p follows the overfitting heuristic of
+    adaptive discriminator augmentation (Karras et al., 2020): r = E[sign(D(real) - threshold)] is accumulated on
+    device and every interval steps p moves towards keeping r at target, without syncing with the host.
+    """
+    def __init__(self, policy='', target=0.6, interval=4, speed_kimg=500, threshold=0.0, p=0.0, device='cpu'):
+        """
+        :param policy: DiffAugment policy string
+        :param target: target value of the overfitting signal r
+        :param interval: number of steps between p updates
+        :param speed_kimg: thousands of images for p to go from 0 to 1
+        :param threshold: decision boundary of the discriminator outputs, e.g. 0.5 for LSGAN, 0 for logits
+        """
+        self.fns = [f for p_ in policy.split(',') if p_ for f in AUGMENT_FNS[p_]]
+        self.target = target
+        self.interval = interval
+        self.speed_kimg = speed_kimg
+        self.threshold = threshold
+        self.p = torch.tensor(p, device=device)
+        # sum of signs on device, number of signs on the host
+        self.signal = torch.zeros((), device=device)
+        self.count = 0
+        self.num_images = 0
+        self.num_steps = 0
+
+    def __call__(self, x):
+        if not self.fns:
+            return x
+        x = (x + 1) / 2
+        for f in self.fns:
+            apply = torch.rand(x.size(0), 1, 1, 1, device=x.device) < self.p
+            x = torch.where(apply, f(x), x)
+        x = x.contiguous()
+        return x * 2 - 1
+
+    def accumulate(self, real_logits):
+        """
+        :param real_logits: discriminator outputs on (augmented) real images
+        """
+        signs = torch.sign(real_logits.detach() - self.threshold)
+        self.signal += signs.sum()
+        self.count += signs.numel()
+
+    def step(self, batch_size):
+        """
+        Count a training step of batch_size real images and adjust p every interval steps
+        """
+        self.num_steps += 1
+        self.num_images += batch_size
+        if self.num_steps % self.interval != 0:
+            return
+        r = self.signal / max(self.count, 1)
+        adjust = torch.sign(r - self.target) * self.num_images / (self.speed_kimg * 1000)
+        self.p = (self.p + adjust).clamp(0, 1)
+        self.signal.zero_()
+        self.count = 0
+        self.num_images = 0
+
+    def state_dict(self):
+        return {'p': self.p.cpu(), 'signal': self.signal.cpu(), 'count': self.count, 'num_images': self.num_images,
+                'num_steps': self.num_steps}
+
+    def load_state_dict(self, state):
+        self.p = state['p'].to(self.p.device)
+        self.signal = state['signal'].to(self.signal.device)
+        self.count = state['count']
+        self.num_images = state['num_images']
+        self.num_steps = state['num_steps']
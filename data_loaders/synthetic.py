@@ -0,0 +1,110 @@
+import copy
+import random
+import numpy as np
+import torch
+import torch.nn.functional as F
+from torch.utils.data import Dataset
+from base import BaseDataLoader
+
+
+def make_image_bank(num_images, image_size, mode='procedural', seed=0):
+    """
+    Pre-generated uint8 images (num_images, 3, image_size, image_size) in shared memory, data loader workers
+    read them without copies
+
+    :param mode: 'random' for uniform noise, 'procedural' for smooth color fields with some structure
+    """
+    generator = torch.Generator().manual_seed(seed)
+    bank = torch.empty((num_images, 3, image_size, image_size), dtype=torch.uint8)
+    for start in range(0, num_images, 64):
+        end = min(start + 64, num_images)
+        if mode == 'random':
+            images = torch.randint(0, 256, (end - start, 3, image_size, image_size), generator=generator,
+                                   dtype=torch.uint8)
+        elif mode == 'procedural':
+            low = torch.rand((end - start, 3, 8, 8), generator=generator)
+            images = F.interpolate(low, size=(image_size, image_size), mode='bicubic', align_corners=False)
+            images = images + 0.1 * torch.rand((end - start, 1, image_size, image_size), generator=generator)
+            images = (images.clamp(0, 1) * 255).to(torch.uint8)
+        else:
+            raise NotImplementedError(mode)
+        bank[start:end] = images
+    return bank.share_memory_()
+
+
+class SyntheticDataset(Dataset):
+    """
+    Serves images of a shared bank with the structure of the real datasets:
+        'cartoon': src, tar (CartoonDataset), 'cartoongan': src, tar, smooth tar (CartoonGANDataset),
+        'star': src, tar, tar label (StarCartoonDataset), 'classifier': img, label (ClassifierDataset)
+    """
+    def __init__(self, bank, kind='cartoon', num_classes=4):
+        self.bank = bank
+        self.kind = kind
+        self.num_classes = num_classes
+        self.indices = np.arange(len(bank))
+        # also return a source key, as CartoonDataset.return_keys
+        self.return_keys = False
+
+    def _shuffle_data(self):
+        np.random.shuffle(self.indices)
+
+    def state_dict(self):
+        return {'indices': self.indices.copy()}
+
+    def load_state_dict(self, state):
+        self.indices = np.asarray(state['indices'])
+
+    def _image(self, index):
+        return self.bank[self.indices[index % len(self.indices)]].float().div_(127.5).sub_(1)
+
+    def __len__(self):
+        return len(self.bank)
+
+    def __getitem__(self, index):
+        # targets are other images of the bank
+        offset = len(self.bank) // 3
+        src_img = self._image(index)
+        if self.kind == 'classifier':
+            return src_img, np.asarray(index % self.num_classes, dtype=np.int64)
+        tar_img = self._image(index + offset)
+        if self.kind == 'star':
+            return src_img, tar_img, random.randint(0, self.num_classes - 1)
+        out = (src_img, tar_img)
+        if self.kind == 'cartoongan':
+            out = out + (self._image(index + 2 * offset),)
+        if self.return_keys:
+            out = out + ('synthetic/{}'.format(index),)
+        return out
+
+
+class SyntheticDataLoader(BaseDataLoader):
+    """
+    Data loader over pre-generated images, to measure the compute throughput of the trainers without decoding
+    and augmentation. The validation split holds at least two batches
+    """
+    def __init__(self, kind='cartoon', image_size=256, batch_size=16, num_workers=4, num_images=512,
+                 mode='procedural'):
+        self.image_size = image_size
+        self.dataset = SyntheticDataset(make_image_bank(num_images, image_size, mode), kind)
+        super(SyntheticDataLoader, self).__init__(
+            dataset=self.dataset,
+            batch_size=batch_size,
+            shuffle=True,
+            validation_split=max(2 * batch_size, num_images // 100),
+            num_workers=num_workers,
+            drop_last=True)
+
+    def shuffle_dataset(self):
+        self.dataset._shuffle_data()
+
+    def split_validation(self, deterministic=False):
+        """
+        :param deterministic: validate on a fixed order of the images, returning keys
+        """
+        if not deterministic:
+            return super(SyntheticDataLoader, self).split_validation()
+        dataset = copy.copy(self.dataset)
+        dataset.indices = self.dataset.indices.copy()
+        dataset.return_keys = True
+        return super(SyntheticDataLoader, self).split_validation(dataset)
@@ -2,11 +2,9 @@ import os
 working_dir = os.path.dirname(__file__)
 import argparse
 import torch
-from easydict import EasyDict as edict
 from tqdm import tqdm
 from data_loaders import CartoonDefaultDataLoader
-from models import Generator
-from utils.misc import read_json
+from inference import load_checkpoint_config, load_generator, build_backend
 import numpy as np
 import cv2
 from fid_score import calculate_fid_given_paths
@@ -19,15 +17,20 @@ def get_config(manual=None):
     # basic options
     parser.add_argument('--checkpoint-path', default='experiments/cyclegan_color_translation_cutout_real_gongqijun_128_bs12_glr0.0001_dlr0.0002_wd0.0001_201106_025817/checkpoints/current.pth', help='checkpoint path')
     parser.add_argument('--image-size', default=128, type=int, help='image size')
+    parser.add_argument('--backend', default='torch', choices=['torch', 'onnx', 'int8'], help='inference backend')
+    parser.add_argument('--model-path', default=None, help='exported onnx model or int8 model of quantize.py')
+    parser.add_argument('--num-threads', default=0, type=int, help='cpu threads for inference, 0 for default')
+    parser.add_argument('--no-ema', default=False, action='store_true',
+                        help='use the trained generator weights even if the checkpoint has moving average weights')
     return parser.parse_args(manual)
 
 
 def main():
-    config = get_config()
-    image_size = config.image_size
+    args = get_config()
+    image_size = args.image_size
 
     # find config.json in checkpoint folder
-    checkpoint_path = os.path.join(working_dir, config.checkpoint_path)
+    checkpoint_path = os.path.join(working_dir, args.checkpoint_path)
     checkpoint_epoch = checkpoint_path.split('/')[-1].split('.')[0]
     checkpoint_dir = os.path.dirname(checkpoint_path)
     exp_dir = os.path.dirname(checkpoint_dir)
@@ -40,11 +43,9 @@ def main():
         device = torch.device('cpu')
 
     # load config
-    config = read_json(os.path.join(exp_dir, 'config.json'))
-    config = edict(config)
-    image_dir = os.path.join(result_dir, '{}2{}_{}_{}'.format(config.src_style, config.tar_style, image_size, checkpoint_epoch))
-    if not os.path.exists(image_dir):
-        os.mkdir(image_dir)
+    config = load_checkpoint_config(checkpoint_path)
+    if args.backend != 'torch':
+        checkpoint_epoch += '_{}'.format(args.backend)
 
     # build dataloader
     data_loader = CartoonDefaultDataLoader(
@@ -55,24 +56,27 @@ def main():
         num_workers=config.num_workers)
 
     # build model
-    model = Generator(config.image_size, config.down_size, config.num_res, config.skip_conn)
-    checkpoint = torch.load(checkpoint_path, map_location=device)
-    if config.exp_name == 'cyclegan':
-        model.load_state_dict(checkpoint['gen_src_tar_state_dict'])
+    if args.backend == 'torch':
+        model, _ = load_generator(checkpoint_path, device, config, ema=not args.no_ema)
+        if model.ema:
+            # keep the results of both weights apart
+            checkpoint_epoch += '_ema'
     else:
-        model.load_state_dict(checkpoint['gen_state_dict'])
-    model.to(device)
-    model.eval()
+        model = None
+        device = torch.device('cpu')
+    model = build_backend(args.backend, model, args.model_path, device, args.num_threads)
+    image_dir = os.path.join(result_dir, '{}2{}_{}_{}'.format(config.src_style, config.tar_style, image_size, checkpoint_epoch))
+    if not os.path.exists(image_dir):
+        os.mkdir(image_dir)
 
     # start evaluation
     print("start evaluation")
     count = 0
     with torch.no_grad():
         for batch_idx, src_imgs in tqdm(enumerate(data_loader), total=len(data_loader)):
-            src_imgs = src_imgs.to(device)
             tar_imgs = model(src_imgs)
 
-            if config.exp_name == 'whitebox':
+            if config.exp_name == 'whitebox' and not model.guided:
                 tar_imgs = guided_filter(tar_imgs, src_imgs, r=1)
 
             # save images
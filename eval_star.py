@@ -2,17 +2,14 @@ import os
 working_dir = os.path.dirname(__file__)
 import argparse
 import torch
-from easydict import EasyDict as edict
 from tqdm import tqdm
 from data_loaders import CartoonDefaultDataLoader
-from models import StarGenerator, MappingNetwork
-from utils.misc import read_json
+from inference import load_checkpoint_config, load_generator, build_backend, StyleBank
 import numpy as np
 import cv2
 from fid_score import calculate_fid_given_paths
 from kid_score import calculate_kid_given_paths
 from acc_score import compute_acc_score
-from utils.wb_utils import guided_filter
 
 
 def get_config(manual=None):
@@ -20,15 +17,22 @@ def get_config(manual=None):
     # basic options
     parser.add_argument('--checkpoint-path', default='experiments/cyclegan_color_translation_cutout_real_gongqijun_128_bs12_glr0.0001_dlr0.0002_wd0.0001_201106_025817/checkpoints/current.pth', help='checkpoint path')
     parser.add_argument('--image-size', default=128, type=int, help='image size')
+    parser.add_argument('--backend', default='torch', choices=['torch', 'onnx'], help='inference backend')
+    parser.add_argument('--model-path', default=None, help='exported onnx generator for the onnx backend')
+    parser.add_argument('--num-threads', default=0, type=int, help='cpu threads for inference, 0 for default')
+    parser.add_argument('--no-ema', default=False, action='store_true',
+                        help='use the trained generator weights even if the checkpoint has moving average weights')
+    parser.add_argument('--style-mode', default='random', choices=['random', 'canonical'],
+                        help='random latent per image or the canonical (average) style of each domain')
     return parser.parse_args(manual)
 
 
 def main():
-    config = get_config()
-    image_size = config.image_size
+    args = get_config()
+    image_size = args.image_size
 
     # find config.json in checkpoint folder
-    checkpoint_path = os.path.join(working_dir, config.checkpoint_path)
+    checkpoint_path = os.path.join(working_dir, args.checkpoint_path)
     checkpoint_epoch = checkpoint_path.split('/')[-1].split('.')[0]
     checkpoint_dir = os.path.dirname(checkpoint_path)
     exp_dir = os.path.dirname(checkpoint_dir)
@@ -41,8 +45,7 @@ def main():
         device = torch.device('cpu')
 
     # load config
-    config = read_json(os.path.join(exp_dir, 'config.json'))
-    config = edict(config)
+    config = load_checkpoint_config(checkpoint_path)
 
     # build dataloader
     data_loader = CartoonDefaultDataLoader(
@@ -53,49 +56,66 @@ def main():
         num_workers=config.num_workers)
 
     # build model
-    model = StarGenerator(config.image_size, config.down_size, config.num_res, config.skip_conn)
-    mapnet  = MappingNetwork(latent_dim=16, style_dim=config.style_size, num_domains=4)
-    checkpoint = torch.load(checkpoint_path, map_location=device)
-    model.load_state_dict(checkpoint['gen_state_dict'])
-    mapnet.load_state_dict(checkpoint['map_state_dict'])
-    model.to(device)
-    mapnet.to(device)
-    model.eval()
-    mapnet.eval()
+    if args.backend == 'torch':
+        model, _ = load_generator(checkpoint_path, device, config, ema=not args.no_ema)
+        if model.ema:
+            # keep the results of both weights apart
+            checkpoint_epoch += '_ema'
+    else:
+        model = None
+        device = torch.device('cpu')
+    model = build_backend(args.backend, model, args.model_path, device, args.num_threads)
 
-    # start evaluation
-    print("start evaluation")
-    for i, tar_style in enumerate(['gongqijun', 'xinhaicheng', 'disney', 'tangqian']):
+    # precompute canonical styles, every batch is translated to all styles in one forward
+    style_names = ['gongqijun', 'xinhaicheng', 'disney', 'tangqian']
+    styles = StyleBank(model, num_domains=len(style_names))
+    image_dirs = []
+    for tar_style in style_names:
         image_dir = os.path.join(result_dir, '{}2{}_{}_{}'.format(config.src_style, tar_style, image_size, checkpoint_epoch))
         if not os.path.exists(image_dir):
             os.mkdir(image_dir)
+        image_dirs.append(image_dir)
 
-        count = 0
-        with torch.no_grad():
-            for batch_idx, src_imgs in tqdm(enumerate(data_loader), total=len(data_loader)):
-                src_imgs = src_imgs.to(device)
-                tar_labels = torch.ones((src_imgs.size(0)), dtype=torch.long) * i
-
-                tar_z = torch.randn((src_imgs.size(0), config.latent_size)).to(device)
-                tar_s = mapnet(tar_z, tar_labels)
-                tar_imgs = model(src_imgs, tar_s)
-
-                # save images
-                tar_imgs = tar_imgs.cpu().numpy().transpose(0, 2, 3, 1)
-                # convert from [-1, 1] to [0, 255] uint
-                tar_imgs = (tar_imgs + 1) / 2
-                tar_imgs = (tar_imgs * 255).astype(np.uint8)
-
-                src_imgs = src_imgs.cpu().numpy().transpose(0, 2, 3, 1)
-                # convert from [-1, 1] to [0, 255] uint
-                src_imgs = (src_imgs + 1) / 2
-                src_imgs = (src_imgs * 255).astype(np.uint8)
-
-                for src_img, tar_img in zip(src_imgs, tar_imgs):
-                    cv2.imwrite(os.path.join(image_dir, '{}_tar.png'.format(count)), tar_img[:, :, ::-1])
-                    cv2.imwrite(os.path.join(image_dir, '{}_src.png'.format(count)), src_img[:, :, ::-1])
-                    count += 1
-
+    # start evaluation
+    print("start evaluation")
+    count = 0
+    with torch.no_grad():
+        for batch_idx, src_imgs in tqdm(enumerate(data_loader), total=len(data_loader)):
+            batch_size = src_imgs.size(0)
+            if model.fan_out:
+                # one encoder pass per image, the decoder runs batched over all styles
+                tar_labels = torch.arange(len(style_names)).repeat(batch_size)
+            else:
+                tar_labels = torch.arange(len(style_names)).repeat_interleave(batch_size)
+            if args.style_mode == 'random':
+                tar_s = styles.random_styles(tar_labels)
+            else:
+                tar_s = styles.canonical_styles(tar_labels)
+            if model.fan_out:
+                tar_imgs = model(src_imgs, tar_s.view(batch_size, len(style_names), -1))
+                tar_imgs = tar_imgs.transpose(0, 1).reshape((-1,) + tar_imgs.shape[2:])
+            else:
+                tar_imgs = model(src_imgs.repeat(len(style_names), 1, 1, 1), tar_s)
+
+            # save images
+            tar_imgs = tar_imgs.cpu().numpy().transpose(0, 2, 3, 1)
+            # convert from [-1, 1] to [0, 255] uint
+            tar_imgs = (tar_imgs + 1) / 2
+            tar_imgs = (tar_imgs * 255).astype(np.uint8)
+            tar_imgs = tar_imgs.reshape((len(style_names), batch_size) + tar_imgs.shape[1:])
+
+            src_imgs = src_imgs.cpu().numpy().transpose(0, 2, 3, 1)
+            # convert from [-1, 1] to [0, 255] uint
+            src_imgs = (src_imgs + 1) / 2
+            src_imgs = (src_imgs * 255).astype(np.uint8)
+
+            for image_dir, style_imgs in zip(image_dirs, tar_imgs):
+                for j, (src_img, tar_img) in enumerate(zip(src_imgs, style_imgs)):
+                    cv2.imwrite(os.path.join(image_dir, '{}_tar.png'.format(count + j)), tar_img[:, :, ::-1])
+                    cv2.imwrite(os.path.join(image_dir, '{}_src.png'.format(count + j)), src_img[:, :, ::-1])
+            count += batch_size
+
+    for tar_style, image_dir in zip(style_names, image_dirs):
         result_file = open('{}/{}2_{}_result_{}_{}.txt'.format(result_dir, config.src_style, tar_style, image_size, checkpoint_epoch), "w")
 
         result_file.write("Style {}\n".format(tar_style))
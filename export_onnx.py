@@ -0,0 +1,49 @@
+import os
+working_dir = os.path.dirname(__file__)
+import argparse
+from inference import load_generator, export_onnx, check_parity, benchmark_backend, TorchBackend, OnnxBackend
+
+
+def get_config(manual=None):
+    parser = argparse.ArgumentParser('Image Cartoon ONNX export')
+    parser.add_argument('--checkpoint-path', required=True, help='checkpoint path')
+    parser.add_argument('--output', default=None, help='onnx path, defaults to the checkpoint path with .onnx')
+    parser.add_argument('--image-size', default=256, type=int, help='image size used for tracing and benchmarking')
+    parser.add_argument('--opset', default=11, type=int, help='onnx opset version')
+    parser.add_argument('--guided-filter', default=None, choices=['on', 'off'],
+                        help='include the whitebox guided filter post-process, defaults to on for whitebox')
+    parser.add_argument('--check-parity', default=False, action='store_true', help='compare outputs with pytorch')
+    parser.add_argument('--atol', default=1e-3, type=float, help='tolerance of the parity check')
+    parser.add_argument('--benchmark', default=False, action='store_true', help='benchmark onnxruntime and pytorch')
+    parser.add_argument('--batch-size', default=1, type=int, help='benchmark batch size')
+    parser.add_argument('--threads', default='1,2,4', help='comma separated thread counts for the benchmark')
+    return parser.parse_args(manual)
+
+
+def main():
+    args = get_config()
+    checkpoint_path = os.path.join(working_dir, args.checkpoint_path)
+    onnx_path = args.output or os.path.splitext(checkpoint_path)[0] + '.onnx'
+    guided = None if args.guided_filter is None else args.guided_filter == 'on'
+
+    model, config = load_generator(checkpoint_path, device='cpu', guided=guided)
+    export_onnx(model, onnx_path, image_size=args.image_size, opset=args.opset)
+    print("exported {} to {}".format(config.exp_name, onnx_path))
+
+    if args.check_parity:
+        backend = OnnxBackend(onnx_path)
+        for image_size, err, passed in check_parity(model, backend, image_sizes=(args.image_size // 2, args.image_size), atol=args.atol):
+            print("parity {}x{}: max abs err {:.2e} {}".format(image_size, image_size, err, 'OK' if passed else 'FAILED'))
+
+    if args.benchmark:
+        print('{:>8s} {:>8s} {:>12s} {:>12s} {:>12s}'.format('backend', 'threads', 'latency(ms)', 'p90(ms)', 'images/s'))
+        for num_threads in [int(t) for t in args.threads.split(',')]:
+            for name, backend in [('torch', TorchBackend(model, 'cpu', num_threads)),
+                                  ('onnx', OnnxBackend(onnx_path, num_threads))]:
+                result = benchmark_backend(backend, args.image_size, args.batch_size)
+                print('{:>8s} {:>8d} {:>12.2f} {:>12.2f} {:>12.2f}'.format(
+                    name, num_threads, result['latency_ms'], result['latency_p90_ms'], result['images_per_sec']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+import os
+working_dir = os.path.dirname(__file__)
+import time
+import argparse
+import resource
+import subprocess
+import sys
+from inference import export_generator_weights
+
+
+def get_config(manual=None):
+    parser = argparse.ArgumentParser('Image Cartoon weights export')
+    parser.add_argument('--checkpoint-path', required=True, help='checkpoint path')
+    parser.add_argument('--output', default=None, help='weights path, defaults to the checkpoint path with .safetensors')
+    parser.add_argument('--half', default=False, action='store_true', help='store the weights as float16')
+    parser.add_argument('--no-ema', default=False, action='store_true',
+                        help='export the trained generator weights even if the checkpoint has moving average weights')
+    parser.add_argument('--benchmark', default=False, action='store_true',
+                        help='compare cold load time and memory of the checkpoint and the weights')
+    parser.add_argument('--load-single', default=None, help=argparse.SUPPRESS)
+    return parser.parse_args(manual)
+
+
+def load_single(path):
+    """ load in a fresh process, prints load time (ms) and peak rss (MB) """
+    from inference import load_generator
+    start = time.perf_counter()
+    load_generator(path, device='cpu')
+    elapsed = time.perf_counter() - start
+    # linux reports kilobytes
+    print('{:.2f} {:.1f}'.format(1000 * elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10))
+
+
+def main():
+    args = get_config()
+    if args.load_single is not None:
+        load_single(args.load_single)
+        return
+    checkpoint_path = os.path.join(working_dir, args.checkpoint_path)
+    weights_path = export_generator_weights(checkpoint_path, args.output, half=args.half, ema=not args.no_ema)
+    print("exported {} ({:.1f} MB) to {} ({:.1f} MB)".format(
+        checkpoint_path, os.path.getsize(checkpoint_path) / 2 ** 20,
+        weights_path, os.path.getsize(weights_path) / 2 ** 20))
+
+    if args.benchmark:
+        print('{:>12s} {:>12s} {:>12s}'.format('format', 'load(ms)', 'peak rss(MB)'))
+        for name, path in [('checkpoint', checkpoint_path), ('safetensors', weights_path)]:
+            out = subprocess.run([sys.executable, os.path.abspath(__file__), '--checkpoint-path', path,
+                                  '--load-single', path], stdout=subprocess.PIPE, universal_newlines=True).stdout
+            load_ms, rss = out.strip().split('\n')[-1].split()
+            print('{:>12s} {:>12.2f} {:>12.1f}'.format(name, float(load_ms), float(rss)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,7 @@
+from .modules import CartoonGenerator, StarCartoonGenerator
+from .loader import load_checkpoint_config, build_generator, load_generator, export_generator_weights
+from .weights import save_weights, load_weights, read_metadata
+from .backends import TorchBackend, OnnxBackend, QuantizedBackend, build_backend
+from .export import export_onnx, check_parity
+from .benchmark import benchmark_backend
+from .style import StyleBank
@@ -0,0 +1,126 @@
+import torch
+import numpy as np
+from .quantize import load_quantized
+
+try:
+    import onnxruntime as ort
+except ImportError:
+    ort = None
+
+__all__ = ['TorchBackend', 'OnnxBackend', 'QuantizedBackend', 'build_backend']
+
+
+class TorchBackend:
+    """
+    Run the PyTorch inference module, inputs and outputs are CPU tensors in [-1, 1]
+    """
+    def __init__(self, model, device='cpu', num_threads=0):
+        if num_threads > 0:
+            torch.set_num_threads(num_threads)
+        self.device = torch.device(device)
+        self.model = model.to(self.device).eval()
+        self.is_star = hasattr(model, 'map_net')
+        self.latent_dim = model.latent_dim if self.is_star else None
+        self.guided = model.guided
+        # styles of shape (batch, K, style_dim) share the encoder
+        self.fan_out = self.is_star
+
+    def style(self, z, y):
+        with torch.no_grad():
+            return self.model.style(z.to(self.device), y.to(self.device)).cpu()
+
+    def __call__(self, x, s=None):
+        with torch.no_grad():
+            x = x.to(self.device)
+            if self.is_star:
+                out = self.model(x, s.to(self.device))
+            else:
+                out = self.model(x)
+        return out.cpu()
+
+
+class OnnxBackend:
+    """
+    Run an exported model with ONNX Runtime on CPU
+
+    :param onnx_path: generator graph, stargan exports need the '_map.onnx' mapping graph next to it
+    """
+    def __init__(self, onnx_path, num_threads=0):
+        if ort is None:
+            raise ImportError("ONNX Runtime is not installed on this machine, please install it with "
+                              "'pip install onnxruntime'.")
+        self.session = self._create_session(onnx_path, num_threads)
+        meta = self.session.get_modelmeta().custom_metadata_map
+        self.is_star = meta.get('model') == 'stargan'
+        self.guided = meta.get('guided_filter') == '1'
+        self.map_session = None
+        self.latent_dim = None
+        self.fan_out = False
+        if self.is_star:
+            self.map_session = self._create_session(mapping_path(onnx_path), num_threads)
+            self.latent_dim = self.map_session.get_inputs()[0].shape[1]
+
+    @staticmethod
+    def _create_session(path, num_threads):
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+        if num_threads > 0:
+            options.intra_op_num_threads = num_threads
+            options.inter_op_num_threads = 1
+        return ort.InferenceSession(path, sess_options=options, providers=['CPUExecutionProvider'])
+
+    def style(self, z, y):
+        s = self.map_session.run(None, {'latent': _to_numpy(z), 'label': _to_numpy(y).astype(np.int64)})[0]
+        return torch.from_numpy(s)
+
+    def __call__(self, x, s=None):
+        inputs = {'input': _to_numpy(x)}
+        if self.is_star:
+            inputs['style'] = _to_numpy(s)
+        out = self.session.run(None, inputs)[0]
+        return torch.from_numpy(out)
+
+
+class QuantizedBackend:
+    """
+    Run an int8 TorchScript generator saved by quantize.py on CPU
+    """
+    def __init__(self, model_path, num_threads=0):
+        if num_threads > 0:
+            torch.set_num_threads(num_threads)
+        self.model, meta = load_quantized(model_path)
+        self.is_star = False
+        self.latent_dim = None
+        self.fan_out = False
+        self.guided = meta['guided_filter']
+
+    def __call__(self, x, s=None):
+        with torch.no_grad():
+            return self.model(x.cpu())
+
+
+def mapping_path(onnx_path):
+    return onnx_path[:-len('.onnx')] + '_map.onnx' if onnx_path.endswith('.onnx') else onnx_path + '_map'
+
+
+def _to_numpy(x):
+    if isinstance(x, torch.Tensor):
+        x = x.detach().cpu().numpy()
+    return np.ascontiguousarray(x)
+
+
+def build_backend(name, model=None, model_path=None, device='cpu', num_threads=0):
+    """
+    :param model: inference module for the torch backend
+    :param model_path: exported onnx model or int8 torchscript model for the other backends
+    """
+    if name == 'torch':
+        backend = TorchBackend(model, device, num_threads)
+    elif name == 'onnx':
+        backend = OnnxBackend(model_path, num_threads)
+    elif name == 'int8':
+        backend = QuantizedBackend(model_path, num_threads)
+    else:
+        raise NotImplementedError
+    return backend
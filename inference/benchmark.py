@@ -0,0 +1,36 @@
+import time
+import torch
+import numpy as np
+
+__all__ = ['benchmark_backend']
+
+
+def benchmark_backend(backend, image_size=256, batch_size=1, iters=20, warmup=3):
+    """
+    Measure latency and throughput of an inference backend on random inputs
+
+    :return: dict with mean/p50/p90 latency in ms and images per second
+    """
+    x = torch.rand((batch_size, 3, image_size, image_size)) * 2 - 1
+    s = None
+    if backend.is_star:
+        z = torch.randn((batch_size, backend.latent_dim))
+        s = backend.style(z, torch.zeros((batch_size,), dtype=torch.long))
+
+    for _ in range(warmup):
+        backend(x, s)
+
+    latencies = []
+    for _ in range(iters):
+        start = time.perf_counter()
+        backend(x, s)
+        latencies.append((time.perf_counter() - start) * 1000)
+    latencies = np.asarray(latencies)
+    return {
+        'image_size': image_size,
+        'batch_size': batch_size,
+        'latency_ms': float(latencies.mean()),
+        'latency_p50_ms': float(np.percentile(latencies, 50)),
+        'latency_p90_ms': float(np.percentile(latencies, 90)),
+        'images_per_sec': float(batch_size * 1000 / latencies.mean()),
+    }
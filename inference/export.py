@@ -0,0 +1,73 @@
+import torch
+import numpy as np
+from .backends import mapping_path
+
+__all__ = ['export_onnx', 'check_parity']
+
+
+def export_onnx(model, onnx_path, image_size=256, batch_size=1, opset=11):
+    """
+    Export an inference module to ONNX with dynamic batch, height and width axes
+
+    :param model: CartoonGenerator or StarCartoonGenerator
+    :param onnx_path: output path, stargan additionally writes the mapping network to '*_map.onnx'
+    """
+    model = model.cpu().eval()
+    is_star = hasattr(model, 'map_net')
+    x = torch.randn((batch_size, 3, image_size, image_size))
+    image_axes = {0: 'batch', 2: 'height', 3: 'width'}
+
+    with torch.no_grad():
+        if is_star:
+            z = torch.randn((batch_size, model.latent_dim))
+            y = torch.zeros((batch_size,), dtype=torch.long)
+            s = model.style(z, y)
+            torch.onnx.export(model, (x, s), onnx_path, opset_version=opset,
+                              input_names=['input', 'style'], output_names=['output'],
+                              dynamic_axes={'input': image_axes, 'style': {0: 'batch'}, 'output': image_axes})
+            torch.onnx.export(model.map_net, (z, y), mapping_path(onnx_path), opset_version=opset,
+                              input_names=['latent', 'label'], output_names=['style'],
+                              dynamic_axes={'latent': {0: 'batch'}, 'label': {0: 'batch'}, 'style': {0: 'batch'}})
+        else:
+            torch.onnx.export(model, x, onnx_path, opset_version=opset,
+                              input_names=['input'], output_names=['output'],
+                              dynamic_axes={'input': image_axes, 'output': image_axes})
+
+    _add_metadata(onnx_path, {'model': 'stargan' if is_star else 'generator',
+                              'guided_filter': '1' if model.guided else '0'})
+    return onnx_path
+
+
+def _add_metadata(onnx_path, metadata):
+    import onnx
+    onnx_model = onnx.load(onnx_path)
+    for key, value in metadata.items():
+        prop = onnx_model.metadata_props.add()
+        prop.key = key
+        prop.value = value
+    onnx.save(onnx_model, onnx_path)
+
+
+def check_parity(model, backend, image_sizes=(128, 256), batch_size=2, atol=1e-3):
+    """
+    Compare backend outputs with the PyTorch module on random inputs
+
+    :return: list of (image_size, max abs error, passed)
+    """
+    model = model.cpu().eval()
+    is_star = hasattr(model, 'map_net')
+    results = []
+    with torch.no_grad():
+        for image_size in image_sizes:
+            x = torch.rand((batch_size, 3, image_size, image_size)) * 2 - 1
+            if is_star:
+                z = torch.randn((batch_size, model.latent_dim))
+                y = torch.arange(batch_size) % model.map_net.num_domains
+                ref = model(x, model.style(z, y))
+                out = backend(x, backend.style(z, y))
+            else:
+                ref = model(x)
+                out = backend(x)
+            err = np.abs(out.numpy() - ref.numpy()).max()
+            results.append((image_size, float(err), bool(err <= atol)))
+    return results
@@ -0,0 +1,107 @@
+import os
+import json
+import torch
+from easydict import EasyDict as edict
+from models import Generator, StarGenerator, MappingNetwork
+from utils.misc import read_json
+from .modules import CartoonGenerator, StarCartoonGenerator
+from .weights import save_weights, load_weights, read_metadata
+
+WEIGHTS_EXT = '.safetensors'
+
+
+def load_checkpoint_config(checkpoint_path):
+    """ load config.json of the experiment a checkpoint belongs to, or the config stored with exported weights """
+    if checkpoint_path.endswith(WEIGHTS_EXT):
+        return edict(json.loads(read_metadata(checkpoint_path)['config']))
+    checkpoint_dir = os.path.dirname(checkpoint_path)
+    exp_dir = os.path.dirname(checkpoint_dir)
+    config = read_json(os.path.join(exp_dir, 'config.json'))
+    return edict(config)
+
+
+def build_generator(config, guided=None):
+    """
+    Build the inference module of an experiment
+
+    :param config: experiment config (config.json)
+    :param guided: append the whitebox guided filter, defaults to True for whitebox experiments
+    """
+    if config.exp_name == 'stargan':
+        gen = StarGenerator(config.image_size, config.down_size, config.num_res, config.skip_conn, config.style_size)
+        map_net = MappingNetwork(latent_dim=config.latent_size, style_dim=config.style_size, num_domains=4)
+        return StarCartoonGenerator(gen, map_net)
+
+    if guided is None:
+        guided = config.exp_name == 'whitebox'
+    gen = Generator(config.image_size, config.down_size, config.num_res, config.skip_conn)
+    return CartoonGenerator(gen, guided=guided)
+
+
+def load_generator(checkpoint_path, device='cpu', config=None, guided=None, ema=True):
+    """
+    Load the generator (and mapping network for stargan) from a training checkpoint, or from weights exported by
+    export_generator_weights, which are memory-mapped instead of unpickled
+
+    :param ema: use the moving average weights of the checkpoint when it has them, model.ema tells if it did
+    :return: inference module in eval mode and the experiment config
+    """
+    if checkpoint_path.endswith(WEIGHTS_EXT):
+        return _load_generator_weights(checkpoint_path, device, config, guided, ema)
+    if config is None:
+        config = load_checkpoint_config(checkpoint_path)
+    model = build_generator(config, guided)
+
+    checkpoint = torch.load(checkpoint_path, map_location=device)
+    if ema and 'ema' in checkpoint:
+        model.gen.load_state_dict(checkpoint['ema']['gen'])
+        if config.exp_name == 'stargan':
+            model.map_net.load_state_dict(checkpoint['ema']['map_net'])
+        model.ema = True
+    else:
+        if config.exp_name == 'cyclegan':
+            model.gen.load_state_dict(checkpoint['gen_src_tar_state_dict'])
+        else:
+            model.gen.load_state_dict(checkpoint['gen_state_dict'])
+        if config.exp_name == 'stargan':
+            model.map_net.load_state_dict(checkpoint['map_state_dict'])
+    del checkpoint
+
+    model.to(device)
+    model.eval()
+    return model, config
+
+
+def _load_generator_weights(weights_path, device='cpu', config=None, guided=None, ema=True):
+    # exported files hold one set of weights, chosen by export_generator_weights
+    has_ema = read_metadata(weights_path).get('ema') == 'True'
+    if has_ema and not ema:
+        raise ValueError('{} holds the moving average weights, export the trained ones with '
+                         'export_weights.py --no-ema'.format(weights_path))
+    if config is None:
+        config = load_checkpoint_config(weights_path)
+    model = build_generator(config, guided)
+    model.load_state_dict(load_weights(weights_path))
+    model.ema = has_ema
+    model.to(device)
+    model.eval()
+    return model, config
+
+
+def export_generator_weights(checkpoint_path, weights_path=None, half=False, ema=True):
+    """
+    Write the inference weights of a training checkpoint (no optimizers or discriminators) in the safetensors
+    layout, with the experiment config as metadata
+
+    :param weights_path: defaults to the checkpoint path with .safetensors
+    :param half: store floating point weights as float16, they are cast back to float32 when loaded
+    :param ema: export the moving average weights when the checkpoint has them
+    :return: path of the weights
+    """
+    weights_path = weights_path or os.path.splitext(checkpoint_path)[0] + WEIGHTS_EXT
+    model, config = load_generator(checkpoint_path, device='cpu', ema=ema)
+    state_dict = model.state_dict()
+    if half:
+        state_dict = {name: t.half() if t.is_floating_point() else t for name, t in state_dict.items()}
+    save_weights(state_dict, weights_path, metadata={'config': json.dumps(config), 'ema': model.ema, 'format': 'pt'})
+    return weights_path
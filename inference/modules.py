@@ -0,0 +1,44 @@
+import torch.nn as nn
+from utils.wb_utils import guided_filter
+
+__all__ = ['CartoonGenerator', 'StarCartoonGenerator']
+
+
+class CartoonGenerator(nn.Module):
+    """
+    Generator with the optional whitebox guided filter post-process
+    """
+    def __init__(self, gen, guided=False):
+        super(CartoonGenerator, self).__init__()
+        self.gen = gen
+        self.guided = guided
+        # loaded with the moving average weights of training
+        self.ema = False
+
+    def forward(self, x):
+        out = self.gen(x)
+        if self.guided:
+            out = guided_filter(out, x, r=1)
+        return out
+
+
+class StarCartoonGenerator(nn.Module):
+    """
+    StarGenerator and MappingNetwork, styles are computed separately so they can be reused
+    """
+    def __init__(self, gen, map_net):
+        super(StarCartoonGenerator, self).__init__()
+        self.gen = gen
+        self.map_net = map_net
+        self.guided = False
+        self.ema = False
+
+    @property
+    def latent_dim(self):
+        return self.map_net.shared[0].in_features
+
+    def style(self, z, y):
+        return self.map_net(z, y)
+
+    def forward(self, x, s):
+        return self.gen(x, s)
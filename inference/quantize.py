@@ -0,0 +1,143 @@
+import json
+import torch
+import torch.nn as nn
+from torch.quantization import QuantStub, DeQuantStub
+from models.generator import Generator, ResConv
+from models.utils import InstanceNorm
+from .modules import CartoonGenerator
+
+__all__ = ['QuantizableGenerator', 'quantize_generator', 'quantize_cartoon_generator', 'calibrate',
+           'save_quantized', 'load_quantized']
+
+
+class FloatIsland(nn.Module):
+    """
+    Run a module without int8 kernels (InstanceNorm, ReflectionPad2d) in float between dequant/quant stubs
+    """
+    def __init__(self, module):
+        super(FloatIsland, self).__init__()
+        self.dequant = DeQuantStub()
+        self.module = module
+        self.module.qconfig = None
+        self.quant = QuantStub()
+
+    def forward(self, x):
+        return self.quant(self.module(self.dequant(x)))
+
+
+class QuantizableResConv(ResConv):
+    def __init__(self, in_dim, out_dim, kernel_size):
+        super(QuantizableResConv, self).__init__(in_dim, out_dim, kernel_size)
+        self.skip_add = nn.quantized.FloatFunctional()
+
+    def forward(self, x):
+        identity = x
+
+        out = self.pad1(x)
+        out = self.conv1(out)
+        out = self.norm1(out)
+        out = self.act1(out)
+
+        out = self.pad2(out)
+        out = self.conv2(out)
+        out = self.norm2(out)
+
+        out = self.skip_add.add(out, identity)
+        out = self.act2(out)
+        return out
+
+
+class QuantizableGenerator(Generator):
+    """
+    Generator with quant stubs and quantizable residual adds / skip concatenations
+    """
+    def __init__(self, image_size=256, down_size=64, num_res=8, skip_conn=False):
+        super(QuantizableGenerator, self).__init__(image_size, down_size, num_res, skip_conn)
+        feat_dim = 64 * 2 ** self.num_down
+        self.res_layers = nn.Sequential(*[QuantizableResConv(feat_dim, feat_dim, 3) for _ in range(self.num_res)])
+        self.skip_cats = nn.ModuleList([nn.quantized.FloatFunctional() for _ in range(self.num_down)])
+        self.quant = QuantStub()
+        self.dequant = DeQuantStub()
+
+    def forward(self, x):
+        x = self.quant(x)
+        out, down = self.forward_encoder(x)
+
+        for i, up_layer in enumerate(self.up_layers):
+            if self.skip_conn:
+                en = down[i]
+                out = self.skip_cats[i].cat([out, en], dim=1)
+            out = up_layer(out)
+
+        out = self.conv_out(out)
+        return self.dequant(out)
+
+
+def _wrap_float_islands(module):
+    for name, child in module.named_children():
+        if isinstance(child, (InstanceNorm, nn.ReflectionPad2d)):
+            setattr(module, name, FloatIsland(child))
+        elif isinstance(child, nn.ConvTranspose2d) and not hasattr(nn.quantized, 'ConvTranspose2d'):
+            setattr(module, name, FloatIsland(child))
+        elif not isinstance(child, FloatIsland):
+            _wrap_float_islands(child)
+
+
+def calibrate(model, data_loader, num_images=256):
+    """ feed calibration images through a prepared model so the observers collect activation ranges """
+    seen = 0
+    with torch.no_grad():
+        for src_imgs in data_loader:
+            model(src_imgs)
+            seen += src_imgs.size(0)
+            if seen >= num_images:
+                break
+    return seen
+
+
+def quantize_generator(gen, data_loader, num_images=256, engine='fbgemm'):
+    """
+    Post-training static int8 quantization of a Generator
+
+    :param gen: trained float Generator
+    :param data_loader: calibration images, e.g. CartoonDefaultDataLoader
+    :param engine: quantized engine, 'fbgemm' for x86
+    """
+    torch.backends.quantized.engine = engine
+    qgen = QuantizableGenerator(gen.image_size, gen.down_size, gen.num_res, gen.skip_conn)
+    qgen.load_state_dict(gen.state_dict())
+    qgen.cpu().eval()
+    _wrap_float_islands(qgen)
+
+    qgen.qconfig = torch.quantization.get_default_qconfig(engine)
+    # transposed convs only support per-tensor weight quantization
+    for module in qgen.modules():
+        if isinstance(module, nn.ConvTranspose2d) and getattr(module, 'qconfig', True) is not None:
+            module.qconfig = torch.quantization.QConfig(activation=qgen.qconfig.activation,
+                                                        weight=torch.quantization.default_weight_observer)
+    torch.quantization.prepare(qgen, inplace=True)
+    calibrate(qgen, data_loader, num_images)
+    torch.quantization.convert(qgen, inplace=True)
+    return qgen
+
+
+def save_quantized(model, path, image_size=256):
+    """ save an int8 CartoonGenerator as TorchScript, the guided filter flag is kept as an extra file """
+    model.eval()
+    with torch.no_grad():
+        traced = torch.jit.trace(model, torch.rand((1, 3, image_size, image_size)) * 2 - 1)
+    extra_files = {'meta.json': json.dumps({'guided_filter': bool(model.guided)})}
+    torch.jit.save(traced, path, _extra_files=extra_files)
+
+
+def load_quantized(path, engine='fbgemm'):
+    torch.backends.quantized.engine = engine
+    extra_files = {'meta.json': ''}
+    model = torch.jit.load(path, map_location='cpu', _extra_files=extra_files)
+    meta = json.loads(extra_files['meta.json'])
+    return model.eval(), meta
+
+
+def quantize_cartoon_generator(model, data_loader, num_images=256, engine='fbgemm'):
+    """ quantize the generator of a CartoonGenerator, the guided filter stays in float """
+    return CartoonGenerator(quantize_generator(model.gen, data_loader, num_images, engine), guided=model.guided)
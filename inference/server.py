@@ -0,0 +1,294 @@
+import json
+import time
+import logging
+import asyncio
+import bisect
+import http.client
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse, parse_qs
+import cv2
+import numpy as np
+import torch
+from .style import StyleBank
+
+logger = logging.getLogger('Serving')
+
+__all__ = ['LatencyHistogram', 'DynamicBatcher', 'CartoonServer', 'request_cartoonize']
+
+
+class LatencyHistogram:
+    """
+    Fixed bucket latency histogram in milliseconds
+    """
+    BUCKETS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, float('inf')]
+
+    def __init__(self):
+        self.counts = [0] * len(self.BUCKETS)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.BUCKETS, value)] += 1
+        self.count += 1
+        self.total += value
+
+    def quantile(self, q):
+        """ upper bucket bound of the q-quantile """
+        if self.count == 0:
+            return 0.0
+        target = q * self.count
+        seen = 0
+        for bound, count in zip(self.BUCKETS, self.counts):
+            seen += count
+            if seen >= target:
+                return bound
+        return self.BUCKETS[-1]
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else 0.0,
+            'p50': self.quantile(0.5),
+            'p90': self.quantile(0.9),
+            'p99': self.quantile(0.99),
+            'buckets': {str(bound): count for bound, count in zip(self.BUCKETS, self.counts)},
+        }
+
+
+def observe(stats, name, value):
+    if name not in stats:
+        stats[name] = LatencyHistogram()
+    stats[name].observe(value)
+
+
+class DynamicBatcher:
+    """
+    Coalesce concurrent requests into batches of at most max_batch_size, waiting at most max_latency_ms
+    after the first request of a batch, and run them on a worker pool.
+
+    :param run_batch: blocking function mapping a list of request payloads to a list of results
+    """
+    def __init__(self, run_batch, max_batch_size=8, max_latency_ms=10, num_workers=2, stats=None):
+        self.run_batch = run_batch
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency_ms / 1000
+        self.executor = ThreadPoolExecutor(max_workers=num_workers)
+        self.slots = None
+        self.num_workers = num_workers
+        self.queue = None
+        self.stats = stats if stats is not None else {}
+        self._task = None
+
+    def start(self):
+        self.queue = asyncio.Queue()
+        self.slots = asyncio.Semaphore(self.num_workers)
+        self._task = asyncio.ensure_future(self._collect())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+        self.executor.shutdown(wait=True)
+
+    async def submit(self, payload):
+        future = asyncio.get_event_loop().create_future()
+        await self.queue.put((payload, future, time.perf_counter()))
+        return await future
+
+    async def _collect(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = batch[0][2] + self.max_latency
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            # wait for a free worker so batches keep growing while all workers are busy
+            await self.slots.acquire()
+            while len(batch) < self.max_batch_size and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            loop.create_task(self._run(batch))
+
+    async def _run(self, batch):
+        loop = asyncio.get_event_loop()
+        start = time.perf_counter()
+        for _, _, arrival in batch:
+            self._observe('queue', (start - arrival) * 1000)
+        self._observe('batch_size', len(batch))
+        try:
+            results = await loop.run_in_executor(self.executor, self.run_batch, [payload for payload, _, _ in batch])
+            for (_, future, _), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+        except Exception as e:
+            for _, future, _ in batch:
+                if not future.done():
+                    future.set_exception(e)
+        finally:
+            self.slots.release()
+        self._observe('inference', (time.perf_counter() - start) * 1000)
+
+    def _observe(self, name, value):
+        observe(self.stats, name, value)
+
+
+class CartoonServer:
+    """
+    Local HTTP inference service
+
+    POST /cartoonize?format=png|jpeg[&style=<domain>&seed=<seed>] with an encoded image body returns the
+    cartoonized image, GET /metrics returns per-stage latency histograms and GET /health returns ok.
+    StarGAN requests without a seed use the canonical style of their domain.
+    """
+    def __init__(self, backend, image_size=256, max_batch_size=8, max_latency_ms=10, num_workers=2, num_domains=4):
+        self.backend = backend
+        self.image_size = image_size
+        self.styles = StyleBank(backend, num_domains) if backend.is_star else None
+        self.stats = {}
+        self.batcher = DynamicBatcher(self._run_batch, max_batch_size, max_latency_ms, num_workers, self.stats)
+        self.executor = ThreadPoolExecutor(max_workers=num_workers)
+
+    def _observe(self, name, value):
+        observe(self.stats, name, value)
+
+    def preprocess(self, data):
+        """ decode, resize the short side, center crop and normalize to [-1, 1] """
+        img = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+        if img is None:
+            raise ValueError('could not decode image')
+        img = img[:, :, ::-1]
+        h, w = img.shape[:2]
+        scale = self.image_size / min(h, w)
+        img = cv2.resize(img, (max(self.image_size, round(w * scale)), max(self.image_size, round(h * scale))),
+                         interpolation=cv2.INTER_LINEAR)
+        h, w = img.shape[:2]
+        top, left = (h - self.image_size) // 2, (w - self.image_size) // 2
+        img = img[top:top + self.image_size, left:left + self.image_size]
+        img = torch.from_numpy(np.ascontiguousarray(img.transpose(2, 0, 1))).float()
+        return img / 127.5 - 1
+
+    @staticmethod
+    def encode(img, fmt='png'):
+        img = ((img.numpy().transpose(1, 2, 0) + 1) / 2 * 255).clip(0, 255).astype(np.uint8)
+        ok, buf = cv2.imencode('.jpg' if fmt == 'jpeg' else '.png', img[:, :, ::-1])
+        if not ok:
+            raise RuntimeError('encoding the output as {} failed'.format(fmt))
+        return buf.tobytes()
+
+    def _run_batch(self, payloads):
+        x = torch.stack([payload['image'] for payload in payloads])
+        s = None
+        if self.backend.is_star:
+            # styles of different domains share one generator forward
+            s = self.styles.styles([payload['style'] for payload in payloads], [payload['seed'] for payload in payloads])
+        out = self.backend(x, s)
+        return list(out)
+
+    async def cartoonize(self, data, fmt='png', style=0, seed=None):
+        if self.styles is not None and not 0 <= style < self.styles.num_domains:
+            raise ValueError('unknown style {}'.format(style))
+        loop = asyncio.get_event_loop()
+        start = time.perf_counter()
+        image = await loop.run_in_executor(self.executor, self.preprocess, data)
+        self._observe('preprocess', (time.perf_counter() - start) * 1000)
+
+        out = await self.batcher.submit({'image': image, 'style': style, 'seed': seed})
+
+        encode_start = time.perf_counter()
+        body = await loop.run_in_executor(self.executor, self.encode, out, fmt)
+        self._observe('encode', (time.perf_counter() - encode_start) * 1000)
+        self._observe('total', (time.perf_counter() - start) * 1000)
+        return body
+
+    def metrics(self):
+        metrics = {name: hist.snapshot() for name, hist in self.stats.items()}
+        if self.styles is not None:
+            metrics['style_cache'] = {'hits': self.styles.hits, 'misses': self.styles.misses, 'size': len(self.styles.cache)}
+        return metrics
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, target, _ = request_line.decode('latin-1').split(' ', 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    key, value = line.decode('latin-1').split(':', 1)
+                    headers[key.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+
+                url = urlparse(target)
+                query = {k: v[0] for k, v in parse_qs(url.query).items()}
+                status, content_type, payload = await self._route(method, url.path, query, body)
+                await self._respond(writer, status, content_type, payload)
+                if headers.get('connection', '').lower() == 'close':
+                    break
+        except (asyncio.IncompleteReadError, ConnectionResetError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def _route(self, method, path, query, body):
+        if method == 'GET' and path == '/health':
+            return 200, 'text/plain', b'ok'
+        if method == 'GET' and path == '/metrics':
+            return 200, 'application/json', json.dumps(self.metrics()).encode()
+        if method == 'POST' and path == '/cartoonize':
+            fmt = query.get('format', 'png')
+            try:
+                seed = int(query['seed']) if 'seed' in query else None
+                data = await self.cartoonize(body, fmt, int(query.get('style', 0)), seed)
+            except ValueError as e:
+                return 400, 'text/plain', str(e).encode()
+            except Exception as e:
+                # e.g. out of memory in the model, answer instead of dropping the connection
+                logger.exception('cartoonize failed')
+                return 500, 'text/plain', '{}: {}'.format(type(e).__name__, e).encode()
+            return 200, 'image/jpeg' if fmt == 'jpeg' else 'image/png', data
+        return 404, 'text/plain', b'not found'
+
+    @staticmethod
+    async def _respond(writer, status, content_type, payload, chunk_size=1 << 16):
+        reason = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 500: 'Internal Server Error'}.get(status, '')
+        writer.write('HTTP/1.1 {} {}\r\nContent-Type: {}\r\nContent-Length: {}\r\n\r\n'.format(
+            status, reason, content_type, len(payload)).encode('latin-1'))
+        # stream the body so large images do not sit in the transport buffer
+        for i in range(0, len(payload), chunk_size):
+            writer.write(payload[i:i + chunk_size])
+            await writer.drain()
+        await writer.drain()
+
+    async def serve(self, host='127.0.0.1', port=8080):
+        self.batcher.start()
+        try:
+            server = await asyncio.start_server(self.handle, host, port)
+            async with server:
+                await server.serve_forever()
+        finally:
+            await self.batcher.stop()
+            self.executor.shutdown(wait=True)
+
+
+def request_cartoonize(data, host='127.0.0.1', port=8080, fmt='png', style=0, seed=None):
+    """ blocking client for the local service, returns the encoded output image """
+    conn = http.client.HTTPConnection(host, port)
+    target = '/cartoonize?format={}&style={}'.format(fmt, style)
+    if seed is not None:
+        target += '&seed={}'.format(seed)
+    conn.request('POST', target, body=data,
+                 headers={'Content-Type': 'application/octet-stream'})
+    response = conn.getresponse()
+    body = response.read()
+    conn.close()
+    if response.status != 200:
+        raise RuntimeError('{} {}'.format(response.status, body.decode(errors='replace')))
+    return body
@@ -0,0 +1,81 @@
+import threading
+import torch
+from collections import OrderedDict
+
+__all__ = ['StyleBank']
+
+
+class StyleBank:
+    """
+    Style vectors for StarGenerator inference
+
+    Canonical styles are the average mapped style of each domain and computed once, seeded styles are
+    kept in an LRU cache keyed by (domain, seed). Styles of a batch may mix domains, so a single
+    StarGenerator forward serves requests for different styles.
+
+    :param backend: inference backend with a style(z, y) method
+    """
+    def __init__(self, backend, num_domains=4, num_samples=1000, cache_size=1024):
+        self.backend = backend
+        self.num_domains = num_domains
+        self.latent_dim = backend.latent_dim
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.canonical = self._average_styles(num_samples)
+
+    def _average_styles(self, num_samples):
+        generator = torch.Generator().manual_seed(0)
+        z = torch.randn((self.num_domains * num_samples, self.latent_dim), generator=generator)
+        y = torch.arange(self.num_domains).repeat_interleave(num_samples)
+        s = self.backend.style(z, y)
+        return s.view(self.num_domains, num_samples, -1).mean(dim=1)
+
+    def canonical_styles(self, labels):
+        return self.canonical[torch.as_tensor(labels, dtype=torch.long)]
+
+    def random_styles(self, labels):
+        labels = torch.as_tensor(labels, dtype=torch.long)
+        z = torch.randn((labels.size(0), self.latent_dim))
+        return self.backend.style(z, labels)
+
+    def seeded_styles(self, labels, seeds):
+        with self.lock:
+            return self._seeded_styles(labels, seeds)
+
+    def _seeded_styles(self, labels, seeds):
+        keys = [(int(label), int(seed)) for label, seed in zip(labels, seeds)]
+        misses = [key for key in OrderedDict.fromkeys(keys) if key not in self.cache]
+        if len(misses) > 0:
+            # map all missing latents in one call
+            z = torch.stack([torch.randn((self.latent_dim,), generator=torch.Generator().manual_seed(seed))
+                             for _, seed in misses])
+            s = self.backend.style(z, torch.LongTensor([label for label, _ in misses]))
+            for key, style in zip(misses, s):
+                self.cache[key] = style
+        self.misses += len(misses)
+        self.hits += len(keys) - len(misses)
+
+        styles = []
+        for key in keys:
+            self.cache.move_to_end(key)
+            styles.append(self.cache[key])
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return torch.stack(styles)
+
+    def styles(self, labels, seeds=None):
+        """
+        Styles of a mixed batch, samples without a seed get the canonical style of their domain
+
+        :param labels: target domain of each sample
+        :param seeds: latent seed of each sample or None
+        """
+        styles = self.canonical_styles(labels).clone()
+        if seeds is not None:
+            seeded = [i for i, seed in enumerate(seeds) if seed is not None]
+            if len(seeded) > 0:
+                styles[seeded] = self.seeded_styles([labels[i] for i in seeded], [seeds[i] for i in seeded])
+        return styles
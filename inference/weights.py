@@ -0,0 +1,83 @@
+"""
+Inference weights in the safetensors layout: an 8 byte little-endian header size, a json header with dtype, shape
+and byte offsets of every tensor, then the raw tensor data. Files can be read by the safetensors package, and
+load_weights memory-maps them, so only the pages of the tensors that are used are read
+"""
+import json
+import struct
+import numpy as np
+import torch
+
+__all__ = ['save_weights', 'load_weights', 'read_metadata']
+
+DTYPES = {
+    torch.float32: ('F32', np.float32),
+    torch.float16: ('F16', np.float16),
+    torch.float64: ('F64', np.float64),
+    torch.int64: ('I64', np.int64),
+    torch.int32: ('I32', np.int32),
+    torch.uint8: ('U8', np.uint8),
+    torch.int8: ('I8', np.int8),
+    torch.bool: ('BOOL', np.bool_),
+}
+NUMPY_DTYPES = {name: np_dtype for name, np_dtype in DTYPES.values()}
+
+
+def save_weights(tensors, path, metadata=None):
+    """
+    :param tensors: dict of name to tensor, e.g. a state dict
+    :param metadata: dict of str to str stored in the header
+    """
+    header = {}
+    offset = 0
+    arrays = []
+    for name, tensor in tensors.items():
+        if tensor.dtype not in DTYPES:
+            raise TypeError("Unsupported dtype {} of '{}'".format(tensor.dtype, name))
+        array = tensor.detach().cpu().contiguous().numpy()
+        header[name] = {'dtype': DTYPES[tensor.dtype][0], 'shape': list(array.shape),
+                        'data_offsets': [offset, offset + array.nbytes]}
+        offset += array.nbytes
+        arrays.append(array)
+    if metadata:
+        header['__metadata__'] = {str(key): str(value) for key, value in metadata.items()}
+
+    header = json.dumps(header, separators=(',', ':')).encode('utf-8')
+    # pad the header so the data starts 8 byte aligned
+    header += b' ' * (-len(header) % 8)
+    with open(path, 'wb') as f:
+        f.write(struct.pack('<Q', len(header)))
+        f.write(header)
+        for array in arrays:
+            f.write(array.tobytes())
+
+
+def _read_header(path):
+    with open(path, 'rb') as f:
+        size = struct.unpack('<Q', f.read(8))[0]
+        header = json.loads(f.read(size).decode('utf-8'))
+    return header, 8 + size
+
+
+def read_metadata(path):
+    """ metadata dict of a weights file, without reading the tensors """
+    return _read_header(path)[0].get('__metadata__', {})
+
+
+def load_weights(path, device='cpu'):
+    """
+    Memory-map the tensors of a weights file
+
+    :param device: tensors are moved there, on cpu they stay backed by the file
+    :return: dict of name to tensor
+    """
+    header, data_start = _read_header(path)
+    header.pop('__metadata__', None)
+    # copy-on-write, the tensors are writable without touching the file
+    data = np.memmap(path, dtype=np.uint8, mode='c', offset=data_start)
+    tensors = {}
+    for name, info in header.items():
+        begin, end = info['data_offsets']
+        array = data[begin:end].view(NUMPY_DTYPES[info['dtype']]).reshape(info['shape'])
+        tensors[name] = torch.from_numpy(array).to(device)
+    return tensors
@@ -1,4 +1,5 @@
 from .gan_loss import *
 from .whitebox_loss import *
 from .percep_loss import *
-from .patch_nce_loss import *
\ No newline at end of file
+from .patch_nce_loss import *
+from .feature_cache import *
@@ -0,0 +1,96 @@
+import os
+from collections import OrderedDict
+import numpy as np
+import torch
+
+__all__ = ['FeatureCache']
+
+
+class FeatureCache:
+    """
+    LRU cache of per-image feature maps (e.g. VGG features of source images), stored as fp16 on the host.
+    Features are kept in memory, or in np.memmap files under cache_dir to bound the resident memory.
+    """
+    def __init__(self, capacity, cache_dir=None, name='features'):
+        """
+        :param capacity: maximum number of cached images, the least recently used one is evicted
+        :param cache_dir: directory for the memmap files, None to keep the features in memory
+        :param name: prefix of the memmap files
+        """
+        self.capacity = capacity
+        self.cache_dir = cache_dir
+        self.name = name
+        self.slots = OrderedDict()  # key -> row in storage, in lru order
+        self.free_slots = list(range(capacity))
+        self.storage = None  # one (capacity, C, H, W) array per feature layer, allocated on the first put
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.slots)
+
+    def __contains__(self, key):
+        return key in self.slots
+
+    def _allocate(self, feats):
+        self.storage = []
+        for i, feat in enumerate(feats):
+            shape = (self.capacity,) + tuple(feat.shape[1:])
+            if self.cache_dir is None:
+                self.storage.append(np.empty(shape, dtype=np.float16))
+            else:
+                os.makedirs(self.cache_dir, exist_ok=True)
+                path = os.path.join(self.cache_dir, '{}_{}.npy'.format(self.name, i))
+                self.storage.append(np.lib.format.open_memmap(path, mode='w+', dtype=np.float16, shape=shape))
+
+    def get(self, keys, device):
+        """
+        :param keys: hashable key of every image in the batch, e.g. (path, crop params)
+        :return: list of float features per layer (batch, C, H, W) on device, None unless every key is cached
+        """
+        if self.storage is None or any(key not in self.slots for key in keys):
+            self.misses += len(keys)
+            return None
+        slots = []
+        for key in keys:
+            self.slots.move_to_end(key)
+            slots.append(self.slots[key])
+        self.hits += len(keys)
+        return [torch.from_numpy(storage[slots]).to(device).float() for storage in self.storage]
+
+    def put(self, keys, feats):
+        """
+        :param keys: hashable key of every image in the batch
+        :param feats: list of features per layer (batch, C, H, W)
+        :return: the features rounded to fp16 as they are cached, in float on their device, so losses on a miss
+            match those on later hits
+        """
+        rounded = [feat.detach().half().float() for feat in feats]
+        if self.capacity <= 0:
+            return rounded
+        if self.storage is None:
+            self._allocate(feats)
+        feats = [feat.to('cpu').numpy() for feat in rounded]
+        for i, key in enumerate(keys):
+            if key in self.slots:
+                self.slots.move_to_end(key)
+                slot = self.slots[key]
+            else:
+                if self.free_slots:
+                    slot = self.free_slots.pop()
+                else:
+                    _, slot = self.slots.popitem(last=False)
+                self.slots[key] = slot
+            for storage, feat in zip(self.storage, feats):
+                storage[slot] = feat[i]
+        return rounded
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'size': len(self.slots),
+            'capacity': self.capacity,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total > 0 else 0.0,
+        }
@@ -7,6 +7,9 @@ __all__ = ['BCEGANLoss', 'LSGANLoss', 'WGANGPLoss']
 
 
 class BCEGANLoss(nn.Module):
+    # decision boundary of the raw discriminator outputs on real vs fake
+    real_threshold = 0.0
+
     def __init__(self):
         super(BCEGANLoss, self).__init__()
         self.bce_loss = nn.BCELoss()
@@ -26,6 +29,8 @@ class BCEGANLoss(nn.Module):
 
 
 class LSGANLoss(nn.Module):
+    real_threshold = 0.5
+
     def __init__(self):
         super(LSGANLoss, self).__init__()
         self.mse_loss = nn.MSELoss()
@@ -44,6 +49,8 @@ class LSGANLoss(nn.Module):
 
 
 class WGANGPLoss(nn.Module):
+    real_threshold = 0.0
+
     def __init__(self, lambda_=10):
         super(WGANGPLoss, self).__init__()
         self.lambda_ = lambda_
@@ -1,45 +1,67 @@
-from packaging import version
+from functools import partial
 import torch
 from torch import nn
+from torch.utils.checkpoint import checkpoint
 
 
 class PatchNCELoss(nn.Module):
-    def __init__(self, tau):
+    def __init__(self, tau, chunk_size=1024, include_all_negatives=True):
+        """
+        :param tau: temperature
+        :param chunk_size: number of query patches whose logits are computed at once, the full
+                           npatches x npatches similarity matrix is never built
+        :param include_all_negatives: take negatives from the patches of all images in the batch, otherwise
+                                      only from the patches of the same image
+        """
         super().__init__()
         self.tau = tau
-        self.cross_entropy_loss = torch.nn.CrossEntropyLoss(reduction='none')
-        self.mask_dtype = torch.uint8 if version.parse(torch.__version__) < version.parse('1.2.0') else torch.bool
+        self.chunk_size = chunk_size
+        self.include_all_negatives = include_all_negatives
 
-    def forward(self, feat_q, feat_k):
-        batchSize = feat_q.shape[0]
+    def forward(self, feat_q, feat_k, batch_size=1):
+        """
+        :param feat_q: (batch_size * npatches, dim) query features, image major as returned by PatchSampleF
+        :param feat_k: (batch_size * npatches, dim) key features
+        :param batch_size: number of images in feat_q, used for per image negatives
+        :return: loss of every query patch (batch_size * npatches, )
+        """
         dim = feat_q.shape[1]
         feat_k = feat_k.detach()
 
         # pos logit
-        l_pos = torch.bmm(feat_q.view(batchSize, 1, -1), feat_k.view(batchSize, -1, 1))
-        l_pos = l_pos.view(batchSize, 1)
+        l_pos = (feat_q * feat_k).sum(dim=1) / self.tau
 
-        # neg logit
-        batch_dim_for_bmm = 1
-
-        # reshape features to batch size
+        # reshape features to (groups, npatches, dim), negatives are the other patches of the same group
+        batch_dim_for_bmm = 1 if self.include_all_negatives else batch_size
         feat_q = feat_q.view(batch_dim_for_bmm, -1, dim)
         feat_k = feat_k.view(batch_dim_for_bmm, -1, dim)
+        l_pos = l_pos.view(batch_dim_for_bmm, -1)
         npatches = feat_q.size(1)
-        l_neg_curbatch = torch.bmm(feat_q, feat_k.transpose(2, 1))
 
-        # diagonal entries are similarity between same features, and hence meaningless.
-        # just fill the diagonal with very small number, which is exp(-10) and almost zero
-        diagonal = torch.eye(npatches, device=feat_q.device, dtype=self.mask_dtype)[None, :, :]
-        l_neg_curbatch.masked_fill_(diagonal, -10.0)
-        l_neg = l_neg_curbatch.view(-1, npatches)
+        loss = []
+        for start in range(0, npatches, self.chunk_size):
+            end = min(start + self.chunk_size, npatches)
+            chunk_loss = partial(self._chunk_loss, start=start)
+            args = (feat_q[:, start:end], feat_k, l_pos[:, start:end])
+            if torch.is_grad_enabled() and feat_q.requires_grad:
+                # recompute the chunk logits in backward instead of keeping them alive
+                loss.append(checkpoint(chunk_loss, *args))
+            else:
+                loss.append(chunk_loss(*args))
+        return torch.cat(loss, dim=1).view(-1)
 
-        out = torch.cat((l_pos, l_neg), dim=1) / self.tau
+    def _chunk_loss(self, feat_q, feat_k, l_pos, start):
+        l_neg = torch.bmm(feat_q, feat_k.transpose(2, 1)) / self.tau  # (groups, chunk, npatches)
 
-        loss = self.cross_entropy_loss(out, torch.zeros(out.size(0), dtype=torch.long,
-                                                        device=feat_q.device))
-        return loss
+        # diagonal entries are similarity between same features, and hence meaningless.
+        # just fill the diagonal with very small number, which is exp(-10) and almost zero
+        diagonal = torch.arange(start, start + feat_q.size(1), device=feat_q.device)
+        diagonal = diagonal.view(1, -1, 1).expand(l_neg.size(0), -1, 1)
+        l_neg = l_neg.scatter(2, diagonal, -10.0 / self.tau)
 
+        # cross entropy with the positive as target
+        logits = torch.cat((l_pos.unsqueeze(2), l_neg), dim=2)
+        return torch.logsumexp(logits, dim=2) - l_pos
 
 
 if __name__ == '__main__':
@@ -48,4 +70,4 @@ if __name__ == '__main__':
 
     loss = PatchNCELoss(0.05)
 
-    out = loss(q, k)
+    out = loss(q.flatten(2).transpose(1, 2).flatten(0, 1), k.flatten(2).transpose(1, 2).flatten(0, 1), batch_size=2)
@@ -7,46 +7,73 @@ __all__ = ['VGGPerceptualLoss']
 
 # VGG loss, Cite from https://gist.github.com/alper111/8233cdb0414b4cb5853f2f730ab95a49
 class VGGPerceptualLoss(nn.Module):
-    def __init__(self, resize=True):
+    # ends of the vgg16 blocks relu1_2, relu2_2, relu3_3, relu4_3
+    block_ends = (4, 9, 16, 23)
+
+    def __init__(self, resize=True, layers=(2,), pretrained=True):
+        """
+        :param resize: resize inputs to 224x224
+        :param layers: indices of the blocks whose features are compared, vgg16 is truncated after the deepest one
+        :param pretrained: load imagenet weights
+        """
         super(VGGPerceptualLoss, self).__init__()
+        self.layers = sorted(layers)
+        features = vgg16(pretrained=pretrained).features
         blocks = []
-        blocks.append(vgg16(pretrained=True).features[:4].eval())
-        blocks.append(vgg16(pretrained=True).features[4:9].eval())
-        blocks.append(vgg16(pretrained=True).features[9:16].eval())
-        blocks.append(vgg16(pretrained=True).features[16:23].eval())
+        start = 0
+        for end in self.block_ends[:self.layers[-1] + 1]:
+            blocks.append(features[start:end].eval())
+            start = end
         for bl in blocks:
-            for p in bl:
+            for p in bl.parameters():
                 p.requires_grad = False
         self.blocks = nn.ModuleList(blocks)
         self.transform = nn.functional.interpolate
-        self.mean = nn.Parameter(torch.tensor([0.485, 0.456, 0.406]).view(1,3,1,1))
-        self.std = nn.Parameter(torch.tensor([0.229, 0.224, 0.225]).view(1,3,1,1))
+        self.register_buffer('mean', torch.tensor([0.485, 0.456, 0.406]).view(1, 3, 1, 1))
+        self.register_buffer('std', torch.tensor([0.229, 0.224, 0.225]).view(1, 3, 1, 1))
         self.resize = resize
 
-    def forward(self, input, target):
-        if input.shape[1] != 3:
-            input = input.repeat(1, 3, 1, 1)
-            target = target.repeat(1, 3, 1, 1)
+    def features(self, x):
+        """
+        :param x: images in [-1, 1]
+        :return: list of features of the compared blocks
+        """
+        if x.shape[1] != 3:
+            x = x.repeat(1, 3, 1, 1)
 
         # normalize [-1, 1] to [0, 1] first
-        input = (input + 1) / 2
-        target = (target + 1) / 2
-
-        input = (input-self.mean) / self.std
-        target = (target-self.mean) / self.std
+        x = (x + 1) / 2
+        x = (x - self.mean) / self.std
         if self.resize:
-            input = self.transform(input, mode='bilinear', size=(224, 224), align_corners=False)
-            target = self.transform(target, mode='bilinear', size=(224, 224), align_corners=False)
-        loss = 0.0
-        x = input
-        y = target
+            x = self.transform(x, mode='bilinear', size=(224, 224), align_corners=False)
+        feats = []
         for i, block in enumerate(self.blocks):
             x = block(x)
-            y = block(y)
-            if i == 2:
-                loss += torch.nn.functional.l1_loss(x, y)
+            if i in self.layers:
+                feats.append(x)
+        return feats
+
+    def feature_loss(self, input_feats, target_feats):
+        loss = 0.0
+        for x, y in zip(input_feats, target_feats):
+            loss += torch.nn.functional.l1_loss(x, y)
         return loss
 
+    def forward(self, input, target=None, target_feats=None):
+        """
+        :param target: target images, input and target run as one batch
+        :param target_feats: precomputed features of the target, as returned by features
+        """
+        if target_feats is None:
+            feats = self.features(torch.cat([input, target], dim=0))
+            input_feats = [f[:input.size(0)] for f in feats]
+            target_feats = [f[input.size(0):] for f in feats]
+            if not target.requires_grad:
+                target_feats = [f.detach() for f in target_feats]
+        else:
+            input_feats = self.features(input)
+        return self.feature_loss(input_feats, target_feats)
+
 
 if __name__ == '__main__':
     model = vgg16(pretrained=True)
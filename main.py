@@ -3,17 +3,26 @@ from utils import process_config
 from trainers import build_trainer
 
 
-def init_config():
+def init_config(manual=None):
     parser = argparse.ArgumentParser('Image Cartoon')
 
     # basic options
     parser.add_argument('--exp-name', default='stargan', help='experiment name',
                         choices=['cyclegan', 'cartoongan', 'whitebox', 'stargan', 'classifier'])
     parser.add_argument('--data-dir', default='/home/zhaobin/cartoon/', help='data dir')
+    parser.add_argument('--data-source', default='disk', choices=['disk', 'synthetic'], help='train on the images of data dir or on pre-generated images in memory')
+    parser.add_argument('--synthetic-size', default=512, type=int, help='number of pre-generated images of the synthetic data source')
+    parser.add_argument('--synthetic-mode', default='procedural', choices=['procedural', 'random'], help='content of the synthetic images')
     parser.add_argument('--n-gpu', default=1, type=int, help='number of gpus to use')
     parser.add_argument('--tensorboard', default=False, action='store_true', help='use tensorboard to log results')
+    parser.add_argument('--tb-scalar-every', type=int, default=1, help='write every tensorboard scalar at most once per this many steps')
+    parser.add_argument('--profile', default=False, action='store_true', help='time the regions of the training step and log a summary every epoch')
+    parser.add_argument('--profile-steps', default='', help='record a torch.profiler trace of global steps N,M into the log dir')
     parser.add_argument('--num-workers', default=4, type=int, help='number of workers in data loaders')
     parser.add_argument('--save-period', default=11, type=int, help='saving period for models')
+    parser.add_argument('--keep-checkpoints', default=0, type=int, help='number of periodic epochN.pth checkpoints to keep, 0 keeps all')
+    parser.add_argument('--ckpt-every-steps', default=0, type=int, help='also checkpoint every N steps within an epoch, 0 to disable')
+    parser.add_argument('--ckpt-every-mins', default=0, type=float, help='also checkpoint every M minutes within an epoch, 0 to disable')
     parser.add_argument('--resume', default=None, help='resume checkpoint path')
 
     # train options
@@ -35,6 +44,13 @@ def init_config():
     parser.add_argument('--num-res', default=4, type=int, help='number of residual blocks in image generator')
     parser.add_argument('--skip-conn', default=False, action='store_true', help="flag of using skip connection in generator")
     parser.add_argument('--data-aug-policy', default='color,translation,cutout', help='data efficient gan training')
+    parser.add_argument('--ada-target', type=float, default=0, help='target overfitting signal of adaptive augmentation, e.g. 0.6, 0 to always augment')
+    parser.add_argument('--ada-interval', type=int, default=4, help='steps between adaptive augmentation probability updates')
+    parser.add_argument('--ada-kimg', type=int, default=500, help='thousands of images for the augmentation probability to go from 0 to 1')
+    parser.add_argument('--ema-decay', type=float, default=0.999, help='per step decay of the moving average of the generator weights, 0 to disable')
+    parser.add_argument('--ema-every', type=int, default=4, help='steps between updates of the moving average of the generator weights')
+    parser.add_argument('--grad-ckpt', default='', help='generator stages with activation checkpointing, comma separated from down,res,up')
+    parser.add_argument('--disc-grad-ckpt', default=False, action='store_true', help='activation checkpointing of the discriminator down stage')
 
     # ================== extra options: add parameters in your experiements here =========================
     # cyclegan
@@ -43,6 +59,10 @@ def init_config():
     # whiteboxgan
     parser.add_argument('--lambda-tv', type=float, default=1, help='total variance loss')
 
+    # whiteboxgan and cartoongan
+    parser.add_argument('--vgg-cache-size', type=int, default=256, help='validation source images whose vgg features are cached, 0 to disable')
+    parser.add_argument('--vgg-cache-dir', default=None, help='keep the cached vgg features in memmap files under this dir instead of host memory')
+
     # star
     parser.add_argument('--style-size', type=int, default=64, help='style dimension')
     parser.add_argument('--latent-size', type=int, default=16, help='latent code dimension')
@@ -50,12 +70,15 @@ def init_config():
     parser.add_argument('--lambda-ds', type=float, default=1, help='diversity loss weight')
     parser.add_argument('--lambda-cls', type=float, default=1, help='classification loss weight')
     parser.add_argument('--nce-t', type=float, default=0.07)
+    parser.add_argument('--num-patches', type=int, default=128, help='patches sampled per image and layer for PatchNCE')
+    parser.add_argument('--nce-per-image', default=False, action='store_true', help='take PatchNCE negatives only from the same image')
+    parser.add_argument('--nce-chunk-size', type=int, default=1024, help='query patches per chunk of the PatchNCE logits')
 
     # classifier
     parser.add_argument('--num-feature', type=int, default=1024, help='num of features')
     parser.add_argument('--num-class', type=int, default=4, help='num of classes')
 
-    return parser.parse_args()
+    return parser.parse_args(manual)
 
 
 def override_config(config):
@@ -2,5 +2,5 @@ from .generator import *
 from .discriminator import *
 from .inception import InceptionV3
 from .lenet import LeNet5
-from .utils import StyleEncoder, MappingNetwork, PatchSampleF
+from .utils import StyleEncoder, MappingNetwork, PatchSampleF, DomainLinear
 from .resnet import ResNet
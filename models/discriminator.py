@@ -1,16 +1,18 @@
 import torch
 import torch.nn as nn
 import math
-from .utils import InstanceNorm
+from .utils import InstanceNorm, GradCheckpointMixin
 from torch.nn.utils import spectral_norm
 
 __all__ = ['Discriminator', 'StarDiscriminator']
 
 
-class Discriminator(nn.Module):
+class Discriminator(GradCheckpointMixin, nn.Module):
     """
     CartoonGAN Discriminator
     """
+    ckpt_stages = ('down',)
+
     def __init__(self, image_size=256, down_size=64):
         super(Discriminator, self).__init__()
 
@@ -47,15 +49,18 @@ class Discriminator(nn.Module):
 
     def forward(self, x):
         out = self.conv_in(x)
-        out = self.conv_down(out)
+        for down_layer in self.conv_down:
+            out = self._run_block('down', down_layer, out)
         out = self.conv_out(out)
         return out
 
 
-class StarDiscriminator(nn.Module):
+class StarDiscriminator(GradCheckpointMixin, nn.Module):
     """
     StarGAN Discriminator
     """
+    ckpt_stages = ('down',)
+
     def __init__(self, image_size=256, down_size=64, num_domains=1):
         super(StarDiscriminator, self).__init__()
 
@@ -93,12 +98,17 @@ class StarDiscriminator(nn.Module):
 
     def forward(self, x, y):
         out = self.conv_in(x)
-        out = self.conv_down(out)
-        # real/fake
-        out = self.conv_out(out)
-        idx = torch.LongTensor(range(y.size(0))).to(y.device)
-        out = out[idx, y].unsqueeze(1)
-        return out
+        for down_layer in self.conv_down:
+            out = self._run_block('down', down_layer, out)
+        # real/fake, only the 1x1 output conv of each sample's domain is evaluated
+        for layer in self.conv_out[:-1]:
+            out = layer(out)
+        head = self.conv_out[-1]
+        batch_size, _, h, w = out.shape
+        weight = head.weight[y].view(batch_size, 1, -1)  # (batch, 1, feat_dim)
+        bias = head.bias[y].view(batch_size, 1, 1)
+        out = torch.baddbmm(bias, weight, out.flatten(2))
+        return out.view(batch_size, 1, h, w)
 
 
 if __name__ == '__main__':
@@ -1,7 +1,7 @@
 import torch
 import torch.nn as nn
 import math
-from .utils import InstanceNorm, AdaInstanceNorm
+from .utils import InstanceNorm, AdaInstanceNorm, GradCheckpointMixin
 
 
 class ResConv(nn.Module):
@@ -36,7 +36,9 @@ class ResConv(nn.Module):
         return out
 
 
-class Generator(nn.Module):
+class Generator(GradCheckpointMixin, nn.Module):
+    ckpt_stages = ('down', 'res', 'up')
+
     def __init__(self, image_size=256, down_size=64, num_res=8, skip_conn=False):
         super(Generator, self).__init__()
         self.image_size = image_size
@@ -100,7 +102,7 @@ class Generator(nn.Module):
             if self.skip_conn:
                 en = down[i]
                 out = torch.cat([out, en], dim=1)
-            out = up_layer(out)
+            out = self._run_block('up', up_layer, out)
 
         out = self.conv_out(out)
         return out
@@ -110,11 +112,12 @@ class Generator(nn.Module):
 
         down = []
         for down_layer in self.down_layers:
-            out = down_layer(out)
+            out = self._run_block('down', down_layer, out)
             down.append(out)
         down = down[::-1]
 
-        out = self.res_layers(out)
+        for res_layer in self.res_layers:
+            out = self._run_block('res', res_layer, out)
         return out, down
 
 
@@ -129,8 +132,15 @@ class UpBlock(nn.Module):
         self.norm2 = AdaInstanceNorm(style_dim, out_dim)
         self.act2 = nn.ReLU(inplace=False)
 
-    def forward(self, x, s):
+    def forward(self, x, s, num_styles=1):
+        """
+        :param num_styles: styles per image of x, consecutive rows of s
+        """
         out = self.conv1(x)
+        if num_styles > 1:
+            # x is shared by several styles, fan out after the style independent conv
+            out = out.repeat_interleave(num_styles, dim=0)
+        assert out.size(0) == s.size(0), 'batch of {} images for {} styles'.format(out.size(0), s.size(0))
         out = self.norm1(out, s)
         out = self.act1(out)
         out = self.conv2(out)
@@ -139,7 +149,9 @@ class UpBlock(nn.Module):
         return out
 
 
-class StarGenerator(nn.Module):
+class StarGenerator(GradCheckpointMixin, nn.Module):
+    ckpt_stages = ('down', 'res', 'up')
+
     def __init__(self, image_size=256, down_size=64, num_res=8, skip_conn=False, style_dim=64):
         super(StarGenerator, self).__init__()
         self.image_size = image_size
@@ -176,6 +188,8 @@ class StarGenerator(nn.Module):
         for i in range(self.num_res):
             res_layers.append(ResConv(feat_dim, feat_dim, 3))
         self.res_layers = nn.ModuleList(res_layers)
+        # channels of the feat_list of forward_encoder
+        self.feat_dims = [64 * 2 ** (i + 1) for i in range(self.num_down)] + [feat_dim] * self.num_res
 
         # upsample layers
         self.up_layers = nn.ModuleList()
@@ -190,15 +204,38 @@ class StarGenerator(nn.Module):
             nn.Conv2d(64, 3, kernel_size=5),
             nn.Tanh())
 
-    def forward(self, x, s):
-
-        out, _, down = self.forward_encoder(x)
+    def forward(self, x, s, return_feats=False):
+        """
+        :param x: input images (batch, 3, H, W)
+        :param s: styles (batch, style_dim), or (batch, K, style_dim) to decode K styles per image
+                  while running the encoder and residual layers only once
+        :param return_feats: also return the encoder feat_list of x, as forward_encoder
+        :return: (batch, 3, H, W), or (batch, K, 3, H, W) for K styles per image
+        """
+        out, feats, down = self.forward_encoder(x)
+        if s.dim() == 2:
+            out = self.forward_decoder(out, down, s)
+        else:
+            batch_size, num_styles = s.size(0), s.size(1)
+            if self.skip_conn:
+                out = out.repeat_interleave(num_styles, dim=0)
+                down = [en.repeat_interleave(num_styles, dim=0) for en in down]
+            out = self.forward_decoder(out, down, s.reshape(batch_size * num_styles, -1),
+                                       1 if self.skip_conn else num_styles)
+            out = out.view(batch_size, num_styles, *out.shape[1:])
+        if return_feats:
+            return out, feats
+        return out
 
+    def forward_decoder(self, out, down, s, num_styles=1):
+        """
+        :param num_styles: styles per image of out, the first up layer repeats its output for them
+        """
         for i, up_layer in enumerate(self.up_layers):
             if self.skip_conn:
                 en = down[i]
                 out = torch.cat([out, en], dim=1)
-            out = up_layer(out, s)
+            out = self._run_block('up', up_layer, out, s, num_styles if i == 0 else 1)
 
         out = self.conv_out(out)
         return out
@@ -209,13 +246,13 @@ class StarGenerator(nn.Module):
         feat_list = []
         down = []
         for i, down_layer in enumerate(self.down_layers):
-            out = down_layer(out)
+            out = self._run_block('down', down_layer, out)
             down.append(out)
             feat_list.append(out)
         down = down[::-1]
 
         for res_layer in self.res_layers:
-            out = res_layer(out)
+            out = self._run_block('res', res_layer, out)
             feat_list.append(out)
         return out, feat_list, down
 
@@ -4,6 +4,7 @@ import torch.nn.functional as F
 import numpy as np
 import math
 from torch.nn import init
+from torch.utils.checkpoint import checkpoint
 
 
 class InstanceNorm(nn.Module):
@@ -25,8 +26,8 @@ class InstanceNorm(nn.Module):
         n = x.size(2) * x.size(3)
         t = x.view(x.size(0), x.size(1), n)
         mean = torch.mean(t, 2).unsqueeze(2).unsqueeze(3).expand_as(x)
-        # Calculate the biased var. torch.var returns unbiased var
-        var = torch.var(t, 2).unsqueeze(2).unsqueeze(3).expand_as(x) * ((n - 1) / float(n))
+        # Calculate the biased var directly so the graph does not bake in the spatial size (ONNX export)
+        var = torch.var(t, 2, unbiased=False).unsqueeze(2).unsqueeze(3).expand_as(x)
         scale_broadcast = self.scale.unsqueeze(1).unsqueeze(1).unsqueeze(0)
         scale_broadcast = scale_broadcast.expand_as(x)
         shift_broadcast = self.shift.unsqueeze(1).unsqueeze(1).unsqueeze(0)
@@ -36,6 +37,53 @@ class InstanceNorm(nn.Module):
         return out
 
 
+# _recompute_in_eval relies on the reentrant checkpoint, whose first forward runs under no_grad so that only the
+# recomputation in backward takes the eval branch. The non-reentrant one runs both with grad enabled, and spectral
+# norm would never do its power iteration. torch < 1.11 has no use_reentrant and is always reentrant
+_REENTRANT = {'use_reentrant': True} if tuple(int(v) for v in torch.__version__.split('.')[:2]) >= (1, 11) else {}
+
+
+class GradCheckpointMixin:
+    """
+    Opt-in activation checkpointing per stage of a network. Every block of a checkpointed stage keeps only
+    its inputs alive and recomputes its activations in backward.
+    """
+    ckpt_stages = ()
+
+    def set_grad_checkpointing(self, stages=()):
+        """
+        :param stages: names of the stages to checkpoint, a subset of ckpt_stages
+        """
+        for stage in stages:
+            if stage not in self.ckpt_stages:
+                raise ValueError('{} has no stage {}, choose from {}'.format(
+                    type(self).__name__, stage, ', '.join(self.ckpt_stages)))
+        self.grad_ckpt_stages = set(stages)
+        return self
+
+    def _run_block(self, stage, block, *inputs):
+        if stage not in getattr(self, 'grad_ckpt_stages', ()) or not torch.is_grad_enabled():
+            return block(*inputs)
+        if not any(torch.is_tensor(x) and x.requires_grad for x in inputs):
+            # checkpoint only back-propagates to the block parameters through inputs requiring grad
+            return block(*inputs)
+        return checkpoint(_recompute_in_eval(block), *inputs, **_REENTRANT)
+
+
+def _recompute_in_eval(block):
+    def forward(*inputs):
+        if torch.is_grad_enabled() and block.training:
+            # recomputation in backward: repeat the forward without another spectral norm power iteration,
+            # so the recomputed weights match the ones of the forward pass
+            block.eval()
+            try:
+                return block(*inputs)
+            finally:
+                block.train()
+        return block(*inputs)
+    return forward
+
+
 class AdaInstanceNorm(nn.Module):
     def __init__(self, style_dim, num_features):
         super().__init__()
@@ -49,9 +97,58 @@ class AdaInstanceNorm(nn.Module):
         return (1 + gamma) * self.norm(x) + beta
 
 
+class DomainLinear(nn.Module):
+    """
+    Per-domain linear heads stacked into one weight, only the head of each sample's domain is evaluated
+    """
+    def __init__(self, in_features, out_features, num_domains=2):
+        super(DomainLinear, self).__init__()
+        self.in_features = in_features
+        self.out_features = out_features
+        self.num_domains = num_domains
+        self.weight = nn.Parameter(torch.Tensor(num_domains, out_features, in_features))
+        self.bias = nn.Parameter(torch.Tensor(num_domains, out_features))
+        self._reset_parameters()
+
+    def _reset_parameters(self):
+        # same as nn.Linear for every domain
+        bound = 1 / math.sqrt(self.in_features)
+        for d in range(self.num_domains):
+            init.kaiming_uniform_(self.weight.data[d], a=math.sqrt(5))
+        init.uniform_(self.bias, -bound, bound)
+
+    def forward(self, x, y):
+        """
+        :param x: (batch, in_features)
+        :param y: domain labels (batch, )
+        :return: (batch, out_features)
+        """
+        weight = self.weight[y]  # (batch, out_features, in_features)
+        bias = self.bias[y].unsqueeze(2)  # (batch, out_features, 1)
+        return torch.baddbmm(bias, weight, x.unsqueeze(2)).squeeze(2)
+
+    def extra_repr(self):
+        return 'in_features={}, out_features={}, num_domains={}'.format(
+            self.in_features, self.out_features, self.num_domains)
+
+
+def _stack_domain_params(state_dict, prefix, old_name, new_name, num_domains):
+    """
+    Convert per-domain nn.Linear parameters of old checkpoints into the stacked DomainLinear ones
+
+    :param old_name: format string of the per-domain module name, e.g. 'unshared.{}.0.'
+    :param new_name: name of the DomainLinear module, e.g. 'unshared.0.'
+    """
+    for param in ('weight', 'bias'):
+        keys = [prefix + old_name.format(d) + param for d in range(num_domains)]
+        if all(key in state_dict for key in keys):
+            state_dict[prefix + new_name + param] = torch.stack([state_dict.pop(key) for key in keys])
+
+
 class MappingNetwork(nn.Module):
     def __init__(self, latent_dim=16, style_dim=64, num_domains=2):
         super().__init__()
+        self.num_domains = num_domains
         layers = []
         layers += [nn.Linear(latent_dim, 256)]
         layers += [nn.ReLU()]
@@ -60,23 +157,24 @@ class MappingNetwork(nn.Module):
             layers += [nn.ReLU()]
         self.shared = nn.Sequential(*layers)
 
-        self.unshared = nn.ModuleList()
-        for _ in range(num_domains):
-            self.unshared += [nn.Sequential(nn.Linear(256, 256),
-                                            nn.ReLU(),
-                                            nn.Linear(256, 128),
-                                            nn.ReLU(),
-                                            nn.Linear(128, style_dim))]
+        self.unshared = nn.ModuleList([DomainLinear(256, 256, num_domains),
+                                       DomainLinear(256, 128, num_domains),
+                                       DomainLinear(128, style_dim, num_domains)])
 
     def forward(self, z, y):
-        h = self.shared(z)
-        out = []
-        for layer in self.unshared:
-            out += [layer(h)]
-        out = torch.stack(out, dim=1)  # (batch, num_domains, style_dim)
-        idx = torch.LongTensor(range(y.size(0))).to(y.device)
-        s = out[idx, y]  # (batch, style_dim)
-        return s
+        s = self.shared(z)
+        for i, layer in enumerate(self.unshared):
+            s = layer(s, y)
+            if i < len(self.unshared) - 1:
+                s = F.relu(s)
+        return s  # (batch, style_dim)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # older checkpoints store one nn.Sequential(Linear, ReLU, Linear, ReLU, Linear) per domain
+        for i, old_idx in enumerate((0, 2, 4)):
+            _stack_domain_params(state_dict, prefix, 'unshared.{}.%d.' % old_idx, 'unshared.%d.' % i,
+                                 self.num_domains)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
 
 
 class ResBlock(nn.Module):
@@ -142,84 +240,174 @@ class StyleEncoder(nn.Module):
         blocks += [nn.LeakyReLU(0.2)]
         self.shared = nn.Sequential(*blocks)
 
-        self.unshared = nn.ModuleList()
-        for _ in range(num_domains):
-            self.unshared += [nn.Linear(dim_out, style_dim)]
+        self.num_domains = num_domains
+        self.unshared = DomainLinear(dim_out, style_dim, num_domains)
 
     def forward(self, x, y):
         h = self.shared(x)
         h = h.view(h.size(0), -1)
-        out = []
-        for layer in self.unshared:
-            out += [layer(h)]
-        out = torch.stack(out, dim=1)  # (batch, num_domains, style_dim)
-        idx = torch.LongTensor(range(y.size(0))).to(y.device)
-        s = out[idx, y]  # (batch, style_dim)
+        s = self.unshared(h, y)  # (batch, style_dim)
         return s
 
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # older checkpoints store one nn.Linear per domain
+        _stack_domain_params(state_dict, prefix, 'unshared.{}.', 'unshared.', self.num_domains)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
 
 class Normalize(nn.Module):
 
-    def __init__(self, power=2):
+    def __init__(self, power=2, dim=1):
         super(Normalize, self).__init__()
         self.power = power
+        self.dim = dim
 
     def forward(self, x):
-        norm = x.pow(self.power).sum(1, keepdim=True).pow(1. / self.power)
+        norm = x.pow(self.power).sum(self.dim, keepdim=True).pow(1. / self.power)
         out = x.div(norm + 1e-7)
         return out
 
 
+class StackedMLP(nn.Module):
+    """
+    Linear-ReLU-Linear heads of several feature layers with the same channels, evaluated with one bmm per linear
+    """
+    def __init__(self, num_layers, in_channels, nc=256, init_type='normal', init_gain=0.02):
+        super(StackedMLP, self).__init__()
+        self.num_layers = num_layers
+        self.weight1 = nn.Parameter(torch.Tensor(num_layers, in_channels, nc))
+        self.bias1 = nn.Parameter(torch.Tensor(num_layers, 1, nc))
+        self.weight2 = nn.Parameter(torch.Tensor(num_layers, nc, nc))
+        self.bias2 = nn.Parameter(torch.Tensor(num_layers, 1, nc))
+        self.init_type = init_type
+        self.init_gain = init_gain
+        self._reset_parameters()
+
+    def _reset_parameters(self):
+        # same as init_weights on one nn.Linear per layer, whose weight is the transpose of a slice
+        for weight in (self.weight1, self.weight2):
+            for i in range(self.num_layers):
+                w = weight.data[i].t()
+                if self.init_type == 'normal':
+                    init.normal_(w, 0.0, self.init_gain)
+                elif self.init_type == 'xavier':
+                    init.xavier_normal_(w, gain=self.init_gain)
+                elif self.init_type == 'kaiming':
+                    init.kaiming_normal_(w, a=0, mode='fan_in')
+                elif self.init_type == 'orthogonal':
+                    init.orthogonal_(w, gain=self.init_gain)
+                else:
+                    raise NotImplementedError('initialization method [%s] is not implemented' % self.init_type)
+        self.bias1.data.zero_()
+        self.bias2.data.zero_()
+
+    def forward(self, x):
+        """
+        :param x: (num_layers, N, in_channels)
+        :return: (num_layers, N, nc)
+        """
+        out = F.relu(torch.baddbmm(self.bias1, x, self.weight1))
+        return torch.baddbmm(self.bias2, out, self.weight2)
+
+
 class PatchSampleF(nn.Module):
-    def __init__(self, use_mlp=False, init_type='normal', init_gain=0.02, nc=256, gpu_ids=[]):
-        # potential issues: currently, we use the same patch_ids for multiple images in the batch
+    """
+    Sample patches of several feature layers and project them with per-layer MLP heads
+
+    Layers with the same channels are gathered with one op and projected together by a StackedMLP.
+    """
+    def __init__(self, in_channels, use_mlp=False, init_type='normal', init_gain=0.02, nc=256):
+        """
+        :param in_channels: channels of every feature layer passed to forward, e.g. StarGenerator.feat_dims
+        """
         super(PatchSampleF, self).__init__()
-        self.l2norm = Normalize(2)
+        self.l2norm = Normalize(2, dim=-1)
         self.use_mlp = use_mlp
-        self.nc = nc  # hard-coded
-        self.mlp_init = False
-        self.init_type = init_type
-        self.init_gain = init_gain
-        self.gpu_ids = gpu_ids
-
-    def create_mlp(self, feats):
-        for mlp_id, feat in enumerate(feats):
-            input_nc = feat.shape[1]
-            mlp = nn.Sequential(*[nn.Linear(input_nc, self.nc), nn.ReLU(), nn.Linear(self.nc, self.nc)])
-            if len(self.gpu_ids) > 0:
-                mlp.cuda()
-            setattr(self, 'mlp_%d' % mlp_id, mlp)
-        init_net(self, self.init_type, self.init_gain, self.gpu_ids)
-        self.mlp_init = True
+        self.nc = nc
+        self.in_channels = list(in_channels)
+
+        # group layers by channels
+        self.groups = []
+        for channels in sorted(set(self.in_channels)):
+            self.groups.append([i for i, c in enumerate(self.in_channels) if c == channels])
+        if self.use_mlp:
+            self.mlps = nn.ModuleList([StackedMLP(len(layers), self.in_channels[layers[0]], nc, init_type, init_gain)
+                                       for layers in self.groups])
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # older checkpoints store one nn.Sequential(Linear, ReLU, Linear) per layer as mlp_<layer>
+        if self.use_mlp:
+            for g, layers in enumerate(self.groups):
+                for old_idx, new_idx in ((0, 1), (2, 2)):
+                    weights = [prefix + 'mlp_%d.%d.weight' % (l, old_idx) for l in layers]
+                    biases = [prefix + 'mlp_%d.%d.bias' % (l, old_idx) for l in layers]
+                    if all(key in state_dict for key in weights + biases):
+                        state_dict[prefix + 'mlps.%d.weight%d' % (g, new_idx)] = torch.stack(
+                            [state_dict.pop(key).t() for key in weights])
+                        state_dict[prefix + 'mlps.%d.bias%d' % (g, new_idx)] = torch.stack(
+                            [state_dict.pop(key) for key in biases]).unsqueeze(1)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def sample_ids(self, feats, num_patches):
+        """
+        Sample distinct patch positions for every image and layer in one call
+
+        :return: (batch, num_layers, num_patches), num_patches is clipped to the smallest layer
+        """
+        sizes = [feat.size(2) * feat.size(3) for feat in feats]
+        num_patches = min(num_patches, min(sizes))
+        device = feats[0].device
+        scores = torch.rand((feats[0].size(0), len(feats), max(sizes)), device=device)
+        invalid = torch.arange(max(sizes), device=device) >= torch.tensor(sizes, device=device).view(-1, 1)
+        scores.masked_fill_(invalid.unsqueeze(0), -1.0)
+        return scores.topk(num_patches, dim=2)[1]
 
     def forward(self, feats, num_patches=64, patch_ids=None):
-        return_ids = []
+        """
+        :param feats: list of feature maps (batch, C_l, H_l, W_l)
+        :param num_patches: patches sampled per image and layer, 0 to keep every position
+        :param patch_ids: (batch, num_layers, num_patches) from a previous call to sample the same positions
+        :return: list of (batch * num_patches, nc) per layer ((batch, nc, H_l, W_l) if num_patches is 0), patch_ids
+        """
+        if num_patches <= 0:
+            return self._forward_dense(feats), None
+
+        batch_size = feats[0].size(0)
+        if patch_ids is None:
+            patch_ids = self.sample_ids(feats, num_patches)
+        num_patches = patch_ids.size(2)
+
+        return_feats = [None] * len(feats)
+        for group_id, layers in enumerate(self.groups):
+            channels = self.in_channels[layers[0]]
+            # one gather over the concatenated positions of all layers in the group
+            flat = torch.cat([feats[i].flatten(2) for i in layers], dim=2)  # (batch, C, sum of H_l * W_l)
+            offsets = np.cumsum([0] + [feats[i].size(2) * feats[i].size(3) for i in layers[:-1]])
+            ids = patch_ids[:, layers] + torch.as_tensor(offsets, device=patch_ids.device).view(1, -1, 1)
+            x_sample = torch.gather(flat, 2, ids.view(batch_size, 1, -1).expand(-1, channels, -1))
+            x_sample = x_sample.view(batch_size, channels, len(layers), num_patches)
+            x_sample = x_sample.permute(2, 0, 3, 1).reshape(len(layers), batch_size * num_patches, channels)
+            if self.use_mlp:
+                x_sample = self.mlps[group_id](x_sample)
+            x_sample = self.l2norm(x_sample)
+            for j, i in enumerate(layers):
+                return_feats[i] = x_sample[j]
+        return return_feats, patch_ids
+
+    def _forward_dense(self, feats):
         return_feats = []
-        if self.use_mlp and not self.mlp_init:
-            self.create_mlp(feats)
         for feat_id, feat in enumerate(feats):
-            B, H, W = feat.shape[0], feat.shape[2], feat.shape[3]
-            feat_reshape = feat.permute(0, 2, 3, 1).flatten(1, 2)
-            if num_patches > 0:
-                if patch_ids is not None:
-                    patch_id = patch_ids[feat_id]
-                else:
-                    patch_id = torch.randperm(feat_reshape.shape[1], device=feats[0].device)
-                    patch_id = patch_id[:int(min(num_patches, patch_id.shape[0]))]  # .to(patch_ids.device)
-                x_sample = feat_reshape[:, patch_id, :].flatten(0, 1)  # reshape(-1, x.shape[1])
-            else:
-                x_sample = feat_reshape
-                patch_id = []
+            B, C, H, W = feat.shape
+            x_sample = feat.flatten(2).transpose(1, 2)  # (batch, H * W, C)
             if self.use_mlp:
-                mlp = getattr(self, 'mlp_%d' % feat_id)
-                x_sample = mlp(x_sample)
-            return_ids.append(patch_id)
+                group_id = [k for k, layers in enumerate(self.groups) if feat_id in layers][0]
+                j = self.groups[group_id].index(feat_id)
+                mlp = self.mlps[group_id]
+                x_sample = F.relu(torch.matmul(x_sample, mlp.weight1[j]) + mlp.bias1[j])
+                x_sample = torch.matmul(x_sample, mlp.weight2[j]) + mlp.bias2[j]
             x_sample = self.l2norm(x_sample)
-
-            if num_patches == 0:
-                x_sample = x_sample.permute(0, 2, 1).reshape([B, x_sample.shape[-1], H, W])
-            return_feats.append(x_sample)
-        return return_feats, return_ids
+            return_feats.append(x_sample.transpose(1, 2).reshape(B, x_sample.size(-1), H, W))
+        return return_feats
 
 
 def init_net(net, init_type='normal', init_gain=0.02, gpu_ids=[], debug=False, initialize_weights=True):
@@ -0,0 +1,53 @@
+import os
+working_dir = os.path.dirname(__file__)
+import argparse
+from data_loaders import CartoonDefaultDataLoader
+from inference import load_generator, benchmark_backend, TorchBackend, QuantizedBackend
+from inference.quantize import quantize_cartoon_generator, save_quantized
+
+
+def get_config(manual=None):
+    parser = argparse.ArgumentParser('Image Cartoon int8 quantization')
+    parser.add_argument('--checkpoint-path', required=True, help='checkpoint path')
+    parser.add_argument('--output', default=None, help='int8 model path, defaults to the checkpoint path with _int8.pt')
+    parser.add_argument('--image-size', default=256, type=int, help='calibration and benchmark image size')
+    parser.add_argument('--num-calib', default=256, type=int, help='number of calibration images')
+    parser.add_argument('--batch-size', default=16, type=int, help='calibration batch size')
+    parser.add_argument('--engine', default='fbgemm', choices=['fbgemm', 'qnnpack'], help='quantized engine')
+    parser.add_argument('--benchmark', default=False, action='store_true', help='benchmark int8 against float')
+    parser.add_argument('--threads', default='1,4', help='comma separated thread counts for the benchmark')
+    return parser.parse_args(manual)
+
+
+def main():
+    args = get_config()
+    checkpoint_path = os.path.join(working_dir, args.checkpoint_path)
+    output = args.output or os.path.splitext(checkpoint_path)[0] + '_int8.pt'
+
+    model, config = load_generator(checkpoint_path, device='cpu')
+    if config.exp_name == 'stargan':
+        raise NotImplementedError('int8 quantization is only implemented for Generator')
+
+    # calibrate on source style images
+    data_loader = CartoonDefaultDataLoader(
+        data_dir=config.data_dir,
+        style=config.src_style,
+        image_size=args.image_size,
+        batch_size=args.batch_size,
+        num_workers=config.num_workers)
+    qmodel = quantize_cartoon_generator(model, data_loader, args.num_calib, args.engine)
+    save_quantized(qmodel, output, args.image_size)
+    print("saved int8 model to {}".format(output))
+
+    if args.benchmark:
+        print('{:>8s} {:>8s} {:>12s} {:>12s} {:>12s}'.format('backend', 'threads', 'latency(ms)', 'p90(ms)', 'images/s'))
+        for num_threads in [int(t) for t in args.threads.split(',')]:
+            for name, backend in [('float', TorchBackend(model, 'cpu', num_threads)),
+                                  ('int8', QuantizedBackend(output, num_threads))]:
+                result = benchmark_backend(backend, args.image_size)
+                print('{:>8s} {:>8d} {:>12.2f} {:>12.2f} {:>12.2f}'.format(
+                    name, num_threads, result['latency_ms'], result['latency_p90_ms'], result['images_per_sec']))
+
+
+if __name__ == '__main__':
+    main()
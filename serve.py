@@ -0,0 +1,42 @@
+import os
+working_dir = os.path.dirname(__file__)
+import argparse
+import asyncio
+import torch
+from inference import load_checkpoint_config, load_generator, build_backend
+from inference.server import CartoonServer
+
+
+def get_config(manual=None):
+    parser = argparse.ArgumentParser('Image Cartoon inference server')
+    parser.add_argument('--checkpoint-path', required=True, help='checkpoint path')
+    parser.add_argument('--backend', default='torch', choices=['torch', 'onnx', 'int8'], help='inference backend')
+    parser.add_argument('--model-path', default=None, help='exported onnx model or int8 model of quantize.py')
+    parser.add_argument('--host', default='127.0.0.1', help='host to bind')
+    parser.add_argument('--port', default=8080, type=int, help='port to bind')
+    parser.add_argument('--image-size', default=256, type=int, help='images are resized and center cropped to this size')
+    parser.add_argument('--max-batch-size', default=8, type=int, help='max number of requests per batch')
+    parser.add_argument('--max-latency-ms', default=10, type=float, help='max time a request waits for its batch to fill')
+    parser.add_argument('--workers', default=2, type=int, help='number of model workers')
+    parser.add_argument('--num-threads', default=0, type=int, help='cpu threads for inference, 0 for default')
+    return parser.parse_args(manual)
+
+
+def main():
+    args = get_config()
+    checkpoint_path = os.path.join(working_dir, args.checkpoint_path)
+    device = torch.device('cuda') if torch.cuda.is_available() and args.backend == 'torch' else torch.device('cpu')
+
+    config = load_checkpoint_config(checkpoint_path)
+    model = None
+    if args.backend == 'torch':
+        model, _ = load_generator(checkpoint_path, device, config)
+    backend = build_backend(args.backend, model, args.model_path, device, args.num_threads)
+
+    server = CartoonServer(backend, args.image_size, args.max_batch_size, args.max_latency_ms, args.workers)
+    print("serving {} on http://{}:{}".format(config.exp_name, args.host, args.port))
+    asyncio.get_event_loop().run_until_complete(server.serve(args.host, args.port))
+
+
+if __name__ == '__main__':
+    main()
@@ -4,7 +4,7 @@ import numpy as np
 from base import BaseTrainer
 from models import Generator, Discriminator
 from losses import *
-from data_loaders import CartoonGANDataLoader, DiffAugment
+from data_loaders import CartoonGANDataLoader
 from utils import MetricTracker
 
 
@@ -19,10 +19,6 @@ class CartoonGanTrainer(BaseTrainer):
         self.logger.info("Creating model architecture...")
         g,d = self._build_model()
 
-        # resume
-        if self.config.resume is not None:
-            self._resume_checkpoint(config.resume)
-
         # move to device
         self.gen = g.to(self.device)
         self.disc = d.to(self.device)
@@ -42,7 +38,16 @@ class CartoonGanTrainer(BaseTrainer):
         self.logger.info("Creating metric trackers...")
         self._build_metrics()
 
+        # moving average of the inference generator
+        self._build_ema({'gen': self.gen})
+
+        # resume once the models and optimizers exist
+        if self.config.resume is not None:
+            self._resume_checkpoint(config.resume)
+
     def _build_dataloader(self):
+        if self.config.data_source == 'synthetic':
+            return self._build_synthetic_dataloader('cartoongan', deterministic=True)
         train_dataloader = CartoonGANDataLoader(
             data_dir=self.config.data_dir,
             src_style='real',
@@ -50,12 +55,13 @@ class CartoonGanTrainer(BaseTrainer):
             batch_size=self.config.batch_size,
             image_size=self.config.image_size,
             num_workers=self.config.num_workers)
-        valid_dataloader = train_dataloader.split_validation()
+        valid_dataloader = train_dataloader.split_validation(deterministic=True)
         return train_dataloader, valid_dataloader
 
     def _build_model(self):
         gen = Generator(self.config.image_size, self.config.down_size, self.config.num_res, self.config.skip_conn)
         disc = Discriminator(self.config.image_size, self.config.down_size)
+        self._set_grad_checkpointing([gen], [disc])
         return gen,disc
 
     def _build_optimizer(self, gen,disc):
@@ -66,6 +72,10 @@ class CartoonGanTrainer(BaseTrainer):
     def _build_criterion(self):
         self.adv_loss = eval('{}Loss'.format(self.config.adv_criterion))()
         self.cont_loss = VGGPerceptualLoss().to(self.device)
+        # vgg features of the fixed validation sources, keyed by (path, image size)
+        self.vgg_cache = None
+        if self.config.vgg_cache_size > 0:
+            self.vgg_cache = FeatureCache(self.config.vgg_cache_size, self.config.vgg_cache_dir, name='cartoongan_src')
 
     def _build_metrics(self):
         self.metric_names = ['disc', 'gen']
@@ -78,45 +88,54 @@ class CartoonGanTrainer(BaseTrainer):
         self.disc.train()
         self.train_metrics.reset()
 
-        for batch_idx, (src_imgs, tar_imgs, smooth_tar_imgs) in enumerate(self.train_dataloader):
-            src_imgs, tar_imgs, smooth_tar_imgs = src_imgs.to(self.device), tar_imgs.to(self.device), smooth_tar_imgs.to(self.device)
+        for batch_idx, (src_imgs, tar_imgs, smooth_tar_imgs) in self._timed_loader(self.train_dataloader):
+            with self.profiler.region('to_device'):
+                src_imgs, tar_imgs, smooth_tar_imgs = src_imgs.to(self.device), tar_imgs.to(self.device), smooth_tar_imgs.to(self.device)
             self.gen_optim.zero_grad()
             self.disc_optim.zero_grad()
 
             # generation
-            fake_tar_imgs = self.gen(src_imgs)
+            with self.profiler.region('generator'):
+                fake_tar_imgs = self.gen(src_imgs)
 
             # train G
             self.set_requires_grad(self.disc, requires_grad=False)
-            disc_fake_tar_logits = self.disc(DiffAugment(fake_tar_imgs, policy=self.config.data_aug_policy))
-            gen_adv_loss = self.adv_loss(disc_fake_tar_logits, real=True)
-            gen_cont_loss = self.cont_loss(fake_tar_imgs, src_imgs)
-            gen_loss = self.config.lambda_adv * gen_adv_loss + self.config.lambda_rec * gen_cont_loss
-            gen_loss.backward()
-            self.gen_optim.step()
+            with self.profiler.region('gen_losses'):
+                disc_fake_tar_logits = self.disc(self.augment(fake_tar_imgs))
+                gen_adv_loss = self.adv_loss(disc_fake_tar_logits, real=True)
+                gen_cont_loss = self.cont_loss(fake_tar_imgs, src_imgs)
+            with self.profiler.region('gen_backward'):
+                gen_loss = self.config.lambda_adv * gen_adv_loss + self.config.lambda_rec * gen_cont_loss
+                gen_loss.backward()
+            with self.profiler.region('gen_optim'):
+                self.gen_optim.step()
 
             # train D
             self.set_requires_grad(self.disc, requires_grad=True)
-            disc_real_logits = self.disc(DiffAugment(tar_imgs, policy=self.config.data_aug_policy))
-            disc_fake_logits = self.disc(DiffAugment(fake_tar_imgs.detach(), policy=self.config.data_aug_policy))
-            disc_edge_logits = self.disc(DiffAugment(smooth_tar_imgs, policy=self.config.data_aug_policy))
+            with self.profiler.region('disc'):
+                disc_real_logits, disc_fake_logits, disc_edge_logits = self.forward_disc(
+                    self.disc, [tar_imgs, fake_tar_imgs.detach(), smooth_tar_imgs])
 
-            # compute loss
-            disc_loss = self.adv_loss(disc_real_logits, real=True) + self.adv_loss(disc_fake_logits, real=False) + self.adv_loss(disc_edge_logits, real=True)
-            disc_loss.backward()
-            self.disc_optim.step()
+                # compute loss
+                disc_loss = self.adv_loss(disc_real_logits, real=True) + self.adv_loss(disc_fake_logits, real=False) + self.adv_loss(disc_edge_logits, real=True)
+                disc_loss.backward()
+            with self.profiler.region('disc_optim'):
+                self.disc_optim.step()
+                self.ada_step([disc_real_logits], tar_imgs.size(0))
 
             # ============ log ============ #
-            self.writer.set_step((epoch - 1) * len(self.train_dataloader) + batch_idx)
-            self.train_metrics.update('disc', disc_loss.item())
-            self.train_metrics.update('gen', gen_loss.item())
-
-            if batch_idx % self.log_step == 0:
-                self.logger.info('Train Epoch: {:d} {:s} Disc. Loss: {:.4f} Gen. Loss {:.4f}'.format(
-                    epoch,
-                    self._progress(batch_idx),
-                    disc_loss.item(),
-                    gen_loss.item()))
+            with self.profiler.region('log'):
+                self.writer.set_step((epoch - 1) * len(self.train_dataloader) + batch_idx)
+                self.train_metrics.update('disc', disc_loss.detach())
+                self.train_metrics.update('gen', gen_loss.detach())
+
+                if batch_idx % self.log_step == 0:
+                    self.train_metrics.flush()
+                    self.logger.info('Train Epoch: {:d} {:s} Disc. Loss: {:.4f} Gen. Loss {:.4f}'.format(
+                        epoch,
+                        self._progress(batch_idx),
+                        disc_loss.item(),
+                        gen_loss.item()))
 
         log = self.train_metrics.result()
         val_log = self._valid_epoch(epoch)
@@ -132,22 +151,30 @@ class CartoonGanTrainer(BaseTrainer):
         gen_losses = []
         self.valid_metrics.reset()
         with torch.no_grad():
-            for batch_idx, (src_imgs, tar_imgs, smooth_tar_imgs) in enumerate(self.valid_dataloader):
+            for batch_idx, (src_imgs, tar_imgs, smooth_tar_imgs, src_paths) in enumerate(self.valid_dataloader):
                 src_imgs, tar_imgs, smooth_tar_imgs = src_imgs.to(self.device), tar_imgs.to(self.device), smooth_tar_imgs.to(self.device)
+                src_keys = [(path, self.config.image_size) for path in src_paths]
 
                 # generation
                 fake_tar_imgs = self.gen(src_imgs)
 
                 # D loss
-                disc_fake_logits = self.disc(fake_tar_imgs.detach())
-                disc_real_logits = self.disc(tar_imgs)
-                disc_edge_logits = self.disc(smooth_tar_imgs)
+                disc_real_logits, disc_fake_logits, disc_edge_logits = self.forward_disc(
+                    self.disc, [tar_imgs, fake_tar_imgs, smooth_tar_imgs], augment=False)
                 disc_loss = self.adv_loss(disc_real_logits, real=True) + self.adv_loss(disc_fake_logits, real=False) + self.adv_loss(disc_edge_logits, real=True)
 
                 # G loss
-                disc_fake_tar_logits = self.disc(fake_tar_imgs)
+                disc_fake_tar_logits = disc_fake_logits
                 gen_disc_loss = self.adv_loss(disc_fake_tar_logits, real=True)
-                gen_content_loss = self.cont_loss(fake_tar_imgs, src_imgs)
+                src_feats = self.vgg_cache.get(src_keys, self.device) if self.vgg_cache is not None else None
+                if src_feats is None:
+                    vgg_feats = self.cont_loss.features(torch.cat([fake_tar_imgs, src_imgs], dim=0))
+                    fake_feats, src_feats = zip(*[torch.chunk(f, 2, dim=0) for f in vgg_feats])
+                    if self.vgg_cache is not None:
+                        src_feats = self.vgg_cache.put(src_keys, src_feats)
+                    gen_content_loss = self.cont_loss.feature_loss(fake_feats, src_feats)
+                else:
+                    gen_content_loss = self.cont_loss(fake_tar_imgs, target_feats=src_feats)
                 gen_loss = self.config.lambda_adv * gen_disc_loss +  self.config.lambda_rec * gen_content_loss
 
                 disc_losses.append(disc_loss.item())
@@ -164,14 +191,13 @@ class CartoonGanTrainer(BaseTrainer):
 
         return self.valid_metrics.result()
 
-    def _save_checkpoint(self, epoch):
+    def _checkpoint_state(self, epoch):
         """
-        Saving checkpoints
+        State dicts of the models and optimizers to checkpoint
+
         :param epoch: current epoch number
-        :param log: logging information of the epoch
-        :param save_best: if True, rename the saved checkpoint to 'model_best.pth'
         """
-        state = {
+        return {
             'epoch': epoch,
             'gen_state_dict': self.gen.state_dict() if len(
                 self.device_ids) <= 1 else self.gen.module.state_dict(),
@@ -180,31 +206,17 @@ class CartoonGanTrainer(BaseTrainer):
             'gen_optim': self.gen_optim.state_dict(),
             'disc_optim': self.disc_optim.state_dict()
         }
-        filename = str(self.config.checkpoint_dir + 'current.pth')
-        torch.save(state, filename)
-        self.logger.info("Saving checkpoint: {} ...".format(filename))
 
-        if epoch % self.save_period == 0:
-            filename = str(self.config.checkpoint_dir + 'epoch{}.pth'.format(epoch))
-            torch.save(state, filename)
-            self.logger.info("Saving checkpoint: {} ...".format(filename))
-
-    def _resume_checkpoint(self, resume_path):
-        """
-        Resume from saved checkpoints
-        :param resume_path: Checkpoint path to be resumed
+    def _load_checkpoint_state(self, checkpoint):
         """
-        resume_path = str(resume_path)
-        self.logger.info("Loading checkpoint: {} ...".format(resume_path))
-        checkpoint = torch.load(resume_path)
-        self.start_epoch = checkpoint['epoch'] + 1
+        Load the models and optimizers of a checkpoint
 
+        :param checkpoint: dict of _checkpoint_state
+        """
         # load architecture params from checkpoint.
-        self.gen.load_state_dict(checkpoint['gen_state_dict'])
-        self.disc.load_state_dict(checkpoint['disc_state_dict'])
+        self._module(self.gen).load_state_dict(checkpoint['gen_state_dict'])
+        self._module(self.disc).load_state_dict(checkpoint['disc_state_dict'])
 
         # load optimizer state from checkpoint only when optimizer type is not changed.
         self.gen_optim.load_state_dict(checkpoint['gen_optim'])
         self.disc_optim.load_state_dict(checkpoint['disc_optim'])
-
-        self.logger.info("Checkpoint loaded. Resume training from epoch {}".format(self.start_epoch))
\ No newline at end of file
@@ -19,9 +19,6 @@ class ClassifierTrainer(BaseTrainer):
 
         self.logger.info("Creating model architecture...")
         resnet = self._build_model()
-        # resume
-        if self.config.resume is not None:
-            self._resume_checkpoint(config.resume)
         # move to device
         self.resnet = resnet.to(self.device)
         if len(self.device_ids) > 1:
@@ -37,7 +34,13 @@ class ClassifierTrainer(BaseTrainer):
         self.logger.info("Creating metric trackers...")
         self._build_metrics()
 
+        # resume once the models and optimizers exist
+        if self.config.resume is not None:
+            self._resume_checkpoint(config.resume)
+
     def _build_dataloader(self):
+        if self.config.data_source == 'synthetic':
+            return self._build_synthetic_dataloader('classifier')
         train_dataloader = ClassifierDataLoader(
             data_dir=self.config.data_dir,
             split='train',
@@ -91,15 +94,19 @@ class ClassifierTrainer(BaseTrainer):
         self.resnet.train()
         self.train_metrics.reset()
 
-        for batch_idx, (img, label) in enumerate(self.train_dataloader):
-            img, label = img.to(self.device), label.to(self.device)
+        for batch_idx, (img, label) in self._timed_loader(self.train_dataloader):
+            with self.profiler.region('to_device'):
+                img, label = img.to(self.device), label.to(self.device)
             self.optim.zero_grad()
 
             # raise NotImplementedError
-            pred = self.resnet(img)
-            loss = self.adv_criterion(pred, label)
-            loss.backward()
-            self.optim.step()
+            with self.profiler.region('forward'):
+                pred = self.resnet(img)
+                loss = self.adv_criterion(pred, label)
+            with self.profiler.region('backward'):
+                loss.backward()
+            with self.profiler.region('optim'):
+                self.optim.step()
 
             correct = pred.argmax(1).eq(label)
             correct = correct.view(-1).float()
@@ -108,17 +115,19 @@ class ClassifierTrainer(BaseTrainer):
 
             # ============ log ============ #
 
-            self.writer.set_step((epoch - 1) * len(self.train_dataloader) + batch_idx)
-            # TODO: add the loss you want to log here
-            self.train_metrics.update('resnet_loss', loss.item())
-            self.train_metrics.update('resnet_acc', torch.div(torch.sum(acc), label.size(0)))
+            with self.profiler.region('log'):
+                self.writer.set_step((epoch - 1) * len(self.train_dataloader) + batch_idx)
+                # TODO: add the loss you want to log here
+                self.train_metrics.update('resnet_loss', loss.detach())
+                self.train_metrics.update('resnet_acc', torch.div(torch.sum(acc), label.size(0)))
 
-            if batch_idx % self.log_step == 0:
-                self.logger.info('Train Epoch: {:d} {:s} Loss: {:.4f} Acc: {:.2f}'.format(
-                    epoch,
-                    self._progress(batch_idx),
-                    loss.item(),
-                    torch.div(torch.sum(acc), label.size(0))))
+                if batch_idx % self.log_step == 0:
+                    self.train_metrics.flush()
+                    self.logger.info('Train Epoch: {:d} {:s} Loss: {:.4f} Acc: {:.2f}'.format(
+                        epoch,
+                        self._progress(batch_idx),
+                        loss.item(),
+                        torch.div(torch.sum(acc), label.size(0))))
 
         self.lr_scheduler.step()
         log = self.train_metrics.result()
@@ -165,15 +174,13 @@ class ClassifierTrainer(BaseTrainer):
         return self.valid_metrics.result()
 
 
-    def _save_checkpoint(self, epoch):
+    def _checkpoint_state(self, epoch):
         """
-        Saving checkpoints
+        State dicts of the models and optimizers to checkpoint
 
         :param epoch: current epoch number
-        :param log: logging information of the epoch
-        :param save_best: if True, rename the saved checkpoint to 'model_best.pth'
         """
-        state = {
+        return {
             'epoch': epoch,
             # 'gen_state_dict': self.gen.state_dict() if len(self.device_ids) <= 1 else self.gen.module.state_dict(),
             # 'disc_state_dict': self.disc.state_dict() if len(self.device_ids) <= 1 else self.disc.module.state_dict(),
@@ -182,33 +189,19 @@ class ClassifierTrainer(BaseTrainer):
             'resnet_state_dict': self.resnet.state_dict() if len(self.device_ids) <= 1 else self.resnet.module.state_dict(),
             'resnet_optim': self.optim.state_dict(),
         }
-        filename = str(self.config.checkpoint_dir + 'current.pth')
-        torch.save(state, filename)
-        self.logger.info("Saving checkpoint: {} ...".format(filename))
 
-        if epoch % self.save_period == 0:
-            filename = str(self.config.checkpoint_dir + 'epoch{}.pth'.format(epoch))
-            torch.save(state, filename)
-            self.logger.info("Saving checkpoint: {} ...".format(filename))
-
-    def _resume_checkpoint(self, resume_path):
+    def _load_checkpoint_state(self, checkpoint):
         """
-        Resume from saved checkpoints
+        Load the models and optimizers of a checkpoint
 
-        :param resume_path: Checkpoint path to be resumed
+        :param checkpoint: dict of _checkpoint_state
         """
-        resume_path = str(resume_path)
-        self.logger.info("Loading checkpoint: {} ...".format(resume_path))
-        checkpoint = torch.load(resume_path)
-        self.start_epoch = checkpoint['epoch'] + 1
-
         # load architecture params from checkpoint.
         # self.gen.load_state_dict(checkpoint['gen_state_dict'])
         # self.disc.load_state_dict(checkpoint['disc_state_dict'])
-        self.resnet.load_state_dict(checkpoint['resnet_state_dict'])
+        self._module(self.resnet).load_state_dict(checkpoint['resnet_state_dict'])
 
         # load optimizer state from checkpoint only when optimizer type is not changed.
         # self.gen_optim.load_state_dict(checkpoint['gen_optim'])
         # self.disc_optim.load_state_dict(checkpoint['disc_optim'])
         self.optim.load_state_dict(checkpoint['resnet_optim'])
-        self.logger.info("Checkpoint loaded. Resume training from epoch {}".format(self.start_epoch))
@@ -4,7 +4,7 @@ import numpy as np
 from base import BaseTrainer
 from models import Generator, Discriminator
 from losses import *
-from data_loaders import CartoonDataLoader, DiffAugment
+from data_loaders import CartoonDataLoader
 from utils import MetricTracker
 
 
@@ -18,9 +18,6 @@ class CycleGANTrainer(BaseTrainer):
 
         self.logger.info("Creating model architecture...")
         gen_src_tar, gen_tar_src, disc_src, disc_tar = self._build_model()
-        # resume
-        if self.config.resume is not None:
-            self._resume_checkpoint(config.resume)
         # move to device
         self.gen_src_tar = gen_src_tar.to(self.device)
         self.gen_tar_src = gen_tar_src.to(self.device)
@@ -42,7 +39,16 @@ class CycleGANTrainer(BaseTrainer):
         self.logger.info("Creating metric trackers...")
         self._build_metrics()
 
+        # moving average of the inference generator
+        self._build_ema({'gen': self.gen_src_tar})
+
+        # resume once the models and optimizers exist
+        if self.config.resume is not None:
+            self._resume_checkpoint(config.resume)
+
     def _build_dataloader(self):
+        if self.config.data_source == 'synthetic':
+            return self._build_synthetic_dataloader('cartoon')
         train_dataloader = CartoonDataLoader(
             data_dir=self.config.data_dir,
             src_style='real',
@@ -59,6 +65,7 @@ class CycleGANTrainer(BaseTrainer):
         gen_tar_src = Generator(self.config.image_size, self.config.down_size, self.config.num_res, self.config.skip_conn)
         disc_src = Discriminator(self.config.image_size, self.config.down_size)
         disc_tar = Discriminator(self.config.image_size, self.config.down_size)
+        self._set_grad_checkpointing([gen_src_tar, gen_tar_src], [disc_src, disc_tar])
         return gen_src_tar, gen_tar_src, disc_src, disc_tar
 
     def _build_optimizer(self, gen_src_tar, gen_tar_src, disc_src, disc_tar):
@@ -98,71 +105,80 @@ class CycleGANTrainer(BaseTrainer):
         self.disc_tar.train()
         self.train_metrics.reset()
 
-        for batch_idx, (src_imgs, tar_imgs) in enumerate(self.train_dataloader):
-            src_imgs, tar_imgs = src_imgs.to(self.device), tar_imgs.to(self.device)
+        for batch_idx, (src_imgs, tar_imgs) in self._timed_loader(self.train_dataloader):
+            with self.profiler.region('to_device'):
+                src_imgs, tar_imgs = src_imgs.to(self.device), tar_imgs.to(self.device)
             self.gen_optim.zero_grad()
             self.disc_optim.zero_grad()
 
             # ============ generation ============ #
-            fake_tar_imgs = self.gen_src_tar(src_imgs)
-            fake_src_imgs = self.gen_tar_src(tar_imgs)
+            with self.profiler.region('generator'):
+                fake_tar_imgs = self.gen_src_tar(src_imgs)
+                fake_src_imgs = self.gen_tar_src(tar_imgs)
 
             # ============ train G ============ #
             self.set_requires_grad([self.disc_tar, self.disc_src], requires_grad=False)
 
             # discriminator loss
-            disc_fake_src_logits = self.disc_src(DiffAugment(fake_src_imgs, policy=self.config.data_aug_policy))
-            disc_fake_tar_logits = self.disc_tar(DiffAugment(fake_tar_imgs, policy=self.config.data_aug_policy))
-            disc_src_loss_ = self.adv_criterion(disc_fake_src_logits, real=True)
-            disc_tar_loss_ = self.adv_criterion(disc_fake_tar_logits, real=True)
+            with self.profiler.region('gen_adv'):
+                disc_fake_src_logits = self.disc_src(self.augment(fake_src_imgs))
+                disc_fake_tar_logits = self.disc_tar(self.augment(fake_tar_imgs))
+                disc_src_loss_ = self.adv_criterion(disc_fake_src_logits, real=True)
+                disc_tar_loss_ = self.adv_criterion(disc_fake_tar_logits, real=True)
 
             # translate back and cycle consistant loss
-            rec_src_imgs = self.gen_tar_src(fake_tar_imgs)
-            rec_tar_imgs = self.gen_src_tar(fake_src_imgs)
-            rec_src_loss = self.cyc_criterion(rec_src_imgs, src_imgs)
-            rec_tar_loss = self.cyc_criterion(rec_tar_imgs, tar_imgs)
+            with self.profiler.region('cycle_identity'):
+                rec_src_imgs = self.gen_tar_src(fake_tar_imgs)
+                rec_tar_imgs = self.gen_src_tar(fake_src_imgs)
+                rec_src_loss = self.cyc_criterion(rec_src_imgs, src_imgs)
+                rec_tar_loss = self.cyc_criterion(rec_tar_imgs, tar_imgs)
 
-            # identity loss
-            idt_tar_imgs = self.gen_src_tar(tar_imgs)
-            idt_src_imgs = self.gen_tar_src(src_imgs)
-            idt_loss = 0.5 * self.config.lambda_rec * (self.ide_criterion(idt_tar_imgs, tar_imgs) + self.ide_criterion(idt_src_imgs, src_imgs))
+                # identity loss
+                idt_tar_imgs = self.gen_src_tar(tar_imgs)
+                idt_src_imgs = self.gen_tar_src(src_imgs)
+                idt_loss = 0.5 * self.config.lambda_rec * (self.ide_criterion(idt_tar_imgs, tar_imgs) + self.ide_criterion(idt_src_imgs, src_imgs))
 
             # total generator loss
-            gen_src_loss = self.config.lambda_adv * disc_tar_loss_ + self.config.lambda_rec * rec_src_loss
-            gen_tar_loss = self.config.lambda_adv * disc_src_loss_ + self.config.lambda_rec * rec_tar_loss
-            gen_loss = gen_src_loss + gen_tar_loss + idt_loss
-            gen_loss.backward()
-            self.gen_optim.step()
+            with self.profiler.region('gen_backward'):
+                gen_src_loss = self.config.lambda_adv * disc_tar_loss_ + self.config.lambda_rec * rec_src_loss
+                gen_tar_loss = self.config.lambda_adv * disc_src_loss_ + self.config.lambda_rec * rec_tar_loss
+                gen_loss = gen_src_loss + gen_tar_loss + idt_loss
+                gen_loss.backward()
+            with self.profiler.region('gen_optim'):
+                self.gen_optim.step()
 
             # ============ train D ============ #
             self.set_requires_grad([self.disc_tar, self.disc_src], requires_grad=True)
 
             # get logits from discriminators
-            disc_src_real_logits = self.disc_src(DiffAugment(src_imgs, policy=self.config.data_aug_policy))
-            disc_src_fake_logits = self.disc_src(DiffAugment(fake_src_imgs.detach(), policy=self.config.data_aug_policy))
-            disc_tar_real_logits = self.disc_tar(DiffAugment(tar_imgs, policy=self.config.data_aug_policy))
-            disc_tar_fake_logits = self.disc_tar(DiffAugment(fake_tar_imgs.detach(), policy=self.config.data_aug_policy))
-
-            # compute loss
-            disc_src_loss = self.adv_criterion(disc_src_real_logits, real=True) + self.adv_criterion(disc_src_fake_logits, real=False)
-            disc_tar_loss = self.adv_criterion(disc_tar_real_logits, real=True) + self.adv_criterion(disc_tar_fake_logits, real=False)
-            disc_loss = disc_src_loss + disc_tar_loss
-            disc_loss.backward()
-            self.disc_optim.step()
+            with self.profiler.region('disc'):
+                disc_src_real_logits, disc_src_fake_logits = self.forward_disc(self.disc_src, [src_imgs, fake_src_imgs.detach()])
+                disc_tar_real_logits, disc_tar_fake_logits = self.forward_disc(self.disc_tar, [tar_imgs, fake_tar_imgs.detach()])
+
+                # compute loss
+                disc_src_loss = self.adv_criterion(disc_src_real_logits, real=True) + self.adv_criterion(disc_src_fake_logits, real=False)
+                disc_tar_loss = self.adv_criterion(disc_tar_real_logits, real=True) + self.adv_criterion(disc_tar_fake_logits, real=False)
+                disc_loss = disc_src_loss + disc_tar_loss
+                disc_loss.backward()
+            with self.profiler.region('disc_optim'):
+                self.disc_optim.step()
+                self.ada_step([disc_src_real_logits, disc_tar_real_logits], tar_imgs.size(0))
 
             # ============ log ============ #
-            self.writer.set_step((epoch - 1) * len(self.train_dataloader) + batch_idx)
-            self.train_metrics.update('disc_src', disc_src_loss.item())
-            self.train_metrics.update('disc_tar', disc_tar_loss.item())
-            self.train_metrics.update('gen_src_tar', gen_src_loss.item())
-            self.train_metrics.update('gen_tar_src', gen_tar_loss.item())
-
-            if batch_idx % self.log_step == 0:
-                self.logger.info('Train Epoch: {:d} {:s} Disc. Loss: {:.4f} Gen. Loss {:.4f}'.format(
-                    epoch,
-                    self._progress(batch_idx),
-                    disc_loss.item(),
-                    gen_loss.item()))
+            with self.profiler.region('log'):
+                self.writer.set_step((epoch - 1) * len(self.train_dataloader) + batch_idx)
+                self.train_metrics.update('disc_src', disc_src_loss.detach())
+                self.train_metrics.update('disc_tar', disc_tar_loss.detach())
+                self.train_metrics.update('gen_src_tar', gen_src_loss.detach())
+                self.train_metrics.update('gen_tar_src', gen_tar_loss.detach())
+
+                if batch_idx % self.log_step == 0:
+                    self.train_metrics.flush()
+                    self.logger.info('Train Epoch: {:d} {:s} Disc. Loss: {:.4f} Gen. Loss {:.4f}'.format(
+                        epoch,
+                        self._progress(batch_idx),
+                        disc_loss.item(),
+                        gen_loss.item()))
 
         log = self.train_metrics.result()
         val_log = self._valid_epoch(epoch)
@@ -215,10 +231,10 @@ class CycleGANTrainer(BaseTrainer):
                 # ============ D Loss ============ #
 
                 # get logits from discriminators
-                disc_src_real_logits = self.disc_src(src_imgs)
-                disc_src_fake_logits = self.disc_src(fake_src_imgs.detach())
-                disc_tar_real_logits = self.disc_tar(tar_imgs)
-                disc_tar_fake_logits = self.disc_tar(fake_tar_imgs.detach())
+                disc_src_real_logits, disc_src_fake_logits = self.forward_disc(
+                    self.disc_src, [src_imgs, fake_src_imgs], augment=False)
+                disc_tar_real_logits, disc_tar_fake_logits = self.forward_disc(
+                    self.disc_tar, [tar_imgs, fake_tar_imgs], augment=False)
 
                 # compute loss
                 disc_src_loss = self.adv_criterion(disc_src_real_logits, real=True) + self.adv_criterion(
@@ -246,15 +262,13 @@ class CycleGANTrainer(BaseTrainer):
             self.writer.add_image('tar2src', make_grid(tar_src_imgs.cpu(), nrow=1, normalize=True))
         return self.valid_metrics.result()
 
-    def _save_checkpoint(self, epoch):
+    def _checkpoint_state(self, epoch):
         """
-        Saving checkpoints
+        State dicts of the models and optimizers to checkpoint
 
         :param epoch: current epoch number
-        :param log: logging information of the epoch
-        :param save_best: if True, rename the saved checkpoint to 'model_best.pth'
         """
-        state = {
+        return {
             'epoch': epoch,
             'gen_src_tar_state_dict': self.gen_src_tar.state_dict() if len(self.device_ids) <= 1 else self.gen_src_tar.module.state_dict(),
             'gen_tar_src_state_dict': self.gen_tar_src.state_dict() if len(self.device_ids) <= 1 else self.gen_tar_src.module.state_dict(),
@@ -263,34 +277,19 @@ class CycleGANTrainer(BaseTrainer):
             'gen_optim': self.gen_optim.state_dict(),
             'disc_optim': self.disc_optim.state_dict()
         }
-        filename = str(self.config.checkpoint_dir + 'current.pth')
-        torch.save(state, filename)
-        self.logger.info("Saving checkpoint: {} ...".format(filename))
-
-        if epoch % self.save_period == 0:
-            filename = str(self.config.checkpoint_dir + 'epoch{}.pth'.format(epoch))
-            torch.save(state, filename)
-            self.logger.info("Saving checkpoint: {} ...".format(filename))
 
-    def _resume_checkpoint(self, resume_path):
+    def _load_checkpoint_state(self, checkpoint):
         """
-        Resume from saved checkpoints
+        Load the models and optimizers of a checkpoint
 
-        :param resume_path: Checkpoint path to be resumed
+        :param checkpoint: dict of _checkpoint_state
         """
-        resume_path = str(resume_path)
-        self.logger.info("Loading checkpoint: {} ...".format(resume_path))
-        checkpoint = torch.load(resume_path)
-        self.start_epoch = checkpoint['epoch'] + 1
-
         # load architecture params from checkpoint.
-        self.gen_src_tar.load_state_dict(checkpoint['gen_src_tar_state_dict'])
-        self.gen_tar_src.load_state_dict(checkpoint['gen_tar_src_state_dict'])
-        self.disc_src.load_state_dict(checkpoint['disc_src_state_dict'])
-        self.disc_tar.load_state_dict(checkpoint['disc_tar_state_dict'])
+        self._module(self.gen_src_tar).load_state_dict(checkpoint['gen_src_tar_state_dict'])
+        self._module(self.gen_tar_src).load_state_dict(checkpoint['gen_tar_src_state_dict'])
+        self._module(self.disc_src).load_state_dict(checkpoint['disc_src_state_dict'])
+        self._module(self.disc_tar).load_state_dict(checkpoint['disc_tar_state_dict'])
 
         # load optimizer state from checkpoint only when optimizer type is not changed.
         self.gen_optim.load_state_dict(checkpoint['gen_optim'])
         self.disc_optim.load_state_dict(checkpoint['disc_optim'])
-
-        self.logger.info("Checkpoint loaded. Resume training from epoch {}".format(self.start_epoch))
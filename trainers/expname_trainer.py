@@ -18,9 +18,6 @@ class ExpnameTrainer(BaseTrainer):
 
         self.logger.info("Creating model architecture...")
         gen, disc = self._build_model()
-        # resume
-        if self.config.resume is not None:
-            self._resume_checkpoint(config.resume)
         # move to device
         self.gen = gen.to(self.device)
         self.disc = disc.to(self.device)
@@ -38,7 +35,16 @@ class ExpnameTrainer(BaseTrainer):
         self.logger.info("Creating metric trackers...")
         self._build_metrics()
 
+        # moving average of the inference generator
+        self._build_ema({'gen': self.gen})
+
+        # resume once the models and optimizers exist
+        if self.config.resume is not None:
+            self._resume_checkpoint(config.resume)
+
     def _build_dataloader(self):
+        if self.config.data_source == 'synthetic':
+            return self._build_synthetic_dataloader('cartoon')
         train_dataloader = CartoonDataLoader(
             data_dir=self.config.data_dir,
             src_style='real',
@@ -53,6 +59,7 @@ class ExpnameTrainer(BaseTrainer):
         """ build generator and discriminator model """
         gen = Generator(self.config.image_size, self.config.down_size, self.config.num_res, self.config.skip_conn)
         disc = Discriminator(self.config.image_size, self.config.down_size)
+        self._set_grad_checkpointing([gen], [disc])
         return gen, disc
 
     def _build_optimizer(self, gen, disc):
@@ -89,7 +96,7 @@ class ExpnameTrainer(BaseTrainer):
         self.disc.train()
         self.train_metrics.reset()
 
-        for batch_idx, (src_imgs, tar_imgs) in enumerate(self.train_dataloader):
+        for batch_idx, (src_imgs, tar_imgs) in self._timed_loader(self.train_dataloader):
             src_imgs, tar_imgs = src_imgs.to(self.device), tar_imgs.to(self.device)
             self.gen_optim.zero_grad()
             self.disc_optim.zero_grad()
@@ -110,6 +117,7 @@ class ExpnameTrainer(BaseTrainer):
             # TODO: add the loss you want to log here
 
             if batch_idx % self.log_step == 0:
+                self.train_metrics.flush()
                 self.logger.info('Train Epoch: {:d} {:d} Disc. Loss: {:.4f} Gen. Loss {:.4f}'.format(
                     epoch,
                     self._progress(batch_idx),
@@ -160,46 +168,30 @@ class ExpnameTrainer(BaseTrainer):
         return self.valid_metrics.result()
 
 
-    def _save_checkpoint(self, epoch):
+    def _checkpoint_state(self, epoch):
         """
-        Saving checkpoints
+        State dicts of the models and optimizers to checkpoint
 
         :param epoch: current epoch number
-        :param log: logging information of the epoch
-        :param save_best: if True, rename the saved checkpoint to 'model_best.pth'
         """
-        state = {
+        return {
             'epoch': epoch,
             'gen_state_dict': self.gen.state_dict() if len(self.device_ids) <= 1 else self.gen.module.state_dict(),
             'disc_state_dict': self.disc.state_dict() if len(self.device_ids) <= 1 else self.disc.module.state_dict(),
             'gen_optim': self.gen_optim.state_dict(),
             'disc_optim': self.disc_optim.state_dict()
         }
-        filename = str(self.config.checkpoint_dir + 'current.pth')
-        torch.save(state, filename)
-        self.logger.info("Saving checkpoint: {} ...".format(filename))
 
-        if epoch % self.save_period == 0:
-            filename = str(self.config.checkpoint_dir + 'epoch{}.pth'.format(epoch))
-            torch.save(state, filename)
-            self.logger.info("Saving checkpoint: {} ...".format(filename))
-
-    def _resume_checkpoint(self, resume_path):
+    def _load_checkpoint_state(self, checkpoint):
         """
-        Resume from saved checkpoints
+        Load the models and optimizers of a checkpoint
 
-        :param resume_path: Checkpoint path to be resumed
+        :param checkpoint: dict of _checkpoint_state
         """
-        resume_path = str(resume_path)
-        self.logger.info("Loading checkpoint: {} ...".format(resume_path))
-        checkpoint = torch.load(resume_path)
-        self.start_epoch = checkpoint['epoch'] + 1
-
         # load architecture params from checkpoint.
-        self.gen.load_state_dict(checkpoint['gen_state_dict'])
-        self.disc.load_state_dict(checkpoint['disc_state_dict'])
+        self._module(self.gen).load_state_dict(checkpoint['gen_state_dict'])
+        self._module(self.disc).load_state_dict(checkpoint['disc_state_dict'])
 
         # load optimizer state from checkpoint only when optimizer type is not changed.
         self.gen_optim.load_state_dict(checkpoint['gen_optim'])
         self.disc_optim.load_state_dict(checkpoint['disc_optim'])
-        self.logger.info("Checkpoint loaded. Resume training from epoch {}".format(self.start_epoch))
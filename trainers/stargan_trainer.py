@@ -4,7 +4,7 @@ import numpy as np
 from base import BaseTrainer
 from models import StarGenerator, StarDiscriminator, MappingNetwork, StyleEncoder, PatchSampleF
 from losses import *
-from data_loaders import StarCartoonDataLoader, DiffAugment
+from data_loaders import StarCartoonDataLoader
 from utils import MetricTracker
 
 
@@ -19,10 +19,6 @@ class StarCartoonTrainer(BaseTrainer):
         self.logger.info("Creating model architecture...")
         gen, disc, map_net, samp_net = self._build_model()
 
-        # resume
-        if self.config.resume is not None:
-            self._resume_checkpoint(config.resume)
-
         # move to device
         self.gen = gen.to(self.device)
         self.disc = disc.to(self.device)
@@ -47,7 +43,16 @@ class StarCartoonTrainer(BaseTrainer):
         self.logger.info("Creating metric trackers...")
         self._build_metrics()
 
+        # moving average of the inference generator
+        self._build_ema({'gen': self.gen, 'map_net': self.map_net})
+
+        # resume once the models and optimizers exist
+        if self.config.resume is not None:
+            self._resume_checkpoint(config.resume)
+
     def _build_dataloader(self):
+        if self.config.data_source == 'synthetic':
+            return self._build_synthetic_dataloader('star')
         train_dataloader = StarCartoonDataLoader(
             data_dir=self.config.data_dir,
             batch_size=self.config.batch_size,
@@ -60,7 +65,8 @@ class StarCartoonTrainer(BaseTrainer):
         gen = StarGenerator(self.config.image_size, self.config.down_size, self.config.num_res, self.config.skip_conn, self.config.style_size)
         disc = StarDiscriminator(self.config.image_size, self.config.down_size, num_domains=4)
         map_net = MappingNetwork(latent_dim=16, style_dim=self.config.style_size, num_domains=4)
-        samp_net = PatchSampleF(use_mlp=True, gpu_ids=self.device_ids)
+        samp_net = PatchSampleF(gen.feat_dims, use_mlp=True)
+        self._set_grad_checkpointing([gen], [disc])
         return gen, disc, map_net, samp_net
 
     def _build_optimizer(self, gen, disc, map_net, samp_net):
@@ -70,7 +76,8 @@ class StarCartoonTrainer(BaseTrainer):
 
     def _build_criterion(self):
         self.adv_loss = eval('{}Loss'.format(self.config.adv_criterion))()
-        self.rec_loss = PatchNCELoss(self.config.nce_t).to(self.device)
+        self.rec_loss = PatchNCELoss(self.config.nce_t, chunk_size=self.config.nce_chunk_size,
+                                     include_all_negatives=not self.config.nce_per_image).to(self.device)
 
     def _build_metrics(self):
         self.metric_names = ['disc',
@@ -78,6 +85,34 @@ class StarCartoonTrainer(BaseTrainer):
         self.train_metrics = MetricTracker(*[metric for metric in self.metric_names], writer=self.writer)
         self.valid_metrics = MetricTracker(*[metric for metric in self.metric_names], writer=self.writer)
 
+    def _nce_losses(self, fake_imgs, src_feats, tar_feats):
+        """
+        PatchNCE losses of the translated and the identity images in one encoder and sampler pass
+
+        :param fake_imgs: translated images of the sources followed by the identity images of the targets
+        :param src_feats: encoder features of the sources
+        :param tar_feats: encoder features of the targets
+        :return: content loss, identity loss
+        """
+        batch_size = src_feats[0].size(0)
+        if len(self.device_ids) > 1:
+            _, feat_q, _ = self.gen.module.forward_encoder(fake_imgs)
+        else:
+            _, feat_q, _ = self.gen.forward_encoder(fake_imgs)
+        feat_k = [torch.cat([f_src, f_tar], dim=0) for f_src, f_tar in zip(src_feats, tar_feats)]
+        feat_k_pool, sample_ids = self.samp_net(feat_k, self.config.num_patches, None)
+        feat_q_pool, _ = self.samp_net(feat_q, self.config.num_patches, sample_ids)
+
+        rec_loss = 0.0
+        idt_loss = 0.0
+        for f_q, f_k in zip(feat_q_pool, feat_k_pool):
+            # first half of the patches belong to the translated images
+            f_q_rec, f_q_idt = torch.chunk(f_q, 2, dim=0)
+            f_k_rec, f_k_idt = torch.chunk(f_k, 2, dim=0)
+            rec_loss += self.rec_loss(f_q_rec, f_k_rec, batch_size).mean()
+            idt_loss += self.rec_loss(f_q_idt, f_k_idt, batch_size).mean()
+        return rec_loss, idt_loss
+
     def _train_epoch(self, epoch):
 
         self.gen.train()
@@ -86,89 +121,79 @@ class StarCartoonTrainer(BaseTrainer):
         self.samp_net.train()
         self.train_metrics.reset()
 
-        for batch_idx, (src_imgs, tar_imgs, tar_labels) in enumerate(self.train_dataloader):
-            src_imgs, tar_imgs, tar_labels = src_imgs.to(self.device), tar_imgs.to(self.device), tar_labels.to(self.device)
+        for batch_idx, (src_imgs, tar_imgs, tar_labels) in self._timed_loader(self.train_dataloader):
+            with self.profiler.region('to_device'):
+                src_imgs, tar_imgs, tar_labels = src_imgs.to(self.device), tar_imgs.to(self.device), tar_labels.to(self.device)
             self.gen_optim.zero_grad()
             self.disc_optim.zero_grad()
             batch_size = src_imgs.size(0)
 
-            # generation
-            tar_z = torch.randn((batch_size, self.config.latent_size)).to(self.device)
-            tar_s = self.map_net(tar_z, tar_labels)
-            fake_tar_imgs = self.gen(src_imgs, tar_s)
+            # styles of the generation, diversity and identity passes
+            with self.profiler.region('generator'):
+                tar_z = torch.randn((3 * batch_size, self.config.latent_size)).to(self.device)
+                tar_s, tar_s2, tar_s3 = torch.chunk(self.map_net(tar_z, tar_labels.repeat(3)), 3, dim=0)
+
+                # generation, the diversity style is decoded in the same pass and shares the encoder
+                fake_tar_imgs, src_feats = self.gen(src_imgs, torch.stack([tar_s, tar_s2], dim=1), return_feats=True)
+                fake_tar_imgs, fake_tar_imgs2 = fake_tar_imgs[:, 0], fake_tar_imgs[:, 1]
 
             # train D
             self.set_requires_grad(self.disc, requires_grad=True)
-            disc_real_logits = self.disc(DiffAugment(tar_imgs, policy=self.config.data_aug_policy), tar_labels)
-            disc_fake_logits = self.disc(DiffAugment(fake_tar_imgs.detach(), policy=self.config.data_aug_policy), tar_labels)
+            with self.profiler.region('disc'):
+                disc_real_logits, disc_fake_logits = self.forward_disc(
+                    self.disc, [tar_imgs, fake_tar_imgs.detach()], labels=[tar_labels, tar_labels])
 
-            # compute loss
-            disc_loss = self.adv_loss(disc_real_logits, real=True) + self.adv_loss(disc_fake_logits, real=False)
-            disc_loss.backward()
-            self.disc_optim.step()
+                # compute loss
+                disc_loss = self.adv_loss(disc_real_logits, real=True) + self.adv_loss(disc_fake_logits, real=False)
+                disc_loss.backward()
+            with self.profiler.region('disc_optim'):
+                self.disc_optim.step()
+                self.ada_step([disc_real_logits], batch_size)
 
             # train G
             self.set_requires_grad(self.disc, requires_grad=False)
 
             # adv loss
-            disc_fake_tar_logits = self.disc(DiffAugment(fake_tar_imgs, policy=self.config.data_aug_policy), tar_labels)
-            gen_adv_loss = self.adv_loss(disc_fake_tar_logits, real=True)
-
-            # diversity sensitive loss
-            tar_z2 = torch.randn((batch_size, self.config.latent_size)).to(self.device)
-            tar_s2 = self.map_net(tar_z2, tar_labels)
-            fake_tar_imgs2 = self.gen(src_imgs, tar_s2)
-            fake_tar_imgs2 = fake_tar_imgs2.detach()
-            gen_ds_loss = torch.mean(torch.abs(fake_tar_imgs - fake_tar_imgs2))
-
-            # content loss
-            if len(self.device_ids) > 1:
-                _, feat_q, _ = self.gen.module.forward_encoder(fake_tar_imgs)
-                _, feat_k, _ = self.gen.module.forward_encoder(src_imgs)
-            else:
-                _, feat_q, _ = self.gen.forward_encoder(fake_tar_imgs)
-                _, feat_k, _ = self.gen.forward_encoder(src_imgs)
-            feat_k_pool, sample_ids = self.samp_net(feat_k, 128, None)
-            feat_q_pool, _ = self.samp_net(feat_q, 128, sample_ids)
-            gen_rec_loss = 0.0
-            for f_q, f_k in zip(feat_q_pool, feat_k_pool):
-                gen_rec_loss += self.rec_loss(f_q, f_k).mean()
-
-            # identity loss
-            tar_z3 = torch.randn((batch_size, self.config.latent_size)).to(self.device)
-            tar_s3 = self.map_net(tar_z3, tar_labels)
-            fake_tar_imgs2 = self.gen(tar_imgs, tar_s3)
-            if len(self.device_ids) > 1:
-                _, feat_q, _ = self.gen.module.forward_encoder(fake_tar_imgs2)
-                _, feat_k, _ = self.gen.module.forward_encoder(tar_imgs)
-            else:
-                _, feat_q, _ = self.gen.forward_encoder(fake_tar_imgs2)
-                _, feat_k, _ = self.gen.forward_encoder(tar_imgs)
-            feat_k_pool, sample_ids = self.samp_net(feat_k, 128, None)
-            feat_q_pool, _ = self.samp_net(feat_q, 128, sample_ids)
-            gen_idt_loss = 0.0
-            for f_q, f_k in zip(feat_q_pool, feat_k_pool):
-                gen_idt_loss += self.rec_loss(f_q, f_k).mean()
+            with self.profiler.region('gen_adv'):
+                disc_fake_tar_logits = self.disc(self.augment(fake_tar_imgs), tar_labels)
+                gen_adv_loss = self.adv_loss(disc_fake_tar_logits, real=True)
+
+                # diversity sensitive loss
+                fake_tar_imgs2 = fake_tar_imgs2.detach()
+                gen_ds_loss = torch.mean(torch.abs(fake_tar_imgs - fake_tar_imgs2))
+
+            # identity
+            with self.profiler.region('identity'):
+                fake_idt_imgs, tar_feats = self.gen(tar_imgs, tar_s3, return_feats=True)
+
+            # content and identity loss, keys reuse the encoder features of the generation passes
+            with self.profiler.region('nce'):
+                gen_rec_loss, gen_idt_loss = self._nce_losses(
+                    torch.cat([fake_tar_imgs, fake_idt_imgs], dim=0), src_feats, tar_feats)
 
             # total loss
-            gen_loss = self.config.lambda_adv *  gen_adv_loss + self.config.lambda_rec * (gen_rec_loss + gen_idt_loss) - self.config.lambda_ds * gen_ds_loss
-            gen_loss.backward()
-            self.gen_optim.step()
+            with self.profiler.region('gen_backward'):
+                gen_loss = self.config.lambda_adv *  gen_adv_loss + self.config.lambda_rec * (gen_rec_loss + gen_idt_loss) - self.config.lambda_ds * gen_ds_loss
+                gen_loss.backward()
+            with self.profiler.region('gen_optim'):
+                self.gen_optim.step()
 
             # ============ log ============ #
-            self.writer.set_step((epoch - 1) * len(self.train_dataloader) + batch_idx)
-            self.train_metrics.update('disc', disc_loss.item())
-            self.train_metrics.update('gen', gen_loss.item())
-            self.train_metrics.update('gen_adv', gen_adv_loss.item())
-            self.train_metrics.update('gen_ds', gen_ds_loss.item())
-            self.train_metrics.update('gen_rec', gen_rec_loss.item())
-
-            if batch_idx % self.log_step == 0:
-                self.logger.info('Train Epoch: {:d} {:s} Disc. Loss: {:.4f} Gen. Loss {:.4f}'.format(
-                    epoch,
-                    self._progress(batch_idx),
-                    disc_loss.item(),
-                    gen_loss.item()))
+            with self.profiler.region('log'):
+                self.writer.set_step((epoch - 1) * len(self.train_dataloader) + batch_idx)
+                self.train_metrics.update('disc', disc_loss.detach())
+                self.train_metrics.update('gen', gen_loss.detach())
+                self.train_metrics.update('gen_adv', gen_adv_loss.detach())
+                self.train_metrics.update('gen_ds', gen_ds_loss.detach())
+                self.train_metrics.update('gen_rec', gen_rec_loss.detach())
+
+                if batch_idx % self.log_step == 0:
+                    self.train_metrics.flush()
+                    self.logger.info('Train Epoch: {:d} {:s} Disc. Loss: {:.4f} Gen. Loss {:.4f}'.format(
+                        epoch,
+                        self._progress(batch_idx),
+                        disc_loss.item(),
+                        gen_loss.item()))
 
         log = self.train_metrics.result()
         val_log = self._valid_epoch(epoch)
@@ -195,59 +220,33 @@ class StarCartoonTrainer(BaseTrainer):
                 src_imgs, tar_imgs, tar_labels = src_imgs.to(self.device), tar_imgs.to(self.device), tar_labels.to(self.device)
                 batch_size = src_imgs.size(0)
 
-                # generation
-                tar_z = torch.randn((batch_size, self.config.latent_size)).to(self.device)
-                tar_s = self.map_net(tar_z, tar_labels)
-                fake_tar_imgs = self.gen(src_imgs, tar_s)
+                # styles of the generation, diversity and identity passes
+                tar_z = torch.randn((3 * batch_size, self.config.latent_size)).to(self.device)
+                tar_s, tar_s2, tar_s3 = torch.chunk(self.map_net(tar_z, tar_labels.repeat(3)), 3, dim=0)
+
+                # generation, the diversity style is decoded in the same pass and shares the encoder
+                fake_tar_imgs, src_feats = self.gen(src_imgs, torch.stack([tar_s, tar_s2], dim=1), return_feats=True)
+                fake_tar_imgs, fake_tar_imgs2 = fake_tar_imgs[:, 0], fake_tar_imgs[:, 1]
 
                 # adv loss
-                disc_fake_tar_logits = self.disc(
-                    DiffAugment(fake_tar_imgs, policy=self.config.data_aug_policy), tar_labels)
+                disc_fake_tar_logits = self.disc(self.augment(fake_tar_imgs), tar_labels)
                 gen_adv_loss = self.adv_loss(disc_fake_tar_logits, real=True)
 
                 # diversity sensitive loss
-                tar_z2 = torch.randn((batch_size, self.config.latent_size)).to(self.device)
-                tar_s2 = self.map_net(tar_z2, tar_labels)
-                fake_tar_imgs2 = self.gen(src_imgs, tar_s2)
-                fake_tar_imgs2 = fake_tar_imgs2.detach()
                 gen_ds_loss = torch.mean(torch.abs(fake_tar_imgs - fake_tar_imgs2))
 
-                # content loss
-                if len(self.device_ids) > 1:
-                    _, feat_q, _ = self.gen.module.forward_encoder(fake_tar_imgs)
-                    _, feat_k, _ = self.gen.module.forward_encoder(src_imgs)
-                else:
-                    _, feat_q, _ = self.gen.forward_encoder(fake_tar_imgs)
-                    _, feat_k, _ = self.gen.forward_encoder(src_imgs)
-                feat_k_pool, sample_ids = self.samp_net(feat_k, 128, None)
-                feat_q_pool, _ = self.samp_net(feat_q, 128, sample_ids)
-                gen_rec_loss = 0.0
-                for f_q, f_k in zip(feat_q_pool, feat_k_pool):
-                    gen_rec_loss += self.rec_loss(f_q, f_k).mean()
-
-                # identity loss
-                tar_z3 = torch.randn((batch_size, self.config.latent_size)).to(self.device)
-                tar_s3 = self.map_net(tar_z3, tar_labels)
-                fake_tar_imgs2 = self.gen(tar_imgs, tar_s3)
-                if len(self.device_ids) > 1:
-                    _, feat_q, _ = self.gen.module.forward_encoder(fake_tar_imgs2)
-                    _, feat_k, _ = self.gen.module.forward_encoder(tar_imgs)
-                else:
-                    _, feat_q, _ = self.gen.forward_encoder(fake_tar_imgs2)
-                    _, feat_k, _ = self.gen.forward_encoder(tar_imgs)
-                feat_k_pool, sample_ids = self.samp_net(feat_k, 128, None)
-                feat_q_pool, _ = self.samp_net(feat_q, 128, sample_ids)
-                gen_idt_loss = 0.0
-                for f_q, f_k in zip(feat_q_pool, feat_k_pool):
-                    gen_idt_loss += self.rec_loss(f_q, f_k).mean()
+                # content and identity loss
+                fake_idt_imgs, tar_feats = self.gen(tar_imgs, tar_s3, return_feats=True)
+                gen_rec_loss, gen_idt_loss = self._nce_losses(
+                    torch.cat([fake_tar_imgs, fake_idt_imgs], dim=0), src_feats, tar_feats)
 
                 # total loss
                 gen_loss = self.config.lambda_adv * gen_adv_loss + self.config.lambda_rec * (gen_rec_loss + gen_idt_loss) - self.config.lambda_ds * gen_ds_loss
 
                 # train D
                 self.set_requires_grad(self.disc, requires_grad=True)
-                disc_real_logits = self.disc(tar_imgs, tar_labels)
-                disc_fake_logits = self.disc(fake_tar_imgs.detach(), tar_labels)
+                disc_real_logits, disc_fake_logits = self.forward_disc(
+                    self.disc, [tar_imgs, fake_tar_imgs], labels=[tar_labels, tar_labels], augment=False)
 
                 # compute loss
                 disc_loss = self.adv_loss(disc_real_logits, real=True) + self.adv_loss(disc_fake_logits, real=False)
@@ -272,14 +271,13 @@ class StarCartoonTrainer(BaseTrainer):
 
         return self.valid_metrics.result()
 
-    def _save_checkpoint(self, epoch):
+    def _checkpoint_state(self, epoch):
         """
-        Saving checkpoints
+        State dicts of the models and optimizers to checkpoint
+
         :param epoch: current epoch number
-        :param log: logging information of the epoch
-        :param save_best: if True, rename the saved checkpoint to 'model_best.pth'
         """
-        state = {
+        return {
             'epoch': epoch,
             'gen_state_dict': self.gen.state_dict() if len(
                 self.device_ids) <= 1 else self.gen.module.state_dict(),
@@ -292,35 +290,23 @@ class StarCartoonTrainer(BaseTrainer):
             'gen_optim': self.gen_optim.state_dict(),
             'disc_optim': self.disc_optim.state_dict(),
         }
-        filename = str(self.config.checkpoint_dir + 'current.pth')
-        torch.save(state, filename)
-        self.logger.info("Saving checkpoint: {} ...".format(filename))
-
-        if epoch % self.save_period == 0:
-            filename = str(self.config.checkpoint_dir + 'epoch{}.pth'.format(epoch))
-            torch.save(state, filename)
-            self.logger.info("Saving checkpoint: {} ...".format(filename))
 
-    def _resume_checkpoint(self, resume_path):
+    def _load_checkpoint_state(self, checkpoint):
         """
-        Resume from saved checkpoints
-        :param resume_path: Checkpoint path to be resumed
-        """
-        resume_path = str(resume_path)
-        self.logger.info("Loading checkpoint: {} ...".format(resume_path))
-        checkpoint = torch.load(resume_path)
-        self.start_epoch = checkpoint['epoch'] + 1
+        Load the models and optimizers of a checkpoint
 
+        :param checkpoint: dict of _checkpoint_state
+        """
         # load architecture params from checkpoint.
-        self.gen.load_state_dict(checkpoint['gen_state_dict'])
-        self.disc.load_state_dict(checkpoint['disc_state_dict'])
-        self.map_net.load_state_dict(checkpoint['map_state_dict'])
+        self._module(self.gen).load_state_dict(checkpoint['gen_state_dict'])
+        self._module(self.disc).load_state_dict(checkpoint['disc_state_dict'])
+        self._module(self.map_net).load_state_dict(checkpoint['map_state_dict'])
+        if 'samp_state_dict' in checkpoint:
+            self._module(self.samp_net).load_state_dict(checkpoint['samp_state_dict'])
         # self.style_enc.load_state_dict(checkpoint['sty_state_dict'])
 
         # load optimizer state from checkpoint only when optimizer type is not changed.
-        self.gen_optim.load_state_dict(checkpoint['gen_optim'])
-        self.disc_optim.load_state_dict(checkpoint['disc_optim'])
-        self.map_net_optim.load_state_dict(checkpoint['map_optim'])
+        # checkpoints with per-domain heads have more parameters, their optimizer states are skipped
+        self._load_optimizer_state(self.gen_optim, checkpoint['gen_optim'], 'gen_optim')
+        self._load_optimizer_state(self.disc_optim, checkpoint['disc_optim'], 'disc_optim')
         # self.style_enc_optim.load_state_dict(checkpoint['sty_optim'])
-
-        self.logger.info("Checkpoint loaded. Resume training from epoch {}".format(self.start_epoch))
\ No newline at end of file
@@ -4,7 +4,7 @@ import numpy as np
 from base import BaseTrainer
 from models import Generator, Discriminator
 from losses import *
-from data_loaders import CartoonDataLoader, DiffAugment
+from data_loaders import CartoonDataLoader
 from utils import MetricTracker, guided_filter, color_shift, superpixel
 
 
@@ -18,9 +18,6 @@ class WhiteboxTrainer(BaseTrainer):
 
         self.logger.info("Creating model architecture...")
         gen, disc_blur, disc_gray = self._build_model()
-        # resume
-        if self.config.resume is not None:
-            self._resume_checkpoint(config.resume)
         # move to device
         self.gen = gen.to(self.device)
         self.disc_blur = disc_blur.to(self.device)
@@ -40,7 +37,16 @@ class WhiteboxTrainer(BaseTrainer):
         self.logger.info("Creating metric trackers...")
         self._build_metrics()
 
+        # moving average of the inference generator
+        self._build_ema({'gen': self.gen})
+
+        # resume once the models and optimizers exist
+        if self.config.resume is not None:
+            self._resume_checkpoint(config.resume)
+
     def _build_dataloader(self):
+        if self.config.data_source == 'synthetic':
+            return self._build_synthetic_dataloader('cartoon', deterministic=True)
         train_dataloader = CartoonDataLoader(
             data_dir=self.config.data_dir,
             src_style='real',
@@ -48,7 +54,7 @@ class WhiteboxTrainer(BaseTrainer):
             batch_size=self.config.batch_size,
             image_size=self.config.image_size,
             num_workers=self.config.num_workers)
-        valid_dataloader = train_dataloader.split_validation()
+        valid_dataloader = train_dataloader.split_validation(deterministic=True)
         return train_dataloader, valid_dataloader
 
     def _build_model(self):
@@ -56,6 +62,7 @@ class WhiteboxTrainer(BaseTrainer):
         gen = Generator(self.config.image_size, self.config.down_size, self.config.num_res, self.config.skip_conn)
         disc_blur = Discriminator(self.config.image_size, self.config.down_size)
         disc_gray = Discriminator(self.config.image_size, self.config.down_size)
+        self._set_grad_checkpointing([gen], [disc_blur, disc_gray])
         return gen, disc_blur, disc_gray
 
     def _build_optimizer(self, gen, disc_blur, disc_gray):
@@ -81,12 +88,28 @@ class WhiteboxTrainer(BaseTrainer):
         self.adv_criterion = eval('{}Loss'.format(self.config.adv_criterion))()
         self.tv_loss = TVLoss()
         self.vgg_loss = VGGPerceptualLoss().to(self.device)
+        # vgg features of the fixed validation sources, keyed by (path, image size)
+        self.vgg_cache = None
+        if self.config.vgg_cache_size > 0:
+            self.vgg_cache = FeatureCache(self.config.vgg_cache_size, self.config.vgg_cache_dir, name='whitebox_src')
 
     def _build_metrics(self):
         self.metric_names = ['disc', 'gen', 'disc_blur_loss', 'disc_gray_loss', 'gen_blur_loss', 'gen_gray_loss', 'gen_recon_loss', 'gen_tv_loss']
         self.train_metrics = MetricTracker(*[metric for metric in self.metric_names], writer=self.writer)
         self.valid_metrics = MetricTracker(*[metric for metric in self.metric_names], writer=self.writer)
 
+    def _representations(self, fake_imgs, real_imgs):
+        """
+        Surface (guided filter) and texture (color shift) representations of fake and real images,
+        both computed in one batched call, the color shift weights are shared as in the original white-box gan
+        :return: blur_fake, blur_real, gray_fake, gray_real
+        """
+        imgs = torch.cat([fake_imgs, real_imgs], dim=0)
+        sizes = [fake_imgs.size(0), real_imgs.size(0)]
+        blur_fake, blur_real = torch.split(guided_filter(imgs, imgs, r=5, eps=2e-1), sizes, dim=0)
+        gray_fake, gray_real = torch.split(color_shift(imgs), sizes, dim=0)
+        return blur_fake, blur_real, gray_fake, gray_real
+
     def _train_epoch(self, epoch):
         """
         Training logic for an epoch
@@ -98,87 +121,97 @@ class WhiteboxTrainer(BaseTrainer):
         self.disc_gray.train()
         self.train_metrics.reset()
 
-        for batch_idx, (src_imgs, tar_imgs) in enumerate(self.train_dataloader):
-            src_imgs, tar_imgs = src_imgs.to(self.device), tar_imgs.to(self.device)
+        for batch_idx, (src_imgs, tar_imgs) in self._timed_loader(self.train_dataloader):
+            with self.profiler.region('to_device'):
+                src_imgs, tar_imgs = src_imgs.to(self.device), tar_imgs.to(self.device)
             self.gen_optim.zero_grad()
             self.disc_blur_optim.zero_grad()
             self.disc_gray_optim.zero_grad()
 
             # ============ Generation ============ #
-            fake_tar_imgs = self.gen(src_imgs)
-            fake_tar_imgs = 0.5 * guided_filter(src_imgs, fake_tar_imgs, r=1) + 0.5 * fake_tar_imgs
+            with self.profiler.region('generator'):
+                fake_tar_imgs = self.gen(src_imgs)
+                fake_tar_imgs = 0.5 * guided_filter(src_imgs, fake_tar_imgs, r=1) + 0.5 * fake_tar_imgs
 
             # ============ train G ============ #
             self.set_requires_grad(self.disc_gray, requires_grad=False)
             self.set_requires_grad(self.disc_blur, requires_grad=False)
             tv_loss = self.tv_loss(fake_tar_imgs)
 
+            # surface and texture representations of fake and real targets, computed once for the G and D steps
+            with self.profiler.region('representations'):
+                blur_fake_tar, blur_real_tar, gray_fake_tar, gray_real_tar = self._representations(fake_tar_imgs, tar_imgs)
+
             # surface representation
-            blur_fake_tar = guided_filter(fake_tar_imgs, fake_tar_imgs, r=5, eps=2e-1)
-            disc_blur_fake_logits = self.disc_blur(DiffAugment(blur_fake_tar, policy=self.config.data_aug_policy))
+            with self.profiler.region('gen_adv'):
+                disc_blur_fake_logits = self.disc_blur(self.augment(blur_fake_tar))
 
-            # texture representation
-            gray_fake_tar = color_shift(fake_tar_imgs)
-            disc_gray_fake_logits = self.disc_gray(DiffAugment(gray_fake_tar, policy=self.config.data_aug_policy))
+                # texture representation
+                disc_gray_fake_logits = self.disc_gray(self.augment(gray_fake_tar))
 
-            # surface and texture loss
-            gen_surface_loss = self.adv_criterion(disc_blur_fake_logits, real=True)
-            gen_texture_loss = self.adv_criterion(disc_gray_fake_logits, real=True)
+                # surface and texture loss
+                gen_surface_loss = self.adv_criterion(disc_blur_fake_logits, real=True)
+                gen_texture_loss = self.adv_criterion(disc_gray_fake_logits, real=True)
 
             # structure loss
-            fake_tar_imgs_superpixel = fake_tar_imgs.detach().cpu().numpy().transpose(0, 2, 3, 1)
-            fake_tar_imgs_superpixel = torch.from_numpy(superpixel(fake_tar_imgs_superpixel)).to(self.device)
-            structure_loss = self.vgg_loss(fake_tar_imgs, fake_tar_imgs_superpixel)
+            with self.profiler.region('superpixel', host=True):
+                fake_tar_imgs_superpixel = fake_tar_imgs.detach().cpu().numpy().transpose(0, 2, 3, 1)
+                fake_tar_imgs_superpixel = torch.from_numpy(superpixel(fake_tar_imgs_superpixel)).to(self.device)
 
-            # content loss
-            content_loss = self.vgg_loss(fake_tar_imgs, src_imgs)
+            # content loss, vgg runs once on the fake, superpixel and source images
+            with self.profiler.region('vgg'):
+                vgg_feats = self.vgg_loss.features(torch.cat([fake_tar_imgs, fake_tar_imgs_superpixel, src_imgs], dim=0))
+                fake_feats, superpixel_feats, src_feats = zip(*[torch.chunk(f, 3, dim=0) for f in vgg_feats])
+                structure_loss = self.vgg_loss.feature_loss(fake_feats, [f.detach() for f in superpixel_feats])
+                content_loss = self.vgg_loss.feature_loss(fake_feats, [f.detach() for f in src_feats])
 
-            total_gen = self.config.lambda_tv * tv_loss + self.config.lambda_adv * (gen_surface_loss + gen_texture_loss) + self.config.lambda_rec * (content_loss + structure_loss)
-            total_gen.backward()
-            self.gen_optim.step()
+            with self.profiler.region('gen_backward'):
+                total_gen = self.config.lambda_tv * tv_loss + self.config.lambda_adv * (gen_surface_loss + gen_texture_loss) + self.config.lambda_rec * (content_loss + structure_loss)
+                total_gen.backward()
+            with self.profiler.region('gen_optim'):
+                self.gen_optim.step()
 
             # ============ train D ============ #
             self.set_requires_grad(self.disc_gray, requires_grad=True)
             self.set_requires_grad(self.disc_blur, requires_grad=True)
 
             # surface representation
-            blur_fake_tar = guided_filter(fake_tar_imgs.detach(), fake_tar_imgs.detach(), r=5, eps=2e-1)
-            blur_real_tar = guided_filter(tar_imgs, tar_imgs, r=5, eps=2e-1)
-            blur_fake_logits = self.disc_blur(DiffAugment(blur_fake_tar, policy=self.config.data_aug_policy))
-            blur_real_logits = self.disc_blur(DiffAugment(blur_real_tar, policy=self.config.data_aug_policy))
+            with self.profiler.region('disc'):
+                blur_fake_logits, blur_real_logits = self.forward_disc(self.disc_blur, [blur_fake_tar.detach(), blur_real_tar])
 
-            # texture representation
-            gray_fake_tar = color_shift(fake_tar_imgs.detach())
-            gray_real_tar = color_shift(tar_imgs)
-            gray_fake_logits = self.disc_gray(DiffAugment(gray_fake_tar, policy=self.config.data_aug_policy))
-            gray_real_logits = self.disc_gray(DiffAugment(gray_real_tar, policy=self.config.data_aug_policy))
+                # texture representation
+                gray_fake_logits, gray_real_logits = self.forward_disc(self.disc_gray, [gray_fake_tar.detach(), gray_real_tar])
 
-            disc_blur_loss = self.adv_criterion(blur_real_logits, real=True) + self.adv_criterion(blur_fake_logits, real=False)
-            disc_gray_loss = self.adv_criterion(gray_real_logits, real=True) + self.adv_criterion(gray_fake_logits, real=False)
+                disc_blur_loss = self.adv_criterion(blur_real_logits, real=True) + self.adv_criterion(blur_fake_logits, real=False)
+                disc_gray_loss = self.adv_criterion(gray_real_logits, real=True) + self.adv_criterion(gray_fake_logits, real=False)
 
-            total_disc = disc_blur_loss + disc_gray_loss
-            total_disc.backward()
-            self.disc_blur_optim.step()
-            self.disc_gray_optim.step()
+                total_disc = disc_blur_loss + disc_gray_loss
+                total_disc.backward()
+            with self.profiler.region('disc_optim'):
+                self.disc_blur_optim.step()
+                self.disc_gray_optim.step()
+                self.ada_step([blur_real_logits, gray_real_logits], blur_real_tar.size(0))
 
             # ============ log ============ #
-            self.writer.set_step((epoch - 1) * len(self.train_dataloader) + batch_idx)
-
-            self.train_metrics.update('disc_blur_loss', disc_blur_loss.item())
-            self.train_metrics.update('disc_gray_loss', disc_gray_loss.item())
-            self.train_metrics.update('gen_blur_loss', gen_surface_loss.item())
-            self.train_metrics.update('gen_gray_loss', gen_texture_loss.item())
-            self.train_metrics.update('gen_recon_loss', content_loss.item())
-            self.train_metrics.update('gen_tv_loss', tv_loss.item())
-            self.train_metrics.update('gen', total_gen.item())
-            self.train_metrics.update('disc', total_disc.item())
-
-            if batch_idx % self.log_step == 0:
-                self.logger.info('Train Epoch: {:d} {:s} Disc. Loss: {:.4f} Gen. Loss {:.4f}'.format(
-                    epoch,
-                    self._progress(batch_idx),
-                    total_disc.item(),
-                    total_gen.item()))
+            with self.profiler.region('log'):
+                self.writer.set_step((epoch - 1) * len(self.train_dataloader) + batch_idx)
+
+                self.train_metrics.update('disc_blur_loss', disc_blur_loss.detach())
+                self.train_metrics.update('disc_gray_loss', disc_gray_loss.detach())
+                self.train_metrics.update('gen_blur_loss', gen_surface_loss.detach())
+                self.train_metrics.update('gen_gray_loss', gen_texture_loss.detach())
+                self.train_metrics.update('gen_recon_loss', content_loss.detach())
+                self.train_metrics.update('gen_tv_loss', tv_loss.detach())
+                self.train_metrics.update('gen', total_gen.detach())
+                self.train_metrics.update('disc', total_disc.detach())
+
+                if batch_idx % self.log_step == 0:
+                    self.train_metrics.flush()
+                    self.logger.info('Train Epoch: {:d} {:s} Disc. Loss: {:.4f} Gen. Loss {:.4f}'.format(
+                        epoch,
+                        self._progress(batch_idx),
+                        total_disc.item(),
+                        total_gen.item()))
 
         log = self.train_metrics.result()
         val_log = self._valid_epoch(epoch)
@@ -209,8 +242,9 @@ class WhiteboxTrainer(BaseTrainer):
         self.valid_metrics.reset()
         with torch.no_grad():
 
-            for batch_idx, (src_imgs, tar_imgs) in enumerate(self.valid_dataloader):
+            for batch_idx, (src_imgs, tar_imgs, src_paths) in enumerate(self.valid_dataloader):
                 src_imgs, tar_imgs = src_imgs.to(self.device), tar_imgs.to(self.device)
+                src_keys = [(path, self.config.image_size) for path in src_paths]
 
                 # ============ Generation ============ #
                 fake_tar_imgs = self.gen(src_imgs)
@@ -218,14 +252,13 @@ class WhiteboxTrainer(BaseTrainer):
 
                 # ============ train G ============ #
                 tv_loss = self.tv_loss(fake_tar_imgs)
+                blur_fake_tar, blur_real_tar, gray_fake_tar, gray_real_tar = self._representations(fake_tar_imgs, tar_imgs)
 
                 # surface representation
-                blur_fake_tar = guided_filter(fake_tar_imgs, fake_tar_imgs, r=5, eps=2e-1)
-                disc_blur_fake_logits = self.disc_blur(DiffAugment(blur_fake_tar, policy=self.config.data_aug_policy))
+                disc_blur_fake_logits = self.disc_blur(self.augment(blur_fake_tar))
 
                 # texture representation
-                gray_fake_tar = color_shift(fake_tar_imgs)
-                disc_gray_fake_logits = self.disc_gray(DiffAugment(gray_fake_tar, policy=self.config.data_aug_policy))
+                disc_gray_fake_logits = self.disc_gray(self.augment(gray_fake_tar))
 
                 # surface and texture loss
                 gen_surface_loss = self.adv_criterion(disc_blur_fake_logits, real=True)
@@ -234,26 +267,29 @@ class WhiteboxTrainer(BaseTrainer):
                 # structure loss
                 fake_tar_imgs_superpixel = fake_tar_imgs.detach().cpu().numpy().transpose(0, 2, 3, 1)
                 fake_tar_imgs_superpixel = torch.from_numpy(superpixel(fake_tar_imgs_superpixel)).to(self.device)
-                structure_loss = self.vgg_loss(fake_tar_imgs, fake_tar_imgs_superpixel)
 
-                # content loss
-                content_loss = self.vgg_loss(fake_tar_imgs, src_imgs)
+                # content loss, vgg runs once on the fake, superpixel and (if not cached) source images
+                src_feats = self.vgg_cache.get(src_keys, self.device) if self.vgg_cache is not None else None
+                vgg_imgs = [fake_tar_imgs, fake_tar_imgs_superpixel] + ([src_imgs] if src_feats is None else [])
+                vgg_feats = self.vgg_loss.features(torch.cat(vgg_imgs, dim=0))
+                vgg_feats = list(zip(*[torch.chunk(f, len(vgg_imgs), dim=0) for f in vgg_feats]))
+                fake_feats, superpixel_feats = vgg_feats[0], vgg_feats[1]
+                if src_feats is None:
+                    src_feats = vgg_feats[2]
+                    if self.vgg_cache is not None:
+                        src_feats = self.vgg_cache.put(src_keys, src_feats)
+                structure_loss = self.vgg_loss.feature_loss(fake_feats, [f.detach() for f in superpixel_feats])
+                content_loss = self.vgg_loss.feature_loss(fake_feats, [f.detach() for f in src_feats])
 
                 total_gen = self.config.lambda_tv * tv_loss + self.config.lambda_adv * (gen_surface_loss + gen_texture_loss) + self.config.lambda_rec * (content_loss + structure_loss)
 
                 # ============ train D ============ #
 
                 # surface representation
-                blur_fake_tar = guided_filter(fake_tar_imgs, fake_tar_imgs, r=5, eps=2e-1)
-                blur_real_tar = guided_filter(tar_imgs, tar_imgs, r=5, eps=2e-1)
-                blur_fake_logits = self.disc_blur(DiffAugment(blur_fake_tar, policy=self.config.data_aug_policy))
-                blur_real_logits = self.disc_blur(DiffAugment(blur_real_tar, policy=self.config.data_aug_policy))
+                blur_fake_logits, blur_real_logits = self.forward_disc(self.disc_blur, [blur_fake_tar, blur_real_tar])
 
                 # texture representation
-                gray_fake_tar = color_shift(fake_tar_imgs)
-                gray_real_tar = color_shift(tar_imgs)
-                gray_fake_logits = self.disc_gray(DiffAugment(gray_fake_tar, policy=self.config.data_aug_policy))
-                gray_real_logits = self.disc_gray(DiffAugment(gray_real_tar, policy=self.config.data_aug_policy))
+                gray_fake_logits, gray_real_logits = self.forward_disc(self.disc_gray, [gray_fake_tar, gray_real_tar])
 
                 disc_blur_loss = self.adv_criterion(blur_real_logits, real=True) + self.adv_criterion(blur_fake_logits,
                                                                                                       real=False)
@@ -288,15 +324,13 @@ class WhiteboxTrainer(BaseTrainer):
         return self.valid_metrics.result()
 
 
-    def _save_checkpoint(self, epoch):
+    def _checkpoint_state(self, epoch):
         """
-        Saving checkpoints
+        State dicts of the models and optimizers to checkpoint
 
         :param epoch: current epoch number
-        :param log: logging information of the epoch
-        :param save_best: if True, rename the saved checkpoint to 'model_best.pth'
         """
-        state = {
+        return {
             'epoch': epoch,
             'gen_state_dict': self.gen.state_dict() if len(self.device_ids) <= 1 else self.gen.module.state_dict(),
             'disc_blur_state_dict': self.disc_blur.state_dict() if len(self.device_ids) <= 1 else self.disc_blur.module.state_dict(),
@@ -305,35 +339,20 @@ class WhiteboxTrainer(BaseTrainer):
             'disc_blur_optim': self.disc_blur_optim.state_dict(),
             'disc_gray_optim': self.disc_gray_optim.state_dict()
         }
-        filename = str(self.config.checkpoint_dir + 'current.pth')
-        torch.save(state, filename)
-        self.logger.info("Saving checkpoint: {} ...".format(filename))
 
-        if epoch % self.save_period == 0:
-            filename = str(self.config.checkpoint_dir + 'epoch{}.pth'.format(epoch))
-            torch.save(state, filename)
-            self.logger.info("Saving checkpoint: {} ...".format(filename))
-
-    def _resume_checkpoint(self, resume_path):
+    def _load_checkpoint_state(self, checkpoint):
         """
-        Resume from saved checkpoints
+        Load the models and optimizers of a checkpoint
 
-        :param resume_path: Checkpoint path to be resumed
+        :param checkpoint: dict of _checkpoint_state
         """
-        resume_path = str(resume_path)
-        self.logger.info("Loading checkpoint: {} ...".format(resume_path))
-        checkpoint = torch.load(resume_path)
-        self.start_epoch = checkpoint['epoch'] + 1
-
         # load architecture params from checkpoint.
-        self.gen.load_state_dict(checkpoint['gen_state_dict'])
-        self.disc_blur.load_state_dict(checkpoint['disc_blur_state_dict'])
-        self.disc_gray.load_state_dict(checkpoint['disc_gray_state_dict'])
+        self._module(self.gen).load_state_dict(checkpoint['gen_state_dict'])
+        self._module(self.disc_blur).load_state_dict(checkpoint['disc_blur_state_dict'])
+        self._module(self.disc_gray).load_state_dict(checkpoint['disc_gray_state_dict'])
 
         # load optimizer state from checkpoint only when optimizer type is not changed.
         self.gen_optim.load_state_dict(checkpoint['gen_optim'])
         # self.disc_optim.load_state_dict(checkpoint['disc_optim'])
         self.disc_blur_optim.load_state_dict(checkpoint['disc_blur_optim'])
         self.disc_gray_optim.load_state_dict(checkpoint['disc_gray_optim'])
-
-        self.logger.info("Checkpoint loaded. Resume training from epoch {}".format(self.start_epoch))
@@ -1,4 +1,5 @@
 from .tb import TensorboardWriter
-from .metric import MetricTracker
+from .metric import MetricTracker, ThroughputMeter
 from .config import process_config
+from .profiler import StepProfiler
 from .wb_utils import guided_filter, color_shift, superpixel
\ No newline at end of file
@@ -1,29 +1,108 @@
+import time
 import torch
-import pandas as pd
+import numpy as np
 
 
 class MetricTracker:
+    """
+    Running averages of scalar metrics. Tensor values are accumulated on their device and copied to the host
+    in one transfer on flush, so update does not synchronize with the GPU; python and numpy values go straight
+    into the host totals
+    """
     def __init__(self, *keys, writer=None):
         self.writer = writer
-        self._data = pd.DataFrame(index=keys, columns=['total', 'counts', 'average'])
+        self._keys = list(keys)
+        self._index = {key: i for i, key in enumerate(keys)}
+        self._total = np.zeros(len(keys))
+        self._counts = np.zeros(len(keys))
         self.reset()
 
     def reset(self):
-        for col in self._data.columns:
-            self._data[col].values[:] = 0
+        self._total[:] = 0
+        self._counts[:] = 0
+        self._pending = {}
+        self._pending_counts = {}
 
     def update(self, key, value, n=1):
+        if torch.is_tensor(value):
+            value = value.detach() * n
+            self._pending[key] = value if key not in self._pending else self._pending[key] + value
+            self._pending_counts[key] = self._pending_counts.get(key, 0) + n
+            return
         if self.writer is not None:
             self.writer.add_scalar(key, value)
-        self._data.total[key] += value * n
-        self._data.counts[key] += n
-        self._data.average[key] = self._data.total[key] / self._data.counts[key]
+        i = self._index[key]
+        self._total[i] += value * n
+        self._counts[i] += n
+
+    def flush(self):
+        """
+        Move the tensors accumulated since the last flush to the host totals, their averages are written at the
+        current writer step
+        """
+        if not self._pending:
+            return
+        keys = list(self._pending)
+        totals = torch.stack([self._pending[key].float().reshape(()) for key in keys]).cpu().numpy()
+        for key, total in zip(keys, totals):
+            n = self._pending_counts[key]
+            if self.writer is not None:
+                self.writer.add_scalar(key, total / n)
+            i = self._index[key]
+            self._total[i] += total
+            self._counts[i] += n
+        self._pending = {}
+        self._pending_counts = {}
 
     def avg(self, key):
-        return self._data.average[key]
+        self.flush()
+        i = self._index[key]
+        return self._total[i] / self._counts[i] if self._counts[i] else 0.0
+
+    def result(self):
+        self.flush()
+        average = np.divide(self._total, self._counts, out=np.zeros_like(self._total), where=self._counts > 0)
+        return dict(zip(self._keys, average.tolist()))
+
+
+class ThroughputMeter:
+    """
+    Samples per second and the split of step time into waiting for data and compute. Compute is the host time
+    between receiving a batch and requesting the next one, so it is accurate over windows that end with a device
+    sync, such as MetricTracker.flush at log_step
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        now = time.perf_counter()
+        self._epoch = [now, 0.0, 0, 0]  # start, data time, samples, steps
+        self._window = [now, 0.0, 0, 0]
+
+    def update(self, data_time, num_samples):
+        for stats in (self._epoch, self._window):
+            stats[1] += data_time
+            stats[2] += num_samples
+            stats[3] += 1
+
+    @staticmethod
+    def _result(stats):
+        start, data_time, samples, steps = stats
+        elapsed = max(time.perf_counter() - start, 1e-9)
+        steps = max(steps, 1)
+        return {'samples_per_sec': samples / elapsed,
+                'data_time': data_time / steps,
+                'compute_time': max(elapsed - data_time, 0.0) / steps}
+
+    def window(self):
+        """ statistics since the last call, which starts a new window """
+        result = self._result(self._window)
+        self._window = [time.perf_counter(), 0.0, 0, 0]
+        return result
 
     def result(self):
-        return dict(self._data.average)
+        """ statistics since reset """
+        return self._result(self._epoch)
 
 
 def accuracy(output, target, topk=(1,)):
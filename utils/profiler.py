@@ -0,0 +1,145 @@
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+import torch
+
+try:
+    import torch.profiler as torch_profiler
+except ImportError:
+    torch_profiler = None
+
+
+class StepProfiler:
+    """
+    Named timing regions of the training step. On GPU a region is timed with CUDA events, so it measures the device
+    work launched inside it and the events are read once the device passed them, without synchronizing; on CPU,
+    and for host-only regions such as waiting for data, it is timed with perf_counter. Optionally a torch.profiler
+    trace is recorded for the global steps start..end
+    """
+    # steps between reads of the finished CUDA events, bounds the number of live events
+    resolve_every = 64
+
+    def __init__(self, enabled, device, logger, writer=None, profile_steps=None, trace_dir=None):
+        """
+        :param enabled: time the regions, region() is a no-op otherwise
+        :param profile_steps: (start, end) global steps of the torch.profiler window, or None
+        :param trace_dir: directory of the chrome traces of the window
+        """
+        self.enabled = enabled
+        self.use_cuda = enabled and torch.device(device).type == 'cuda'
+        self.logger = logger
+        self.writer = writer
+        self.profile_steps = profile_steps
+        self.trace_dir = trace_dir
+        self.num_steps = 0
+        self._profiler = None
+        self.reset()
+
+    def reset(self):
+        self._host = OrderedDict()    # name -> [total seconds, count]
+        self._device = OrderedDict()  # name -> [total milliseconds, count] of the read CUDA events
+        self._events = deque()        # (name, start, end) CUDA events not read yet, in record order
+
+    @contextmanager
+    def region(self, name, host=False):
+        """
+        :param name: region name, regions of the same name are summed
+        :param host: time with perf_counter even on GPU, for regions without device work
+        """
+        if not self.enabled:
+            yield
+            return
+        with torch.autograd.profiler.record_function(name):
+            if self.use_cuda and not host:
+                start, end = torch.cuda.Event(enable_timing=True), torch.cuda.Event(enable_timing=True)
+                start.record()
+                yield
+                end.record()
+                self._events.append((name, start, end))
+            else:
+                start = time.perf_counter()
+                yield
+                stats = self._host.setdefault(name, [0.0, 0])
+                stats[0] += time.perf_counter() - start
+                stats[1] += 1
+
+    def step(self):
+        """ mark the end of a training step, starts and stops the torch.profiler window """
+        self.num_steps += 1
+        if self._events and self.num_steps % self.resolve_every == 0:
+            self._resolve(block=False)
+        if self.profile_steps is None:
+            return
+        start, end = self.profile_steps
+        if self.num_steps == start and self._profiler is None:
+            self._profiler = self._start_trace()
+        elif self.num_steps == end and self._profiler is not None:
+            self._stop_trace()
+
+    def _resolve(self, block):
+        """
+        Accumulate the times of the recorded CUDA events
+        :param block: wait for all of them, otherwise stop at the first one the device has not reached
+        """
+        if block:
+            torch.cuda.synchronize()
+        while self._events:
+            name, start, end = self._events[0]
+            if not block and not end.query():
+                break
+            self._events.popleft()
+            stats = self._device.setdefault(name, [0.0, 0])
+            stats[0] += start.elapsed_time(end)
+            stats[1] += 1
+
+    def _start_trace(self):
+        if torch_profiler is not None:
+            activities = [torch_profiler.ProfilerActivity.CPU]
+            if self.use_cuda:
+                activities.append(torch_profiler.ProfilerActivity.CUDA)
+            prof = torch_profiler.profile(activities=activities, record_shapes=True)
+        else:
+            prof = torch.autograd.profiler.profile(use_cuda=self.use_cuda, record_shapes=True)
+        prof.__enter__()
+        self.logger.info("Profiling steps {} to {} ...".format(*self.profile_steps))
+        return prof
+
+    def _stop_trace(self):
+        prof, self._profiler = self._profiler, None
+        prof.__exit__(None, None, None)
+        sort_by = 'cuda_time_total' if self.use_cuda else 'cpu_time_total'
+        self.logger.info(prof.key_averages().table(sort_by=sort_by, row_limit=20))
+        if self.trace_dir is not None:
+            path = '{}/trace_steps{}-{}.json'.format(self.trace_dir.rstrip('/'), *self.profile_steps)
+            prof.export_chrome_trace(path)
+            self.logger.info("Saving profiler trace: {} ...".format(path))
+
+    def summary(self, title=''):
+        """
+        Log a table of the regions timed since the last summary and write their mean times to tensorboard
+        :return: dict of region name to mean milliseconds per call
+        """
+        if not self.enabled:
+            return {}
+        if self._events:
+            self._resolve(block=True)
+        totals = OrderedDict()
+        for name, (total, count) in self._host.items():
+            totals[name] = (total * 1000, count)
+        for name, (total, count) in self._device.items():
+            totals[name] = (total, count)
+        self.reset()
+        if not totals:
+            return {}
+
+        overall = sum(total for total, _ in totals.values())
+        lines = ['{:20s} {:>10s} {:>8s} {:>10s} {:>7s}'.format('region', 'total ms', 'calls', 'mean ms', '%')]
+        means = OrderedDict()
+        for name, (total, count) in sorted(totals.items(), key=lambda item: -item[1][0]):
+            means[name] = total / max(count, 1)
+            lines.append('{:20s} {:10.1f} {:8d} {:10.3f} {:7.1f}'.format(
+                name, total, count, means[name], 100.0 * total / max(overall, 1e-9)))
+            if self.writer is not None:
+                self.writer.add_scalar('time_ms/{}'.format(name), means[name])
+        self.logger.info('Step profile {}\n{}'.format(title, '\n'.join(lines)))
+        return means
@@ -1,9 +1,19 @@
 import importlib
-from datetime import datetime
+import queue
+import threading
+import time
+import torch
 
 
 class TensorboardWriter():
-    def __init__(self, log_dir, logger, enabled):
+    """
+    Tensorboard writer whose events are queued from the training thread and written by a background thread,
+    which flushes the event file in batches. Per-step scalars are downsampled to one event every scalar_every steps
+    per tag
+    """
+    _stop = object()
+
+    def __init__(self, log_dir, logger, enabled, scalar_every=1, flush_secs=30, max_queue=1024):
         self.writer = None
         self.selected_module = ""
 
@@ -29,48 +39,104 @@ class TensorboardWriter():
 
         self.step = 0
         self.mode = ''
+        self.logger = logger
+        self.scalar_every = max(1, scalar_every)
+        self.flush_secs = flush_secs
+        self._last_scalar_step = {}
 
         self.tb_writer_ftns = {
             'add_scalar', 'add_scalars', 'add_image', 'add_images', 'add_audio',
             'add_text', 'add_histogram', 'add_pr_curve', 'add_embedding'
         }
         self.tag_mode_exceptions = {'add_histogram', 'add_embedding'}
-        self.timer = datetime.now()
+
+        # wrappers are built once, attribute lookup then never reaches __getattr__
+        for name in self.tb_writer_ftns:
+            setattr(self, name, self._make_wrapper(name))
+
+        self._queue = None
+        self._thread = None
+        if self.writer is not None:
+            self._queue = queue.Queue(maxsize=max_queue)
+            self._thread = threading.Thread(target=self._worker, name='tensorboard-writer', daemon=True)
+            self._thread.start()
 
     def set_step(self, step, mode='train'):
         self.mode = mode
         self.step = step
-        if step == 0:
-            self.timer = datetime.now()
-        else:
-            duration = datetime.now() - self.timer
-            self.add_scalar('steps_per_sec', 1 / duration.total_seconds())
-            self.timer = datetime.now()
+
+    def _make_wrapper(self, name):
+        def wrapper(tag, data, *args, **kwargs):
+            if self._queue is None:
+                return
+            # add mode(train/valid) tag
+            if name not in self.tag_mode_exceptions:
+                tag = '{}/{}'.format(tag, self.mode)
+            if name == 'add_scalar':
+                last = self._last_scalar_step.get(tag)
+                if last is not None and 0 <= self.step - last < self.scalar_every:
+                    return
+                self._last_scalar_step[tag] = self.step
+            if torch.is_tensor(data):
+                # the device to host copy happens on the writer thread
+                data = data.detach()
+            self._put((name, tag, data, self.step, args, kwargs))
+        return wrapper
+
+    def _put(self, event):
+        """ queue an event, dropped once the writer thread is gone so training never blocks on a full queue """
+        while self._thread is not None and self._thread.is_alive():
+            try:
+                self._queue.put(event, timeout=1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _worker(self):
+        last_flush = time.time()
+        while True:
+            events = [self._queue.get()]
+            while len(events) < 256:
+                try:
+                    events.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = False
+            for event in events:
+                if event is self._stop:
+                    stop = True
+                    continue
+                name, tag, data, step, args, kwargs = event
+                try:
+                    if torch.is_tensor(data):
+                        data = data.cpu()
+                    if name == 'add_embedding':
+                        self.writer.add_embedding(tag=tag, mat=data, global_step=step, *args, **kwargs)
+                    else:
+                        getattr(self.writer, name)(tag, data, step, *args, **kwargs)
+                except Exception as e:
+                    self.logger.warning("Failed to write {} '{}': {}".format(name, tag, e))
+            if stop or time.time() - last_flush > self.flush_secs:
+                try:
+                    self.writer.flush()
+                except Exception as e:
+                    self.logger.warning("Failed to flush tensorboard events: {}".format(e))
+                last_flush = time.time()
+            if stop:
+                return
+
+    def close(self):
+        """ write the queued events and close the event file """
+        if self._thread is not None:
+            self._put(self._stop)
+            self._thread.join()
+            self._thread = None
+            self._queue = None
+            self.writer.close()
 
     def __getattr__(self, name):
         """
-        If visualization is configured to use:
-            return add_data() methods of tensorboard with additional information (step, tag) added.
-        Otherwise:
-            return a blank function handle that does nothing
+        Only reached for attributes that are not tensorboard methods, which are set in __init__
         """
-        if name in self.tb_writer_ftns:
-            add_data = getattr(self.writer, name, None)
-
-            def wrapper(tag, data, *args, **kwargs):
-                if add_data is not None:
-                    # add mode(train/valid) tag
-                    if name not in self.tag_mode_exceptions:
-                        tag = '{}/{}'.format(tag, self.mode)
-                    if name == 'add_embedding':
-                        add_data(tag=tag, mat=data, global_step=self.step, *args, **kwargs)
-                    else:
-                        add_data(tag, data, self.step, *args, **kwargs)
-            return wrapper
-        else:
-            # default action for returning methods defined in this class, set_step() for instance.
-            try:
-                attr = object.__getattr__(name)
-            except AttributeError:
-                raise AttributeError("type object '{}' has no attribute '{}'".format(self.selected_module, name))
-            return attr
+        raise AttributeError("type object '{}' has no attribute '{}'".format(self.selected_module, name))
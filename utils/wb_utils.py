@@ -18,9 +18,7 @@ def box_filter(x, r):
 
 
 def guided_filter(x, y, r, eps=1e-2):
-    x_shape = list(x.size())
-
-    N = box_filter(torch.ones((1, 1, x_shape[2], x_shape[3])), r).to(x.device)
+    N = box_filter(torch.ones_like(x[:1, :1]), r)
 
     mean_x = box_filter(x, r) / (N + eps)
     mean_y = box_filter(y, r) / (N + eps)